@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+"""Measure Anisette data throughput of a provisioned session."""
+
+import argparse
+import sys
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+from anisette import Anisette, GuestProfiler, TraceLevel
+
+
+def measure(func: Callable[[], object], iterations: int) -> float:
+    """Run a function a number of times and return the number of calls per second."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return iterations / (time.perf_counter() - start)
+
+
+def bench_trace_levels(files: list[str], iterations: int) -> None:
+    """Compare OTP throughput for every trace level."""
+    for level in TraceLevel:
+        ani = Anisette.load(*files, trace_level=level)
+        ani.get_data()  # warm up: start VM
+
+        rate = measure(ani.get_data, iterations)
+        print(f"{level.value:>12}: {rate:8.2f} OTP/s")
+
+
+def bench_threads(files: list[str], iterations: int, max_threads: int) -> None:
+    """Measure combined OTP throughput of independent sessions, one per thread."""
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", lambda: True)
+    print(f"GIL {'enabled' if is_gil_enabled() else 'disabled'}")
+
+    sessions = [Anisette.load(*files) for _ in range(max_threads)]
+    with ThreadPoolExecutor(max_threads) as executor:
+        list(executor.map(lambda ani: ani.get_data(), sessions))  # warm up: start VMs
+
+        threads = 1
+        while threads <= max_threads:
+            start = time.perf_counter()
+            list(executor.map(lambda ani: measure(ani.get_data, iterations), sessions[:threads]))
+            rate = threads * iterations / (time.perf_counter() - start)
+            print(f"{threads:>4} threads: {rate:8.2f} OTP/s")
+            threads *= 2
+
+
+def profile(files: list[str], iterations: int, output: str) -> None:
+    """Sample guest execution while generating OTPs, and write the samples as collapsed stacks."""
+    ani = Anisette.load(*files)
+    ani.get_data()  # warm up: start VM
+
+    with ani.profile(GuestProfiler()) as profiler:
+        rate = measure(ani.get_data, iterations)
+    profiler.write_collapsed(output)
+    print(f"{'profiled':>12}: {rate:8.2f} OTP/s, samples written to {output}")
+
+
+def main() -> None:
+    """Entrypoint."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("files", nargs="+", help="Saved session file(s), as passed to Anisette.load")
+    parser.add_argument("-n", "--iterations", type=int, default=50, help="Number of OTPs to generate per run")
+    parser.add_argument("-t", "--threads", type=int, default=0, help="Measure scaling up to this many threads")
+    parser.add_argument("-p", "--profile", metavar="FILE", help="Write a guest profile in collapsed stack format")
+    args = parser.parse_args()
+
+    if args.profile:
+        profile(args.files, args.iterations, args.profile)
+    elif args.threads:
+        bench_threads(args.files, args.iterations, args.threads)
+    else:
+        bench_trace_levels(args.files, args.iterations)
+
+
+if __name__ == "__main__":
+    main()
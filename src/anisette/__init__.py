@@ -2,9 +2,27 @@
 
 from importlib.metadata import version
 
+from ._allocator import AllocatorStats
 from ._device import AnisetteDeviceConfig
+from ._profiler import GuestProfiler, LeakReport, LeakSite, StubStats
+from ._vm import Backend, CallBudget, CallBudgetExceededError, CallStats, MemoryProfile, TraceLevel
 from .anisette import Anisette, AnisetteHeaders
 
 __version__ = version("anisette")
 
-__all__ = ("Anisette", "AnisetteDeviceConfig", "AnisetteHeaders")
+__all__ = (
+    "AllocatorStats",
+    "Anisette",
+    "AnisetteDeviceConfig",
+    "AnisetteHeaders",
+    "Backend",
+    "CallBudget",
+    "CallBudgetExceededError",
+    "CallStats",
+    "GuestProfiler",
+    "LeakReport",
+    "LeakSite",
+    "MemoryProfile",
+    "StubStats",
+    "TraceLevel",
+)
@@ -1,18 +1,31 @@
 from __future__ import annotations
 
 import logging
+import struct
+import threading
 from dataclasses import dataclass
 from typing import TYPE_CHECKING
 
+from typing_extensions import override
+
+from ._fs import StatResult, VirtualFileSystem
+from ._native import NativeVM, runs_natively
 from ._util import u_to_s32
-from ._vm import VM, Architecture
+from ._vm import VM, Architecture, VMOptions, VMSnapshot
 
 if TYPE_CHECKING:
-    from ._fs import VirtualFileSystem
+    from ._allocator import AllocatorStats
     from ._library import LibraryStore
+    from ._profiler import GuestProfiler, LeakReport, StubRecorder
+    from ._vm import CallStats
 
 logger = logging.getLogger(__name__)
 
+# Out-parameters of ADI calls: two (pointer, length) pairs, or (pointer, length, session)
+_OUT_PARAMS_SIZE = 0x20
+_OTP_OUT_PARAMS = struct.Struct("<QI4xQI4x")  # otp, otp length, mid, mid length
+_CPIM_OUT_PARAMS = struct.Struct("<QI4xI")  # cpim, cpim length, session
+
 
 @dataclass(frozen=True)
 class ClientProvisioningIntermediateMetadata:
@@ -28,13 +41,170 @@ class OneTimePassword:
     machine_id: bytes
 
 
-class ADI:
-    def __init__(self, fs: VirtualFileSystem, lib_store: LibraryStore, identifier: str) -> None:
-        self._vm = VM.create(fs, lib_store, Architecture.ARM64)
+class _RecordingFileSystem(VirtualFileSystem):
+    """Virtual file system that remembers every path the guest touched."""
+
+    def __init__(self, fs: VirtualFileSystem) -> None:
+        super().__init__(fs)
+
+        self.accessed_paths: set[str] = set()
+
+    @override
+    def open(self, path: str, o_flag: int) -> int:
+        self.accessed_paths.add(path)
+        return super().open(path, o_flag)
+
+    @override
+    def mkdir(self, path: str) -> None:
+        self.accessed_paths.add(path)
+        return super().mkdir(path)
+
+    @override
+    def stat(self, path_or_fd: str | int) -> StatResult:
+        if isinstance(path_or_fd, str):
+            self.accessed_paths.add(path_or_fd)
+        return super().stat(path_or_fd)
+
+
+def _probe(fs: VirtualFileSystem, path: str) -> tuple[StatResult, bytes | None] | None:
+    try:
+        stat = fs.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    try:
+        return stat, fs.read_bytes(path)
+    except IsADirectoryError:
+        return stat, None
+
+
+def _read_files(fs: VirtualFileSystem) -> dict[str, bytes]:
+    return {f"{path}/{name}": fs.read_bytes(f"{path}/{name}") for path, _, files in fs.walk(".") for name in files}
 
+
+@dataclass(frozen=True)
+class _ADITemplate:
+    """
+    Snapshot of a fully initialized ADI.
+
+    Initialization may look at the file system, so a template is only valid for file systems on which every
+    path touched while building it looks the same as it did back then.
+    """
+
+    snapshot: VMSnapshot | None
+    observed: tuple[tuple[str, tuple[StatResult, bytes | None] | None], ...]
+    directories: tuple[str, ...]
+
+    def applies_to(self, fs: VirtualFileSystem) -> bool:
+        return all(_probe(fs, path) == expected for path, expected in self.observed)
+
+    def prepare(self, fs: VirtualFileSystem) -> None:
+        # replay the side effects initialization had on the file system
+        for path in self.directories:
+            fs.mkdir(path)
+
+
+_MAX_TEMPLATES = 4
+
+# (library digest, memory key) -> templates, most recently built first, shared by all sessions of this process
+_templates: dict[tuple[str, tuple[object, ...]], list[_ADITemplate]] = {}
+# one lock per key, held while looking up or building its templates, so concurrent VM startups build each
+# template only once without making startups with other libraries or options wait for it
+_template_locks: dict[tuple[str, tuple[object, ...]], threading.Lock] = {}
+_templates_lock = threading.Lock()
+
+
+def _build_template(
+    fs: VirtualFileSystem,
+    lib_store: LibraryStore,
+    identifier: str,
+    options: VMOptions | None,
+) -> _ADITemplate:
+    logger.debug("Building ADI template")
+
+    template_fs = _RecordingFileSystem(fs.copy())
+    dirs_before = {path for path, _, _ in template_fs.walk(".")}
+    files_before = _read_files(template_fs)
+
+    adi = ADI(template_fs, lib_store, identifier, options, use_template=False)
+    vm = adi._vm  # noqa: SLF001
+    assert isinstance(vm, VM)
+
+    observed = tuple((path, _probe(fs, path)) for path in sorted(template_fs.accessed_paths))
+    if template_fs.has_open_files or _read_files(template_fs) != files_before:
+        # cloning would lose these writes, so always initialize from scratch in this state
+        logger.debug("ADI initialization modifies files, not using a template")
+        return _ADITemplate(None, observed, ())
+
+    return _ADITemplate(
+        snapshot=vm.snapshot(),
+        observed=observed,
+        directories=tuple(path for path, _, _ in template_fs.walk(".") if path not in dirs_before),
+    )
+
+
+def _get_template(
+    fs: VirtualFileSystem,
+    lib_store: LibraryStore,
+    identifier: str,
+    options: VMOptions | None,
+) -> _ADITemplate:
+    key = (lib_store.content_digest, (options or VMOptions()).memory_key)
+    with _templates_lock:
+        key_lock = _template_locks.setdefault(key, threading.Lock())
+
+    with key_lock:
+        templates = _templates.setdefault(key, [])
+        for template in templates:
+            if template.applies_to(fs):
+                return template
+
+        template = _build_template(fs, lib_store, identifier, options)
+        templates.insert(0, template)
+        del templates[_MAX_TEMPLATES:]
+        return template
+
+
+class ADI:
+    def __init__(
+        self,
+        fs: VirtualFileSystem,
+        lib_store: LibraryStore,
+        identifier: str,
+        options: VMOptions | None = None,
+        use_template: bool = True,
+    ) -> None:
         self._provisioning_path: str | None = None
         self._identifier: str | None = None
+        self._p_out_params: int | None = None
+
+        # native VMs live at addresses of their own in the host process, so they can't be cloned
+        native = runs_natively(options, Architecture.ARM64)
+        template = _get_template(fs, lib_store, identifier, options) if use_template and not native else None
+        if template is not None and template.snapshot is not None:
+            logger.debug("Cloning VM from ADI template")
+
+            self._vm: VM | NativeVM = VM.from_snapshot(template.snapshot, fs, lib_store, options)
+            template.prepare(fs)
+
+            self._resolve_symbols()
+
+            # template was initialized in the regular order, we only need to swap out the identifier
+            self._set_identifier(identifier)
+            self._provisioning_path = "."
+            return
+
+        if native:
+            self._vm = NativeVM(fs, lib_store, Architecture.ARM64, options)
+        else:
+            self._vm = VM.create(fs, lib_store, Architecture.ARM64, options)
 
+        self._resolve_symbols()
+
+        self._set_identifier(identifier)
+        self._set_provisioning_path(".")
+        self._load_library(".")
+
+    def _resolve_symbols(self) -> None:
         ssc_library = self._vm.load_library("libstoreservicescore.so")
 
         logger.debug("Loading Android-specific symbols...")
@@ -54,32 +224,79 @@ class ADI:
         self.__pADIDispose = ssc_library.resolve_symbol_by_name("jk24uiwqrg")
         self.__pADIOTPRequest = ssc_library.resolve_symbol_by_name("qi864985u0")
 
-        self._set_identifier(identifier)
-        self._set_provisioning_path(".")
-        self._load_library(".")
+        self._entry_points = {
+            self.__pADILoadLibraryWithPath: "ADILoadLibraryWithPath",
+            self.__pADISetAndroidID: "ADISetAndroidID",
+            self.__pADISetProvisioningPath: "ADISetProvisioningPath",
+            self.__pADIProvisioningErase: "ADIProvisioningErase",
+            self.__pADISynchronize: "ADISynchronize",
+            self.__pADIProvisioningDestroy: "ADIProvisioningDestroy",
+            self.__pADIProvisioningEnd: "ADIProvisioningEnd",
+            self.__pADIProvisioningStart: "ADIProvisioningStart",
+            self.__pADIGetLoginCode: "ADIGetLoginCode",
+            self.__pADIDispose: "ADIDispose",
+            self.__pADIOTPRequest: "ADIOTPRequest",
+        }
+        self._vm.name_entry_points(self._entry_points)
+
+    @property
+    def interrupted(self) -> bool:
+        return self._vm.interrupted
 
     @property
     def alloc_stats(self) -> tuple[float, float, float]:
         return self._vm.alloc_stats
 
+    @property
+    def allocator_stats(self) -> dict[str, AllocatorStats]:
+        return self._vm.allocator_stats
+
+    @property
+    def call_stats(self) -> dict[str, CallStats]:
+        return {
+            self._entry_points[address]: stats
+            for address, stats in self._vm.call_stats.items()
+            if address in self._entry_points
+        }
+
+    def set_profiler(self, profiler: GuestProfiler | None) -> None:
+        self._vm.set_profiler(profiler)
+
+    def set_stub_recorder(self, recorder: StubRecorder | None) -> None:
+        self._vm.set_stub_recorder(recorder)
+
+    def set_leak_tracking(self, enabled: bool) -> None:
+        self._vm.set_leak_tracking(enabled)
+
+    def leak_report(self) -> LeakReport | None:
+        return self._vm.leak_report()
+
+    def attach_fs(self, fs: VirtualFileSystem) -> None:
+        """Move this ADI over to a file system with the same contents as the one it was created with."""
+        self._vm.attach_fs(fs)
+
+    def _out_params(self) -> int:
+        # allocated once and reused by every call, lazily so ADI templates don't carry it around
+        with self._vm.lock:
+            if self._p_out_params is None:
+                self._p_out_params = self._vm.temp_alloc(_OUT_PARAMS_SIZE)
+            return self._p_out_params
+
     def _set_provisioning_path(self, value: str) -> None:
-        p_path = self._vm.temp_alloc_data(value.encode("utf-8") + b"\x00")
+        p_path = self._vm.scratch_alloc_data(value.encode("utf-8") + b"\x00")
         self._vm.invoke_cdecl(self.__pADISetProvisioningPath, [p_path])
         self._provisioning_path = value
-        self._vm.temp_free(p_path)
 
     def _set_identifier(self, value: str) -> None:
         self._identifier = value
         logger.debug("Setting identifier %s", value)
         identifier = value.encode("utf-8")
-        p_identifier = self._vm.temp_alloc_data(identifier)
+        p_identifier = self._vm.scratch_alloc_data(identifier)
         self._vm.invoke_cdecl(self.__pADISetAndroidID, [p_identifier, len(identifier)])
-        self._vm.temp_free(p_identifier)
 
     def _load_library(self, library_path: str) -> None:
-        p_library_path = self._vm.temp_alloc_data(library_path.encode("utf-8") + b"\x00")
+        p_library_path = self._vm.scratch_alloc_data(library_path.encode("utf-8") + b"\x00")
         self._vm.invoke_cdecl(self.__pADILoadLibraryWithPath, [p_library_path])
-        self._vm.temp_free(p_library_path)
 
     def erase_provisioning(self) -> None:
         raise NotImplementedError
@@ -91,30 +308,28 @@ class ADI:
         raise NotImplementedError
 
     def end_provisioning(self, session: int, persistent_token_metadata: bytes, trust_key: bytes) -> None:
-        p_persistent_token_metadata = self._vm.temp_alloc_data(persistent_token_metadata)
-        p_trust_key = self._vm.temp_alloc_data(trust_key)
-
-        ret = self._vm.invoke_cdecl(
-            self.__pADIProvisioningEnd,
-            [
-                session,
-                p_persistent_token_metadata,
-                len(persistent_token_metadata),
-                p_trust_key,
-                len(trust_key),
-            ],
-        )
-
-        self._vm.temp_free(p_persistent_token_metadata)
-        self._vm.temp_free(p_trust_key)
+        with self._vm.transaction():
+            p_persistent_token_metadata = self._vm.scratch_alloc_data(persistent_token_metadata)
+            p_trust_key = self._vm.scratch_alloc_data(trust_key)
+
+            ret = self._vm.invoke_cdecl(
+                self.__pADIProvisioningEnd,
+                [
+                    session,
+                    p_persistent_token_metadata,
+                    len(persistent_token_metadata),
+                    p_trust_key,
+                    len(trust_key),
+                ],
+            )
+
+            logger.debug("%s: %X=%d", "pADIProvisioningEnd", ret, u_to_s32(ret))
+            assert ret == 0
 
         logger.debug("0x%X", session)
         logger.debug("Persistent token: %s (len: %i)", persistent_token_metadata.hex(), len(persistent_token_metadata))
         logger.debug("Trust key: %s (len: %d)", trust_key.hex(), len(trust_key))
 
-        logger.debug("%s: %X=%d", "pADIProvisioningEnd", ret, u_to_s32(ret))
-        assert ret == 0
-
     def start_provisioning(
         self,
         ds_id: int,
@@ -123,40 +338,35 @@ class ADI:
         logger.debug("ADI.start_provisioning")
         # FIXME: !!!
 
-        p_cpim = self._vm.temp_alloc(8)  # ubyte*
-        p_cpim_length = self._vm.temp_alloc(4)  # uint
-        p_session = self._vm.temp_alloc(4)  # uint
-        p_server_provisioning_intermediate_metadata = self._vm.temp_alloc_data(
-            server_provisioning_intermediate_metadata,
-        )
+        p_out = self._out_params()
+        p_cpim = p_out  # ubyte*
+        p_cpim_length = p_out + 0x08  # uint
+        p_session = p_out + 0x10  # uint
         logger.debug("0x%X", ds_id)
         logger.debug(server_provisioning_intermediate_metadata.hex())
 
-        ret = self._vm.invoke_cdecl(
-            self.__pADIProvisioningStart,
-            [
-                ds_id,
-                p_server_provisioning_intermediate_metadata,
-                len(server_provisioning_intermediate_metadata),
-                p_cpim,
-                p_cpim_length,
-                p_session,
-            ],
-        )
-        logger.debug("%s: %X=%d", "pADIProvisioningStart", ret, u_to_s32(ret))
-        assert ret == 0
-
-        self._vm.temp_free(p_cpim)
-        self._vm.temp_free(p_cpim_length)
-        self._vm.temp_free(p_session)
-        self._vm.temp_free(p_server_provisioning_intermediate_metadata)
-
-        # Readback output
-        cpim = self._vm.read_u64(p_cpim)
-        logger.debug("Wrote data to 0x%X", cpim)
-        cpim_length = self._vm.read_u32(p_cpim_length)
-        cpim_bytes = self._vm.mem_read(cpim, cpim_length)
-        session = self._vm.read_u32(p_session)
+        with self._vm.transaction():
+            p_server_provisioning_intermediate_metadata = self._vm.scratch_alloc_data(
+                server_provisioning_intermediate_metadata,
+            )
+            ret = self._vm.invoke_cdecl(
+                self.__pADIProvisioningStart,
+                [
+                    ds_id,
+                    p_server_provisioning_intermediate_metadata,
+                    len(server_provisioning_intermediate_metadata),
+                    p_cpim,
+                    p_cpim_length,
+                    p_session,
+                ],
+            )
+            logger.debug("%s: %X=%d", "pADIProvisioningStart", ret, u_to_s32(ret))
+            assert ret == 0
+
+            # Readback output
+            cpim, cpim_length, session = self._vm.read_struct(p_out, _CPIM_OUT_PARAMS)
+            logger.debug("Wrote data to 0x%X", cpim)
+            cpim_bytes = self._vm.mem_read(cpim, cpim_length)
 
         # logger.debug(cpim_length, cpim_bytes.hex(), session)
         # assert(False)
@@ -165,7 +375,8 @@ class ADI:
     def is_machine_provisioned(self, ds_id: int) -> bool:
         logger.debug("ADI.is_machine_provisioned")
 
-        error_code = u_to_s32(self._vm.invoke_cdecl(self.__pADIGetLoginCode, [ds_id]))
+        with self._vm.transaction():
+            error_code = u_to_s32(self._vm.invoke_cdecl(self.__pADIGetLoginCode, [ds_id], budgeted=True))
 
         if error_code == 0:
             return True
@@ -180,42 +391,46 @@ class ADI:
 
     def request_otp(self, ds_id: int) -> OneTimePassword:
         logger.debug("ADI.request_otp")
+        return self.request_otp_batch(ds_id, 1)[0]
+
+    def request_otp_batch(self, ds_id: int, count: int) -> list[OneTimePassword]:
+        """Generate several OTPs back to back while holding the VM, reusing the same output buffers."""
+        logger.debug("ADI.request_otp_batch(%d)", count)
         # FIXME: !!!
 
-        p_otp = self._vm.temp_alloc(8)
-        p_otp_length = self._vm.temp_alloc(4)
-        p_mid = self._vm.temp_alloc(8)
-        p_mid_length = self._vm.temp_alloc(4)
+        p_out = self._out_params()
+        p_otp = p_out
+        p_otp_length = p_out + 0x08
+        p_mid = p_out + 0x10
+        p_mid_length = p_out + 0x18
 
         # ubyte* otp;
         # uint otpLength;
         # ubyte* mid;
         # uint midLength;
 
-        ret = self._vm.invoke_cdecl(
-            self.__pADIOTPRequest,
-            [
-                ds_id,
-                p_mid,
-                p_mid_length,
-                p_otp,
-                p_otp_length,
-            ],
-        )
-        logger.debug("%s: %X=%d", "pADIOTPRequest", ret, u_to_s32(ret))
-        assert ret == 0
-
-        self._vm.temp_free(p_otp)
-        self._vm.temp_free(p_otp_length)
-        self._vm.temp_free(p_mid)
-        self._vm.temp_free(p_mid_length)
-
-        otp = self._vm.read_u64(p_otp)
-        otp_length = self._vm.read_u32(p_otp_length)
-        otp_bytes = self._vm.mem_read(otp, otp_length)
-
-        mid = self._vm.read_u64(p_mid)
-        mid_length = self._vm.read_u32(p_mid_length)
-        mid_bytes = self._vm.mem_read(mid, mid_length)
-
-        return OneTimePassword(self, otp_bytes, mid_bytes)
+        otps = []
+        # a failure rolls back the whole batch, so no OTP is handed out from a VM state that was undone
+        with self._vm.transaction():
+            for _ in range(count):
+                ret = self._vm.invoke_cdecl(
+                    self.__pADIOTPRequest,
+                    [
+                        ds_id,
+                        p_mid,
+                        p_mid_length,
+                        p_otp,
+                        p_otp_length,
+                    ],
+                    budgeted=True,
+                )
+                logger.debug("%s: %X=%d", "pADIOTPRequest", ret, u_to_s32(ret))
+                assert ret == 0
+
+                otp, otp_length, mid, mid_length = self._vm.read_struct(p_out, _OTP_OUT_PARAMS)
+                (otp_bytes,), (mid_bytes,) = self._vm.read_many(
+                    [(otp, f"{otp_length}s"), (mid, f"{mid_length}s")],
+                )
+                otps.append(OneTimePassword(self, otp_bytes, mid_bytes))
+
+        return otps
@@ -1,85 +1,209 @@
 from __future__ import annotations
 
 import logging
+from dataclasses import dataclass
 
 logger = logging.getLogger(__name__)
 
 
+@dataclass(frozen=True)
+class AllocatorStats:
+    """Point-in-time usage statistics of one guest memory allocator."""
+
+    size: int
+    """Total size of the memory region managed by the allocator."""
+    bytes_in_use: int
+    """Bytes currently allocated."""
+    high_water_mark: int
+    """Largest number of bytes that was ever allocated at once."""
+    live_allocations: int
+    """Number of blocks currently allocated."""
+    free_blocks: int
+    """Number of separate free blocks."""
+    largest_free_block: int
+    """Size of the largest block that can still be allocated."""
+    alloc_calls: int
+    """Number of successful allocations."""
+    free_calls: int
+    """Number of successful frees."""
+
+    @property
+    def usage(self) -> float:
+        """Fraction of the region that is allocated."""
+        return self.bytes_in_use / self.size
+
+    @property
+    def fragmentation(self) -> float:
+        """
+        Fraction of free memory that is not part of the largest free block.
+
+        Close to 0 if free memory is contiguous, close to 1 if it is scattered over many small blocks.
+        """
+        free = self.size - self.bytes_in_use
+        return 1 - self.largest_free_block / free if free else 0.0
+
+
 class Allocator:
+    """
+    Segregated-fit allocator for a fixed range of guest memory.
+
+    Free blocks are binned into power-of-two size classes, with a bitmask of non-empty classes,
+    so finding a block only needs a few bit operations. Blocks are also indexed by both of their
+    boundaries, which lets a freed block coalesce with its neighbours in constant time.
+    """
+
     _PAGE_SIZE = 0xFF
 
     def __init__(self, base: int, size: int) -> None:
         self._base = base
         self._size = size
 
+        # free blocks: start -> end, end -> start
+        self._free_starts: dict[int, int] = {}
+        self._free_ends: dict[int, int] = {}
+        # free blocks by size class (floor(log2(size))): start -> size
+        self._free_classes: dict[int, dict[int, int]] = {}
+        # bit n is set if size class n has any free blocks
+        self._class_mask = 0
+
         # allocated blocks: addr -> size
-        self._free_blocks: list[tuple[int, int]] = [(self._base, self._base + self._size)]
         self._alloc_size: dict[int, int] = {}
+        self._allocated = 0
+
+        self._high_water_mark = 0
+        self._alloc_calls = 0
+        self._free_calls = 0
+
+        self._add_free_block(self._base, self._base + self._size)
+
+    def copy(self) -> Allocator:
+        allocator = Allocator(self._base, self._size)
+        allocator._free_starts = dict(self._free_starts)
+        allocator._free_ends = dict(self._free_ends)
+        allocator._free_classes = {size_class: dict(blocks) for size_class, blocks in self._free_classes.items()}
+        allocator._class_mask = self._class_mask
+        allocator._alloc_size = dict(self._alloc_size)
+        allocator._allocated = self._allocated
+        allocator._high_water_mark = self._high_water_mark
+        allocator._alloc_calls = self._alloc_calls
+        allocator._free_calls = self._free_calls
+        return allocator
+
+    @property
+    def base(self) -> int:
+        return self._base
+
+    @property
+    def size(self) -> int:
+        return self._size
 
     @property
     def alloc_size(self) -> int:
-        return sum(self._alloc_size.values())
+        return self._allocated
 
     @property
     def alloc_perc(self) -> float:
-        return self.alloc_size / self._size
+        return self._allocated / self._size
 
-    def _find_free_block(self, size: int) -> int | None:
-        return next((i for i, block in enumerate(self._free_blocks) if (block[1] - block[0]) >= size), None)
+    @property
+    def stats(self) -> AllocatorStats:
+        largest_free_block = 0
+        if self._class_mask:
+            # the largest block is always in the highest non-empty size class
+            largest_free_block = max(self._free_classes[self._class_mask.bit_length() - 1].values())
+
+        return AllocatorStats(
+            size=self._size,
+            bytes_in_use=self._allocated,
+            high_water_mark=self._high_water_mark,
+            live_allocations=len(self._alloc_size),
+            free_blocks=len(self._free_starts),
+            largest_free_block=largest_free_block,
+            alloc_calls=self._alloc_calls,
+            free_calls=self._free_calls,
+        )
+
+    @property
+    def top(self) -> int:
+        """End of the highest allocated block, everything above it is free."""
+        return self._free_ends.get(self._base + self._size, self._base + self._size)
+
+    def is_allocated(self, address: int) -> bool:
+        return address in self._alloc_size
+
+    def _add_free_block(self, start: int, end: int) -> None:
+        size_class = (end - start).bit_length() - 1
+        self._free_starts[start] = end
+        self._free_ends[end] = start
+        self._free_classes.setdefault(size_class, {})[start] = end - start
+        self._class_mask |= 1 << size_class
 
-    def _claim_block(self, block_i: int, size: int) -> int:
-        block_start, block_end = self._free_blocks.pop(block_i)
+    def _remove_free_block(self, start: int) -> int:
+        end = self._free_starts.pop(start)
+        del self._free_ends[end]
+
+        size_class = (end - start).bit_length() - 1
+        blocks = self._free_classes[size_class]
+        del blocks[start]
+        if not blocks:
+            del self._free_classes[size_class]
+            self._class_mask &= ~(1 << size_class)
+
+        return end
+
+    def _find_free_block(self, size: int) -> int | None:
+        # every block in a class at or above this one is large enough
+        min_class = (size - 1).bit_length()
+        larger = self._class_mask >> min_class
+        if larger:
+            size_class = min_class + (larger & -larger).bit_length() - 1
+            return next(iter(self._free_classes[size_class]))
+
+        # no free block reaches size rounded up to a power of two, but one in the class below may still fit.
+        # this runs for any request close to the size of the largest free block, and is linear in the number
+        # of free blocks in that class, so up to O(free blocks) when memory is fragmented
+        blocks = self._free_classes.get(min_class - 1, {})
+        return next((start for start, block_size in blocks.items() if block_size >= size), None)
+
+    def _claim_block(self, block_start: int, size: int) -> int:
+        block_end = self._remove_free_block(block_start)
 
         new_start = block_start + size
         assert new_start <= block_end
         if new_start != block_end:
-            self._free_blocks.insert(0, (block_start + size, block_end))
+            self._add_free_block(new_start, block_end)
 
         self._alloc_size[block_start] = size
+        self._allocated += size
+        self._high_water_mark = max(self._high_water_mark, self._allocated)
+        self._alloc_calls += 1
 
         return block_start
 
     def _create_free_block(self, address: int, size: int) -> None:
-        blocks = [
-            (-1, self._base),
-            *self._free_blocks,
-            (self._base + self._size, -1),
-        ]
-        for i, ((_, start), (end, _)) in enumerate(zip(blocks, blocks[1:])):
-            if start <= address <= end:  # addr lies in this allocated (non-free) block
-                new_block = (address, address + size)
-
-                if self._free_blocks[i - 1][1] == new_block[0]:
-                    # can merge with previous free block
-                    self._free_blocks[i - 1] = (self._free_blocks[i - 1][0], new_block[1])
-
-                    if new_block[1] == self._free_blocks[i][0]:
-                        # can *also* merge with next block
-                        self._free_blocks[i - 1] = (self._free_blocks[i - 1][0], self._free_blocks[i][1])
-                        del self._free_blocks[i]
-                elif new_block[1] == self._free_blocks[i][0]:
-                    # can *only* merge with next free block
-                    self._free_blocks[i] = (new_block[0], self._free_blocks[i][1])
-                else:
-                    # cannot merge
-                    self._free_blocks.insert(i, new_block)
-
-                return
-
-        logger.warning("Could not free 0x%x: address not allocated?", address)
+        start, end = address, address + size
+
+        # merge with the free blocks directly before and after
+        if end in self._free_starts:
+            end = self._remove_free_block(end)
+        if start in self._free_ends:
+            start = self._free_ends[start]
+            self._remove_free_block(start)
+
+        self._add_free_block(start, end)
 
     def alloc(self, size: int) -> tuple[int, int]:
         length = (size + self._PAGE_SIZE) & ~self._PAGE_SIZE  # Align to pagesize bytes
-        block_i = self._find_free_block(length)
-        if block_i is None:
+        block_start = self._find_free_block(length)
+        if block_start is None:
             msg = "Cannot alloc more memory: allocator is full!"
             raise RuntimeError(msg)
 
-        address = self._claim_block(block_i, length)
+        address = self._claim_block(block_start, length)
 
         logger.debug("Allocating %d bytes (align: %d) at 0x%x", size, length, address)
         logger.debug("Allocator base: 0x%x, size: 0x%x", self._base, self._size)
-        logger.debug("New alloc size: %x", self.alloc_size)
+        logger.debug("New alloc size: %x", self._allocated)
 
         return address, length
 
@@ -89,6 +213,8 @@ class Allocator:
             logger.warning("Tried to free memory at 0x%X, but never allocated", address)
             return
 
+        self._allocated -= size
+        self._free_calls += 1
         self._create_free_block(address, size)
 
-        logger.debug("Freed %x bytes at %x, new alloc size: %x", size, address, self.alloc_size)
+        logger.debug("Freed %x bytes at %x, new alloc size: %x", size, address, self._allocated)
@@ -1,7 +1,10 @@
 from __future__ import annotations
 
 import logging
-from typing import BinaryIO, Callable
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, BinaryIO, Callable
 
 from typing_extensions import Self
 
@@ -11,33 +14,76 @@ from ._fs import FSCollection, VirtualFileSystem
 from ._library import LibraryStore
 from ._session import ProvisioningSession
 
+if TYPE_CHECKING:
+    from ._allocator import AllocatorStats
+    from ._profiler import GuestProfiler, LeakReport, StubRecorder
+    from ._vm import CallStats, VMOptions
+
 logger = logging.getLogger(__name__)
 
 
+@dataclass(frozen=True)
+class RecyclePolicy:
+    """When to replace a VM whose allocators are filling up."""
+
+    # usage at which a replacement is built in the background while the current VM keeps serving
+    soft_threshold: float = 0.35
+    # usage at which the VM is dropped right away, and the next request has to wait for a new one
+    hard_threshold: float = 0.5
+
+    def __post_init__(self) -> None:
+        # with the soft threshold at or above the hard one, VMs would be dropped before a replacement is ever built
+        if not 0 < self.soft_threshold < self.hard_threshold <= 1:
+            msg = (
+                f"Invalid recycle thresholds: soft {self.soft_threshold}, hard {self.hard_threshold}, "
+                "expected 0 < soft < hard <= 1"
+            )
+            raise ValueError(msg)
+
+
 class AnisetteProvider:
     def __init__(
         self,
         fs_collection: FSCollection,
         fs_fallback: Callable[[], VirtualFileSystem],
         default_device_config: AnisetteDeviceConfig | None,
+        vm_options: VMOptions | None = None,
+        recycle_policy: RecyclePolicy | None = None,
     ) -> None:
         self._fs_collection = fs_collection
         self._fs_fallback = fs_fallback
         self._default_device_config = default_device_config or AnisetteDeviceConfig.default()
+        self._vm_options = vm_options
+        self._recycle_policy = recycle_policy or RecyclePolicy()
 
         self._lib_store: LibraryStore | None = None
         self._device: Device | None = None
         self._adi: ADI | None = None
         self._provisioning_session: ProvisioningSession | None = None
 
+        self._lock = threading.Lock()
+        self._recycle_executor: ThreadPoolExecutor | None = None
+        # replacement ADI being built in the background, on a copy of the ADI file system
+        self._replacement: tuple[Future[ADI], VirtualFileSystem] | None = None
+        # memory usage of the current VM right after it started
+        self._startup_usage = 0.0
+        # usage the current VM has to reach before another replacement is prepared, raised after a failed attempt
+        self._retry_usage = 0.0
+
+        self._profiler: GuestProfiler | None = None
+        self._stub_recorder: StubRecorder | None = None
+        self._leak_tracking = False
+
     @classmethod
     def load(
         cls,
         *files: BinaryIO,
         fs_fallback: Callable[[], VirtualFileSystem],
         default_device_config: AnisetteDeviceConfig | None = None,
+        vm_options: VMOptions | None = None,
+        recycle_policy: RecyclePolicy | None = None,
     ) -> Self:
-        provider = cls(FSCollection.load(*files), fs_fallback, default_device_config)
+        provider = cls(FSCollection.load(*files), fs_fallback, default_device_config, vm_options, recycle_policy)
         assert provider.library_store is not None  # verify that library store exists
         return provider
 
@@ -64,18 +110,150 @@ class AnisetteProvider:
 
     @property
     def adi(self) -> ADI:
-        if self._adi and any(usage >= 0.5 for usage in self._adi.alloc_stats):
+        with self._lock:
+            adi_fs = self._fs_collection.get("adi")
+
+            if self._adi is not None and self._adi.interrupted:
+                logger.warning("VM was stopped in the middle of a call, replacing it")
+                self._adi = None
+                self._replacement = None
+
+            if self._adi is not None:
+                self._recycle(adi_fs)
+
+            if self._adi is None:
+                self._set_adi(ADI(adi_fs, self.library_store, self.device.adi_identifier, self._vm_options))
+
+            assert self._adi is not None
+            return self._adi
+
+    @property
+    def allocator_stats(self) -> dict[str, AllocatorStats]:
+        # don't start a VM just to report on it
+        with self._lock:
+            return self._adi.allocator_stats if self._adi is not None else {}
+
+    @property
+    def call_stats(self) -> dict[str, CallStats]:
+        with self._lock:
+            return self._adi.call_stats if self._adi is not None else {}
+
+    @property
+    def profiler(self) -> GuestProfiler | None:
+        return self._profiler
+
+    @profiler.setter
+    def profiler(self, profiler: GuestProfiler | None) -> None:
+        # also applies to VMs started later on, so recycling doesn't end a profiling session
+        with self._lock:
+            self._profiler = profiler
+            if self._adi is not None:
+                self._adi.set_profiler(profiler)
+
+    @property
+    def stub_recorder(self) -> StubRecorder | None:
+        return self._stub_recorder
+
+    @stub_recorder.setter
+    def stub_recorder(self, recorder: StubRecorder | None) -> None:
+        with self._lock:
+            self._stub_recorder = recorder
+            if self._adi is not None:
+                self._adi.set_stub_recorder(recorder)
+
+    @property
+    def leak_tracking(self) -> bool:
+        return self._leak_tracking
+
+    @leak_tracking.setter
+    def leak_tracking(self, enabled: bool) -> None:
+        with self._lock:
+            self._leak_tracking = enabled
+            if self._adi is not None:
+                self._adi.set_leak_tracking(enabled)
+
+    @property
+    def leak_report(self) -> LeakReport | None:
+        with self._lock:
+            return self._adi.leak_report() if self._adi is not None else None
+
+    def _set_adi(self, adi: ADI) -> None:
+        self._adi = adi
+        adi.set_profiler(self._profiler)
+        adi.set_stub_recorder(self._stub_recorder)
+        # tracked allocations belong to one VM, so a new VM starts with a new tracker
+        adi.set_leak_tracking(self._leak_tracking)
+        if self._provisioning_session is not None:
+            self._provisioning_session.adi = adi
+
+        self._startup_usage = max(adi.alloc_stats)
+        self._retry_usage = 0.0
+
+        # a fresh VM that is already close to recycling means the memory layout is too small for these libraries
+        for region, stats in adi.allocator_stats.items():
+            if stats.high_water_mark >= self._recycle_policy.soft_threshold * stats.size:
+                logger.warning(
+                    "VM %s memory peaked at %d%% right after startup, consider a larger memory profile",
+                    region,
+                    stats.high_water_mark * 100 // stats.size,
+                )
+
+    def _recycle(self, adi_fs: VirtualFileSystem) -> None:
+        assert self._adi is not None
+
+        if self._replacement is not None and self._replacement[0].done():
+            replacement = self._take_replacement(adi_fs)
+            if replacement is not None:
+                logger.debug("Swapping in prewarmed VM")
+                self._set_adi(replacement)
+                return
+            # don't rebuild right away, try again once half the way to the hard threshold is used up
+            hard_threshold = self._recycle_policy.hard_threshold
+            self._retry_usage = (max(self._adi.alloc_stats) + hard_threshold) / 2
+
+        usage = max(self._adi.alloc_stats)
+        if usage >= self._recycle_policy.hard_threshold:
             logger.warning("Detected memory leak, restarting VM. Next data fetch may take slightly longer.")
             self._adi = None
+            self._replacement = None
+        elif (
+            usage >= max(self._recycle_policy.soft_threshold, self._retry_usage)
+            # a replacement would start out just as full, and be replaced again right away
+            and self._startup_usage < self._recycle_policy.soft_threshold
+            and self._replacement is None
+        ):
+            logger.info("VM memory usage at %d%%, preparing a replacement in the background", usage * 100)
+            if self._recycle_executor is None:
+                self._recycle_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="anisette-recycle")
+            fs_copy = adi_fs.copy()
+            future = self._recycle_executor.submit(
+                ADI,
+                fs_copy,
+                self.library_store,
+                self.device.adi_identifier,
+                self._vm_options,
+            )
+            self._replacement = (future, fs_copy)
 
-        if self._adi is None:
-            adi_fs = self._fs_collection.get("adi")
-            self._adi = ADI(adi_fs, self.library_store, self.device.adi_identifier)
+    def _take_replacement(self, adi_fs: VirtualFileSystem) -> ADI | None:
+        assert self._replacement is not None
+        future, fs_copy = self._replacement
+        self._replacement = None
+
+        try:
+            adi = future.result()
+        except Exception:
+            logger.warning("Could not prepare replacement VM", exc_info=True)
+            return None
 
-            if self._provisioning_session is not None:
-                self._provisioning_session.adi = self._adi
+        # the replacement can only take over if initializing it on the copy
+        # left everything exactly like the real file system looks now
+        if fs_copy.has_open_files or fs_copy.root != adi_fs.root:
+            logger.debug("File system changed while preparing replacement VM, discarding it")
+            return None
 
-        return self._adi
+        adi.attach_fs(adi_fs)
+        return adi
 
     @property
     def provisioning_session(self) -> ProvisioningSession:
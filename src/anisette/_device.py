@@ -36,6 +36,7 @@ class Device:
     _SERVER_FRIENDLY_DESCRIPTION_JSON = "clientInfo"
     _ADI_IDENTIFIER_JSON = "identifier"
     _LOCAL_USER_UUID_JSON = "localUUID"
+    _PROVISIONED_DS_IDS_JSON = "provisionedDsIds"
 
     _PATH = "device.json"
 
@@ -65,6 +66,8 @@ class Device:
             self._LOCAL_USER_UUID_JSON,
             default_config.local_user_uuid,
         )
+        # bundles written by older versions don't record this, their DSID is added when it's next used
+        self._provisioned_ds_ids: list[int] = data.get(self._PROVISIONED_DS_IDS_JSON, [])
 
         self.write()
 
@@ -75,6 +78,7 @@ class Device:
             self._SERVER_FRIENDLY_DESCRIPTION_JSON: self._server_friendly_description,
             self._ADI_IDENTIFIER_JSON: self._adi_identifier,
             self._LOCAL_USER_UUID_JSON: self._local_user_uuid,
+            self._PROVISIONED_DS_IDS_JSON: self._provisioned_ds_ids,
         }
         with self._fs.easy_open(self._PATH, "w") as f:
             json.dump(data, f)
@@ -94,3 +98,12 @@ class Device:
     @property
     def local_user_uuid(self) -> str:
         return self._local_user_uuid
+
+    @property
+    def provisioned_ds_ids(self) -> list[int]:
+        return list(self._provisioned_ds_ids)
+
+    def add_provisioned_ds_id(self, ds_id: int) -> None:
+        if ds_id not in self._provisioned_ds_ids:
+            self._provisioned_ds_ids.append(ds_id)
+            self.write()
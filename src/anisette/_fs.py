@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import contextlib
+import copy
 import io
 import json
 import logging
@@ -48,6 +49,16 @@ class VirtualFileSystem:
     def root(self) -> Directory:
         return self._tree
 
+    @property
+    def has_open_files(self) -> bool:
+        return bool(self._file_handles)
+
+    def copy(self) -> VirtualFileSystem:
+        """Create an independent deep copy of this file system, without any open file handles."""
+        fs = VirtualFileSystem()
+        fs._tree = copy.deepcopy(self._tree)
+        return fs
+
     # -------- Internal helpers --------
     def _split(self, path: str) -> list[str]:
         parts = [p for p in Path(path).parts if p not in (".", "")]
@@ -182,7 +193,7 @@ class VirtualFileSystem:
         _path, _mode, buf = self._file_handles[fd]
         return buf.read(length)
 
-    def write(self, fd: int, data: bytes) -> None:
+    def write(self, fd: int, data: bytes | bytearray | memoryview) -> None:
         logger.debug("FS: write %d: %s", fd, data.hex())
         _path, _mode, buf = self._file_handles[fd]
         buf.write(data)
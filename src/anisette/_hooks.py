@@ -4,11 +4,13 @@ import logging
 import math
 import time
 from dataclasses import dataclass
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Callable, cast
 
 from unicorn import UC_MEM_FETCH_UNMAPPED, UC_MEM_WRITE_UNMAPPED
 from unicorn.arm64_const import (
     UC_ARM64_REG_FP,
+    UC_ARM64_REG_LR,
+    UC_ARM64_REG_PC,
     UC_ARM64_REG_W13,
     UC_ARM64_REG_W14,
     UC_ARM64_REG_W15,
@@ -17,22 +19,23 @@ from unicorn.arm64_const import (
     UC_ARM64_REG_X2,
 )
 
-from ._structs import c_stat, c_timeval
+from ._structs import STAT, TIMEVAL, c_timeval
 from ._util import s_to_u64
 
 if TYPE_CHECKING:
     from ._fs import VirtualFileSystem
+    from ._native import NativeVM
     from ._vm import VM
 
 logger = logging.getLogger(__name__)
 
-IMPORT_ADDRESS = 0xA0000000
-IMPORT_SIZE = 0x1000
+# unicorn (qemu) exception number for SVC instructions
+EXCP_SWI = 2
 
 
 @dataclass()
 class HookContext:
-    vm: VM
+    vm: VM | NativeVM
     fs: VirtualFileSystem
 
 
@@ -45,8 +48,14 @@ def _hook_empty_stub(ctx: HookContext, orig_name: str | None = None) -> None:
 def _hook_malloc(ctx: HookContext) -> None:
     x0 = ctx.vm.reg_read(UC_ARM64_REG_X0)
     logger.debug("malloc(0x%X)", x0)
-    x0 = ctx.vm.malloc(x0)
-    ctx.vm.reg_write(UC_ARM64_REG_X0, x0)
+    address = ctx.vm.malloc(x0)
+
+    tracker = ctx.vm.leak_tracker
+    if tracker is not None:
+        # LR points right after the call
+        tracker.allocated(address, x0, ctx.vm.reg_read(UC_ARM64_REG_LR) - 4, ctx.vm.entry_address)
+
+    ctx.vm.reg_write(UC_ARM64_REG_X0, address)
 
 
 def _hook_free(ctx: HookContext) -> None:
@@ -54,6 +63,9 @@ def _hook_free(ctx: HookContext) -> None:
     logger.debug("free(0x%X)", x0)
 
     ctx.vm.free(x0)
+    tracker = ctx.vm.leak_tracker
+    if tracker is not None:
+        tracker.freed(x0)
 
     ctx.vm.reg_write(UC_ARM64_REG_X0, 0)
 
@@ -67,10 +79,8 @@ def _hook_strncpy(ctx: HookContext) -> None:
     p_src = x1
     _len = x2
 
-    src = ctx.vm.read_cstr(p_src)
-    if len(src) > _len:
-        msg = f"Read data too long: {len(src)} > {_len}"
-        raise RuntimeError(msg)
+    # the terminator may be left out if the string fills the whole buffer
+    src = ctx.vm.read_cstr(p_src, max_length=_len + 1)
 
     padding_size = _len - len(src)
     data = src + b"\x00" * padding_size
@@ -80,6 +90,38 @@ def _hook_strncpy(ctx: HookContext) -> None:
     ctx.vm.reg_write(UC_ARM64_REG_X0, p_dst)
 
 
+def _hook_memcpy(ctx: HookContext) -> None:
+    x0 = ctx.vm.reg_read(UC_ARM64_REG_X0)
+    x1 = ctx.vm.reg_read(UC_ARM64_REG_X1)
+    x2 = ctx.vm.reg_read(UC_ARM64_REG_X2)
+
+    logger.debug("memcpy(0x%X, 0x%X, %d)", x0, x1, x2)
+
+    if x2 > 0:
+        ctx.vm.mem_write(x0, ctx.vm.mem_read(x1, x2))
+
+    ctx.vm.reg_write(UC_ARM64_REG_X0, x0)
+
+
+def _hook_memset(ctx: HookContext) -> None:
+    x0 = ctx.vm.reg_read(UC_ARM64_REG_X0)
+    x1 = ctx.vm.reg_read(UC_ARM64_REG_X1)
+    x2 = ctx.vm.reg_read(UC_ARM64_REG_X2)
+
+    logger.debug("memset(0x%X, 0x%X, %d)", x0, x1, x2)
+
+    if x2 > 0:
+        ctx.vm.mem_write(x0, bytes([x1 & 0xFF]) * x2)
+
+    ctx.vm.reg_write(UC_ARM64_REG_X0, x0)
+
+
+def _hook_strlen(ctx: HookContext) -> None:
+    x0 = ctx.vm.reg_read(UC_ARM64_REG_X0)
+
+    ctx.vm.reg_write(UC_ARM64_REG_X0, len(ctx.vm.read_cstr(x0)))
+
+
 def _hook_mkdir(ctx: HookContext) -> None:
     x0 = ctx.vm.reg_read(UC_ARM64_REG_X0)
     x1 = ctx.vm.reg_read(UC_ARM64_REG_X1)
@@ -130,71 +172,31 @@ def _handle_stat(ctx: HookContext, path_or_fd: str | int, buf: int) -> None:
         ctx.vm.set_errno(2)  # ENOENT
         return
 
-    stat = c_stat(
-        st_dev=0,
-        st_ino=0,
-        st_mode=stat_result.st_mode,
-        # ...
-        st_size=stat_result.st_size,
-        st_blksize=512,
-        st_blocks=(stat_result.st_size + 511) // 512,
-        # ...s
-    )
-    stat.__byte = stat_result.st_size  # noqa: SLF001
-    stat_bytes = bytes(stat)
-    # print(statBytes.hex(), len(statBytes))
-
-    # logger.debug("%s %s %s", stat_result.st_size, stat_result.st_blksize, stat_result.st_blocks)
-    logger.debug("%s %s %s", stat.st_size, stat.st_blksize, stat.st_blocks)
-
     logger.debug("0x%X = %d", stat_result.st_mode, stat_result.st_mode)
-    stat_bytes = b"".join(
-        [
-            bytes.fromhex(
-                "00000000"
-                "00000000"  # st_dev
-                "00000000"
-                "00000000",
-            )  # st_ino
-            + int.to_bytes(stat_result.st_mode, 4, "little")  # st_mode
-            + bytes.fromhex(
-                "00000000"  # st_nlink
-                "a4810000"  # st_uid
-                "00000000"  # st_gid
-                "00000000"
-                "00000000"  # st_rdev
-                "00000000"
-                "00000000",
-            ),  # __pad1
-            int.to_bytes(stat_result.st_size, 8, "little"),  # st_size
-            bytes.fromhex(
-                "00000000"  # st_blksize
-                "00000000"  # __pad2
-                "00000000"
-                "00000000"  # st_blocks
-                "00000000"
-                "00000000"  # st_atime
-                "00000000"
-                "00000000" +  # st_atime_nsec
-                # "00" * 4 +
-                "00" * 2
-                + "01" * 2
-                + "00000000"  # st_mtime [This must have a valid value]
-                "00000000"
-                "00000000"  # st_mtime_nsec
-                "00000000"
-                "00000000"  # st_ctime
-                "00000000"
-                "00000000"  # st_ctime_nsec
-                "00000000"  # __unused4
-                "00000000",  # __unused5
-            ),
-        ],
+    ctx.vm.write_struct(
+        buf,
+        STAT,
+        0,  # st_dev
+        0,  # st_ino
+        stat_result.st_mode,
+        0,  # st_nlink
+        0x81A4,  # st_uid
+        0,  # st_gid
+        0,  # st_rdev
+        0,  # __pad1
+        stat_result.st_size,
+        0,  # st_blksize
+        0,  # __pad2
+        0,  # st_blocks
+        0,  # st_atime
+        0,  # st_atime_nsec
+        0x01010000,  # st_mtime [This must have a valid value]
+        0,  # st_mtime_nsec
+        0,  # st_ctime
+        0,  # st_ctime_nsec
+        0,  # __unused4
+        0,  # __unused5
     )
-    logger.debug(len(stat_bytes))
-    assert len(stat_bytes) in [104, 128]
-
-    ctx.vm.mem_write(buf, stat_bytes)
 
     # Return success
     ctx.vm.reg_write(UC_ARM64_REG_X0, 0)
@@ -283,7 +285,7 @@ def _hook_write(ctx: HookContext) -> None:
 
     logger.debug("write(%d, 0x%X, %d)", fildes, buf, nbyte)
 
-    buf_bytes = ctx.vm.mem_read(buf, nbyte)
+    buf_bytes = ctx.vm.mem_view(buf, nbyte)
     ctx.fs.write(fildes, buf_bytes)
 
     ctx.vm.reg_write(UC_ARM64_REG_X0, nbyte)
@@ -375,7 +377,7 @@ def _hook_gettimeofday(ctx: HookContext) -> None:
 
     # Write the time
     logger.debug("%s %s %s", t.__dict__, t_bytes.hex(), len(t_bytes))
-    ctx.vm.mem_write(tp, t_bytes)
+    ctx.vm.write_struct(tp, TIMEVAL, t.tv_sec, t.tv_usec)
 
     # Return success
     ctx.vm.reg_write(UC_ARM64_REG_X0, 0)
@@ -410,6 +412,9 @@ STUBBED_FUNCTIONS = {
     "malloc": _hook_malloc,
     "free": _hook_free,
     # string
+    "memcpy": _hook_memcpy,
+    "memset": _hook_memset,
+    "strlen": _hook_strlen,
     "strncpy": _hook_strncpy,
     # fs
     "mkdir": _hook_mkdir,
@@ -487,35 +492,39 @@ def hook_code(ctx: HookContext, address: int, size: int) -> None:
     logger.debug(logs)
 
 
-def hook_block(ctx: HookContext, _address: int, _size: int) -> None:
-    pass
-    # print("         >>> Tracing basic block at 0x%x, block size = 0x%x" %(address, size))
+def hook_block(_ctx: HookContext, address: int, size: int) -> None:
+    logger.debug(">>> Tracing basic block at 0x%X, block size = 0x%X", address, size)
 
 
-def hook_stub(ctx: HookContext, address: int, _size: int) -> bool:
-    assert address >= IMPORT_ADDRESS
-    assert address < IMPORT_ADDRESS + 0x01000000 * 10
+def _hook_unsupported(name: str) -> Callable[[HookContext], None]:
+    def _hook(_ctx: HookContext) -> None:
+        msg = f"Symbol not in stubbed functions: {name}"
+        raise RuntimeError(msg)
 
-    offset = address - IMPORT_ADDRESS
-    library_index = offset // 0x01000000
-    symbol_index = (offset % 0x01000000) // 4
+    return _hook
 
-    # assert(libraryIndex == 0)
-    library = ctx.vm.get_library(library_index)
 
-    symbol_name = library.symbol_name_by_index(symbol_index)
+def get_stub_handler(name: str) -> Callable[[HookContext], None]:
+    handler = STUBBED_FUNCTIONS.get(name)
+    if handler is None:
+        # Libraries import plenty of functions they never call, so only fail once one is actually used
+        logger.debug("Import is not stubbed: %s", name)
+        return _hook_unsupported(name)
+    return handler
 
-    # lr = uc.reg_read(UC_ARM64_REG_LR)
 
-    # print("stub", "0x%X" % lr, uc, address, size, user_data, end=" :: ")
-    # print(libraryIndex, library.name, symbolIndex, symbolName)
+def hook_stub(ctx: HookContext, address: int, _size: int) -> bool:
+    # unicorn hooks only run in emulated VMs
+    cast("VM", ctx.vm).call_stub(address)
+    return True
 
-    if symbol_name in STUBBED_FUNCTIONS:
-        STUBBED_FUNCTIONS[symbol_name](ctx)
-        # assert(False)
-    else:
-        msg = f"Symbol not in stubbed functions: {symbol_name}"
+
+def hook_intr(ctx: HookContext, intno: int) -> None:
+    if intno != EXCP_SWI:
+        msg = f"Unhandled interrupt: {intno}"
         raise RuntimeError(msg)
 
-    # time.sleep(0.1)
-    return True
+    # PC already points past the SVC instruction of the stub
+    # unicorn hooks only run in emulated VMs
+    vm = cast("VM", ctx.vm)
+    vm.call_stub(vm.reg_read(UC_ARM64_REG_PC) - 4)
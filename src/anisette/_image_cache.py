@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import json
+import logging
+import mmap
+import struct
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b"ANIIMG\x00\x02"
+_HEADER = struct.Struct("<8sQ")  # magic, metadata length
+_PAGE_SIZE = 0x1000
+
+
+def _page_align(value: int) -> int:
+    return (value + _PAGE_SIZE - 1) & ~(_PAGE_SIZE - 1)
+
+
+def _layout_segments(segments: list[tuple[int, int, bytes]]) -> tuple[list[tuple[int, int, int, int]], int]:
+    # segment data starts on page boundaries so it can be mapped straight into the guest
+    entries = []
+    data_size = 0
+    for address, perms, data in segments:
+        entries.append((address, len(data), data_size, perms))
+        data_size = _page_align(data_size + len(data))
+    return entries, data_size
+
+
+@dataclass(frozen=True)
+class LibraryImage:
+    """
+    A mapped and relocated library, ready to be placed into guest memory.
+
+    Segment data lives in a page-aligned host memory map (a private copy-on-write map of the
+    cache file, or an anonymous one), so it can be handed to unicorn without being copied first.
+    """
+
+    buffer: mmap.mmap
+    segments: tuple[tuple[int, int, int, int], ...]  # guest address, size, offset into buffer, permissions
+    symbols: dict[int, int]
+
+    @classmethod
+    def from_segments(cls, segments: list[tuple[int, int, bytes]], symbols: dict[int, int]) -> LibraryImage:
+        """Create an in-memory image from (guest address, permissions, data) segments."""
+        entries, data_size = _layout_segments(segments)
+        buffer = mmap.mmap(-1, max(data_size, _PAGE_SIZE))
+        for (_, _, data), (_, size, offset, _) in zip(segments, entries):
+            buffer[offset : offset + size] = data
+        return cls(buffer=buffer, segments=tuple(entries), symbols=dict(symbols))
+
+
+class LibraryImageCache:
+    """
+    Content-addressed on-disk cache of relocated library images.
+
+    Images are keyed by the digest of the library file and every layout parameter that ends up baked into the image
+    (load base, import stub addresses, ...), so a cached image can only be used when the library would be loaded
+    in exactly the same way.
+    """
+
+    def __init__(self, directory: str | Path) -> None:
+        self._directory = Path(directory)
+
+    @staticmethod
+    def _key(digest: str, layout: tuple[int, ...]) -> str:
+        return "-".join([digest, *(f"{value:x}" for value in layout)])
+
+    def _path(self, key: str) -> Path:
+        return self._directory / f"{key}.img"
+
+    def load(self, digest: str, layout: tuple[int, ...]) -> LibraryImage | None:
+        path = self._path(self._key(digest, layout))
+        try:
+            with path.open("rb") as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        meta = None
+        meta_length = 0
+        try:
+            magic, meta_length = _HEADER.unpack_from(buffer)
+            if magic == _MAGIC:
+                meta = json.loads(buffer[_HEADER.size : _HEADER.size + meta_length])
+        except (struct.error, ValueError):
+            pass
+        if meta is None:
+            logger.warning("Ignoring corrupt or outdated library image: %s", path)
+            buffer.close()
+            return None
+
+        data_start = _page_align(_HEADER.size + meta_length)
+        segments = tuple(
+            (address, size, data_start + offset, perms) for address, size, offset, perms in meta["segments"]
+        )
+        if any(offset + size > len(buffer) for _, size, offset, _ in segments):
+            logger.warning("Ignoring truncated library image: %s", path)
+            buffer.close()
+            return None
+
+        logger.debug("Loaded library image from cache: %s", path)
+        return LibraryImage(
+            buffer=buffer,
+            segments=segments,
+            symbols={int(index): address for index, address in meta["symbols"].items()},
+        )
+
+    def store(
+        self,
+        digest: str,
+        layout: tuple[int, ...],
+        segments: list[tuple[int, int, bytes]],
+        symbols: dict[int, int],
+    ) -> None:
+        entries, data_size = _layout_segments(segments)
+        meta = json.dumps({"segments": entries, "symbols": symbols}).encode()
+        data_start = _page_align(_HEADER.size + len(meta))
+
+        path = self._path(self._key(digest, layout))
+        tmp_path = None
+        try:
+            self._directory.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile("wb", dir=self._directory, suffix=".tmp", delete=False) as f:
+                tmp_path = f.name
+                f.write(_HEADER.pack(_MAGIC, len(meta)))
+                f.write(meta)
+                for (_, _, data), (_, _, offset, _) in zip(segments, entries):
+                    f.seek(data_start + offset)
+                    f.write(data)
+                f.truncate(data_start + data_size)
+            # atomically publish, readers either see the old file or the complete new one
+            Path(tmp_path).replace(path)
+        except OSError:
+            logger.warning("Could not write library image to cache: %s", path, exc_info=True)
+            if tmp_path is not None:
+                Path(tmp_path).unlink(missing_ok=True)
+            return
+
+        logger.debug("Stored library image in cache: %s", path)
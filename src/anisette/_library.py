@@ -1,12 +1,13 @@
 from __future__ import annotations
 
+import hashlib
 import io
 import logging
+import struct
 import tarfile
 import zipfile
 from typing import IO, TYPE_CHECKING, BinaryIO
 
-from elftools.elf.sections import SymbolTableSection
 from typing_extensions import Self
 
 from ._arch import Architecture
@@ -23,6 +24,17 @@ R_AARCH64_GLOB_DAT = 1025
 R_AARCH64_JUMP_SLOT = 1026
 R_AARCH64_RELATIVE = 1027
 
+# x86_64 libraries can only be run by the native backend, on x86_64 hosts
+R_X86_64_64 = 1
+R_X86_64_GLOB_DAT = 6
+R_X86_64_JUMP_SLOT = 7
+R_X86_64_RELATIVE = 8
+
+SHN_UNDEF = 0
+
+_ELF64_SYM = struct.Struct("<IBBHQQ")  # st_name, st_info, st_other, st_shndx, st_value, st_size
+_ELF64_RELA = struct.Struct("<QQq")  # r_offset, r_info, r_addend
+
 
 class Library:
     def __init__(self, name: str, elf: ELFFile, base: int, index: int) -> None:
@@ -32,47 +44,84 @@ class Library:
         self.symbols = {}
         self.index = index
 
+        # parsed lazily from .dynsym/.dynstr, once per library
+        self._raw_symbols: list[tuple[int, int, int]] | None = None
+        self._symbol_names: list[str] | None = None
+        self._symbol_indices: dict[str, int] | None = None
+
     def resolve_symbol_by_index(self, symbol_index: int) -> int:
-        # for section in elf.iter_sections():
-        #   print(section)
         if symbol_index in self.symbols:
-            # print("Resolving symbol 0x%X from symbols dict" % symbolIndex)
             return self.symbols[symbol_index]
 
-        section = self.elf.get_section_by_name(".dynsym")
-        assert isinstance(section, SymbolTableSection)
-
-        sym = section.get_symbol(symbol_index)
-        # print("Resolving symbol 0x%X relative to base" % symbolIndex, sym.__dict__)
-
-        # if sym['st_shndx'] == 11:
-        #    section = library.elf.get_section(sym['st_shndx'])
-        #    print("Fixing section", section.__dict__)
-        #    print("0x%X" % (section['sh_addr'] + sym['st_value']))
-        #    assert(False)
-
-        return self.base + sym["st_value"]
+        _, _, st_value = self.raw_symbols()[symbol_index]
+        return self.base + st_value
 
     def resolve_symbol_by_name(self, symbol_name: str) -> int:
-        section = self.elf.get_section_by_name(".dynsym")
-        assert isinstance(section, SymbolTableSection)
-
-        num_symbols = section.num_symbols()
-        for i in range(num_symbols):
-            sym = section.get_symbol(i)
-            if sym.name == symbol_name:
-                # print(sym.__dict__)
-                return self.resolve_symbol_by_index(i)
-
-        msg = f"Symbol '{symbol_name}' not found"
-        raise ValueError(msg)
+        if self._symbol_indices is None:
+            indices: dict[str, int] = {}
+            for i, name in enumerate(self._names()):
+                # first match wins, like a scan of the symbol table would
+                indices.setdefault(name, i)
+            self._symbol_indices = indices
+
+        symbol_index = self._symbol_indices.get(symbol_name)
+        if symbol_index is None:
+            msg = f"Symbol '{symbol_name}' not found"
+            raise ValueError(msg)
+        return self.resolve_symbol_by_index(symbol_index)
+
+    def _section_data(self, section_name: str) -> bytes:
+        section = self.elf.get_section_by_name(section_name)
+        if section is None:
+            return b""
+        return section.data()
+
+    def raw_symbols(self) -> list[tuple[int, int, int]]:
+        """Parse the dynamic symbol table in one go, returning (name offset, section index, value) per symbol."""
+        if self._raw_symbols is None:
+            assert self.elf.elfclass == 64
+            assert self.elf.little_endian
+
+            self._raw_symbols = [
+                (st_name, st_shndx, st_value)
+                for st_name, _, _, st_shndx, st_value, _ in _ELF64_SYM.iter_unpack(self._section_data(".dynsym"))
+            ]
+        return self._raw_symbols
+
+    def _names(self) -> list[str]:
+        if self._symbol_names is None:
+            strtab = self._section_data(".dynstr")
+            self._symbol_names = [
+                strtab[st_name : strtab.index(b"\x00", st_name)].decode("utf-8", errors="replace")
+                for st_name, _, _ in self.raw_symbols()
+            ]
+        return self._symbol_names
+
+    def raw_relocations(self, section_name: str) -> list[tuple[int, int, int, int]]:
+        """Parse a RELA section in one go, returning (offset, type, symbol index, addend) per entry."""
+        assert self.elf.elfclass == 64
+        assert self.elf.little_endian
+
+        return [
+            (r_offset, r_info & 0xFFFFFFFF, r_info >> 32, r_addend)
+            for r_offset, r_info, r_addend in _ELF64_RELA.iter_unpack(self._section_data(section_name))
+        ]
+
+    def import_names(self) -> dict[int, str]:
+        """Get the names of all undefined (imported) dynamic symbols, by symbol index."""
+        names = self._names()
+        return {i: names[i] for i, (_, st_shndx, _) in enumerate(self.raw_symbols()) if st_shndx == SHN_UNDEF}
+
+    def defined_symbols(self) -> list[tuple[int, str]]:
+        """Get the address and name of every symbol this library defines."""
+        return [
+            (self.base + st_value, name)
+            for (st_name, st_shndx, st_value), name in zip(self.raw_symbols(), self._names())
+            if st_shndx != SHN_UNDEF and st_value != 0 and st_name != 0
+        ]
 
     def symbol_name_by_index(self, symbol_index: int) -> str:
-        section = self.elf.get_section_by_name(".dynsym")
-        assert isinstance(section, SymbolTableSection)
-
-        sym = section.get_symbol(symbol_index)
-        return sym.name
+        return self._names()[symbol_index]
 
 
 class LibraryStore(VirtualFileSystem):
@@ -85,13 +134,29 @@ class LibraryStore(VirtualFileSystem):
     def __init__(self, fs: VirtualFileSystem | None) -> None:
         super().__init__(fs)
 
+        # library name -> digest of its contents
+        self._digests: dict[str, str] = {}
+
     def open_library(self, name: str) -> IO:
         return self.easy_open(name, "rb")
 
     def add_library(self, name: str, data: IO[bytes]) -> None:
+        self._digests.pop(name, None)
         with self.easy_open(name, "wb+") as f:
             f.write(data.read())
 
+    def library_digest(self, name: str) -> str:
+        """SHA-256 of a library file, which identifies it across stores holding the same libraries."""
+        digest = self._digests.get(name)
+        if digest is None:
+            digest = self._digests[name] = hashlib.sha256(self.read_bytes(name)).hexdigest()
+        return digest
+
+    @property
+    def content_digest(self) -> str:
+        """Digest covering all libraries in this store."""
+        return hashlib.sha256("".join(self.library_digest(lib) for lib in self._LIBRARIES).encode()).hexdigest()
+
     @staticmethod
     def _candidates_for(lib: str, arch: Architecture) -> tuple[str, str, str]:
         return (
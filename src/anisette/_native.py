@@ -0,0 +1,527 @@
+from __future__ import annotations
+
+import contextlib
+import ctypes
+import functools
+import io
+import logging
+import mmap
+import os
+import platform
+import struct
+import threading
+import time
+import weakref
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Callable
+
+from elftools.elf.elffile import ELFFile
+from unicorn.arm64_const import UC_ARM64_REG_X0
+
+from ._allocator import Allocator, AllocatorStats
+from ._hooks import HookContext, get_stub_handler
+from ._library import Library
+from ._vm import LIB_SPACE, SCRATCH_ALIGNMENT, VM, Backend, CallBudget, CallStats, TraceLevel, VMOptions
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator, Sequence
+
+    from ._arch import Architecture
+    from ._fs import VirtualFileSystem
+    from ._library import LibraryStore
+    from ._profiler import GuestProfiler, LeakReport, LeakTracker, StubRecorder
+
+logger = logging.getLogger(__name__)
+
+# Linux values, the same on every architecture this backend runs on
+_PROT_NONE = 0x0
+_PROT_READ = 0x1
+_PROT_WRITE = 0x2
+_PROT_EXEC = 0x4
+_MAP_PRIVATE = 0x02
+_MAP_ANONYMOUS = 0x20
+_MAP_NORESERVE = 0x4000
+_MAP_FAILED = ctypes.c_void_p(-1).value
+
+# import stubs take their arguments from the first argument registers, none of them needs more than these
+_STUB_ARGUMENTS = 6
+_STUB_TYPE = ctypes.CFUNCTYPE(ctypes.c_uint64, *[ctypes.c_uint64] * _STUB_ARGUMENTS)
+
+_HOST_ARCHITECTURES = {
+    "aarch64": "arm64-v8a",
+    "arm64": "arm64-v8a",
+    "x86_64": "x86_64",
+    "amd64": "x86_64",
+}
+
+
+def native_supported(arch: Architecture) -> bool:
+    """Whether libraries of an architecture can run directly on this host."""
+    return platform.system() == "Linux" and _HOST_ARCHITECTURES.get(platform.machine().lower()) == arch.value
+
+
+def _emulation_reason(options: VMOptions, arch: Architecture) -> str | None:
+    if not native_supported(arch):
+        return f"{arch.value} libraries cannot run on this {platform.system()} {platform.machine()} host"
+    if options.trace_level != TraceLevel.OFF:
+        return "tracing needs the emulator"
+    if options.call_budget != CallBudget():
+        return "native calls cannot be stopped, call budgets need the emulator"
+    return None
+
+
+@functools.cache
+def _log_fallback(reason: str) -> None:
+    logger.warning("Not running the libraries natively, %s", reason)
+
+
+def runs_natively(options: VMOptions | None, arch: Architecture) -> bool:
+    """Whether VMs with these options use the native backend, see :class:`Backend`."""
+    if options is None or options.backend != Backend.NATIVE:
+        return False
+    reason = _emulation_reason(options, arch)
+    if reason is not None:
+        _log_fallback(reason)
+        return False
+    return True
+
+
+@functools.cache
+def _libc() -> ctypes.CDLL:
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.mmap.restype = ctypes.c_void_p
+    libc.mmap.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long)
+    libc.mprotect.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int)
+    libc.munmap.argtypes = (ctypes.c_void_p, ctypes.c_size_t)
+    libc.strnlen.restype = ctypes.c_size_t
+    libc.strnlen.argtypes = (ctypes.c_void_p, ctypes.c_size_t)
+    return libc
+
+
+def _check(result: int, call: str) -> None:
+    if result != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"{call} failed: {os.strerror(errno)}")
+
+
+def _map(size: int, prot: int) -> int:
+    # reserved lazily by the kernel, so untouched heap space costs no memory
+    address = _libc().mmap(None, size, prot, _MAP_PRIVATE | _MAP_ANONYMOUS | _MAP_NORESERVE, -1, 0)
+    if address in (None, _MAP_FAILED):
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"mmap failed: {os.strerror(errno)}")
+    return address
+
+
+def _protect(address: int, size: int, prot: int) -> None:
+    _check(_libc().mprotect(address, size, prot), "mprotect")
+
+
+def _unmap(mappings: dict[int, int]) -> None:
+    for address, size in mappings.items():
+        _libc().munmap(address, size)
+
+
+@functools.lru_cache(maxsize=16)
+def _function_type(argument_count: int) -> Any:  # noqa: ANN401
+    return ctypes.CFUNCTYPE(ctypes.c_uint64, *[ctypes.c_uint64] * argument_count)
+
+
+def _page_protections(segments: list[tuple[int, int, bytearray]]) -> list[tuple[int, int, int]]:
+    # segments are aligned for the ELF file's page size, which can be smaller than the host's,
+    # so a host page that holds several segments gets the permissions of all of them.
+    # Segment permissions are unicorn's UC_PROT_* flags, which have the same values as PROT_*.
+    page_size = mmap.PAGESIZE
+    pages: dict[int, int] = {}
+    for address, perms, image in segments:
+        for page in range(address & ~(page_size - 1), address + len(image), page_size):
+            pages[page] = pages.get(page, _PROT_NONE) | perms
+
+    # start, size, protection of runs of pages with the same permissions
+    runs: list[tuple[int, int, int]] = []
+    for page in sorted(pages):
+        if runs and runs[-1][0] + runs[-1][1] == page and runs[-1][2] == pages[page]:
+            start, size, prot = runs[-1]
+            runs[-1] = (start, size + page_size, prot)
+        else:
+            runs.append((page, page_size, pages[page]))
+    return runs
+
+
+@dataclass(frozen=True)
+class NativeCheckpoint:
+    """Memory a native call can change, see :meth:`NativeVM.checkpoint`."""
+
+    memory: tuple[tuple[int, bytes], ...]
+    allocators: tuple[Allocator, Allocator]
+    errno_address: int | None
+
+
+class NativeVM:
+    """
+    Runs the libraries directly on the host CPU, with the interface of :class:`VM` that ADI and the stubs use.
+
+    Libraries are relocated like in the emulator, into host memory this VM reserves for itself, so guest addresses
+    are host addresses and VMs don't get in each other's way. Imports are bound to ctypes callbacks that run the
+    stubs of ``_hooks.py``, and the functions that run as guest routines in the emulator are bound to the host's
+    libc. Stubs see the arguments of the call through the argument registers, whatever the host architecture is.
+    """
+
+    def __init__(
+        self,
+        fs: VirtualFileSystem,
+        lib_store: LibraryStore,
+        arch: Architecture,
+        options: VMOptions | None = None,
+    ) -> None:
+        self._fs = fs
+        self._arch = arch
+        self._options = options or VMOptions()
+        self._layout = self._options.layout
+
+        self._lib_store = lib_store
+        self._loaded_libs: dict[str, Library] = {}
+        self._libraries: list[Library] = []
+
+        # host mappings owned by this VM, address -> size, released once the VM is collected
+        self._mappings: dict[int, int] = {}
+        weakref.finalize(self, _unmap, self._mappings)
+
+        # library space is only reserved, segments are made accessible as libraries are loaded
+        self._lib_allocator = Allocator(self._map(LIB_SPACE, _PROT_NONE), LIB_SPACE)
+        self._malloc_allocator = Allocator(self._map(self._layout.malloc_size), self._layout.malloc_size)
+        self._temp_allocator = Allocator(self._map(self._layout.temp_size), self._layout.temp_size)
+        self._scratch_address = self._map(self._layout.scratch_size)
+        self._scratch_top = self._scratch_address
+
+        # writable library segments, which checkpoints save along with the heaps: address, size
+        self._writable_segments: list[tuple[int, int]] = []
+
+        # import name -> callback, kept alive for as long as library code may call it
+        self._callbacks: dict[str, Any] = {}
+        # argument registers of the stub call in progress, X0 holds the return value when it is done
+        self._registers: list[int] = []
+        # first exception raised by a stub during the current call, re-raised once the call returns
+        self._error: BaseException | None = None
+
+        self._errno_address: int | None = None
+
+        self._hook_ctx = HookContext(vm=self, fs=self._fs)
+
+        # a VM runs one call at a time, different VMs can run in parallel
+        self._lock = threading.RLock()
+
+        self._entry_names: dict[int, str] = {}
+        self._entry_address = 0
+        self._stub_recorder: StubRecorder | None = None
+
+        # set when a stub failed during a call, until a rollback undoes it
+        self._interrupted = False
+
+        # entry point -> calls
+        self._call_stats: dict[int, int] = {}
+
+    def _map(self, size: int, prot: int = _PROT_READ | _PROT_WRITE) -> int:
+        address = _map(size, prot)
+        self._mappings[address] = size
+        return address
+
+    @property
+    def lock(self) -> threading.RLock:
+        """Held by whoever is using the VM. Calls that span several steps must hold it throughout."""
+        return self._lock
+
+    @property
+    def interrupted(self) -> bool:
+        """Whether library code went on after a stub failed, which leaves its state inconsistent."""
+        return self._interrupted
+
+    @property
+    def alloc_stats(self) -> tuple[float, float, float]:
+        with self._lock:
+            return (
+                self._temp_allocator.alloc_perc,
+                self._malloc_allocator.alloc_perc,
+                self._lib_allocator.alloc_perc,
+            )
+
+    @property
+    def allocator_stats(self) -> dict[str, AllocatorStats]:
+        with self._lock:
+            return {
+                "temp": self._temp_allocator.stats,
+                "malloc": self._malloc_allocator.stats,
+                "lib": self._lib_allocator.stats,
+            }
+
+    @property
+    def call_stats(self) -> dict[int, CallStats]:
+        # instructions are not counted natively
+        with self._lock:
+            return {address: CallStats(calls=calls, instructions=0) for address, calls in self._call_stats.items()}
+
+    @property
+    def errno_address(self) -> int | None:
+        return self._errno_address
+
+    def attach_fs(self, fs: VirtualFileSystem) -> None:
+        self._fs = fs
+        self._hook_ctx.fs = fs
+
+    def malloc(self, length: int) -> int:
+        return self._malloc_allocator.alloc(length)[0]
+
+    def free(self, address: int) -> None:
+        return self._malloc_allocator.free(address)
+
+    def mem_write(self, address: int, data: bytes) -> None:
+        ctypes.memmove(address, bytes(data), len(data))
+
+    def mem_read(self, address: int, length: int) -> bytes:
+        return ctypes.string_at(address, length)
+
+    def mem_view(self, address: int, length: int) -> memoryview:
+        """Like :meth:`mem_read`, but without copying the data."""
+        return memoryview((ctypes.c_char * length).from_address(address)).cast("B")
+
+    def read_struct(self, address: int, fmt: str | struct.Struct) -> tuple[Any, ...]:
+        fmt = fmt if isinstance(fmt, struct.Struct) else struct.Struct(fmt)
+        return fmt.unpack(ctypes.string_at(address, fmt.size))
+
+    def read_many(self, requests: Sequence[tuple[int, str | struct.Struct]]) -> list[tuple[Any, ...]]:
+        """Read a struct at each of the given addresses, in the order of the requests."""
+        return [self.read_struct(address, fmt) for address, fmt in requests]
+
+    def write_struct(self, address: int, fmt: str | struct.Struct, *values: Any) -> None:  # noqa: ANN401
+        data = struct.pack(fmt, *values) if isinstance(fmt, str) else fmt.pack(*values)
+        ctypes.memmove(address, data, len(data))
+
+    def reg_write(self, reg_id: int, value: int) -> None:
+        self._registers[self._argument_index(reg_id)] = value
+
+    def reg_read(self, reg_id: int) -> int:
+        return self._registers[self._argument_index(reg_id)]
+
+    @staticmethod
+    def _argument_index(reg_id: int) -> int:
+        # stubs name arguments by their arm64 registers, natively they are just the arguments of the call
+        index = reg_id - UC_ARM64_REG_X0
+        if not 0 <= index < _STUB_ARGUMENTS:
+            msg = f"Only the first {_STUB_ARGUMENTS} argument registers are available natively, not {reg_id}"
+            raise ValueError(msg)
+        return index
+
+    def read_cstr(self, address: int, max_length: int = 0x1000) -> bytes:
+        """Read a NUL-terminated string of at most `max_length` bytes, without the terminator."""
+        length = _libc().strnlen(address, max_length)
+        if length == max_length:
+            msg = f"String at 0x{address:X} is not terminated within {max_length} bytes"
+            raise RuntimeError(msg)
+        return ctypes.string_at(address, length)
+
+    def set_errno(self, value: int) -> None:
+        if self._errno_address is None:
+            self._errno_address = self.temp_alloc(4)
+        self.write_struct(self._errno_address, "<I", value)
+
+    def temp_alloc_data(self, data: bytes) -> int:
+        data_size = len(data)
+        address, alloc_size = self._temp_allocator.alloc(data_size + 1)
+        self.mem_write(address, data + b"\xcc" * (alloc_size - data_size))
+        return address
+
+    def temp_alloc(self, size: int) -> int:
+        return self.temp_alloc_data(b"\xaa" * size)
+
+    def temp_free(self, address: int) -> None:
+        return self._temp_allocator.free(address)
+
+    def scratch_alloc(self, size: int) -> int:
+        """
+        Reserve memory that lives until the next call returns.
+
+        Scratch memory is not initialized and never needs to be freed.
+        """
+        address = self._scratch_top
+        top = (address + size + SCRATCH_ALIGNMENT - 1) & ~(SCRATCH_ALIGNMENT - 1)
+        if top > self._scratch_address + self._layout.scratch_size:
+            msg = f"Cannot alloc more scratch memory: 0x{size:X} bytes requested"
+            raise RuntimeError(msg)
+        self._scratch_top = top
+        return address
+
+    def scratch_alloc_data(self, data: bytes) -> int:
+        address = self.scratch_alloc(len(data))
+        self.mem_write(address, data)
+        return address
+
+    def invoke_cdecl(self, address: int, args: list[int], *, budgeted: bool = False) -> int:  # noqa: ARG002
+        """
+        Call a library function and return the value it returns.
+
+        Native calls can't be stopped, so there is no call budget to apply with ``budgeted``.
+        """
+        function = _function_type(len(args))(address)
+        self._entry_address = address
+        self._error = None
+        logger.debug("Calling 0x%X natively", address)
+        try:
+            result = function(*args)
+        finally:
+            self._call_stats[address] = self._call_stats.get(address, 0) + 1
+            self._scratch_top = self._scratch_address
+
+        error = self._error
+        if error is not None:
+            self._error = None
+            # the library went on with a return value of 0 from the failed stub, only a rollback can undo that
+            self._interrupted = True
+            raise error
+        return result
+
+    def _stub_callback(self, name: str) -> Callable[..., int]:
+        handler = get_stub_handler(name)
+
+        def _callback(*args: int) -> int:
+            # exceptions can't unwind through library code, so they are kept until the call returns
+            if self._error is not None:
+                return 0
+            self._registers = list(args)
+            recorder = self._stub_recorder
+            start = time.perf_counter_ns()
+            try:
+                handler(self._hook_ctx)
+            except BaseException as e:  # noqa: BLE001
+                self._error = e
+                return 0
+            finally:
+                if recorder is not None:
+                    elapsed = time.perf_counter_ns() - start
+                    recorder.record(self._entry_name(self._entry_address), name, elapsed)
+            return self._registers[0]
+
+        return _callback
+
+    def _bind_import(self, name: str) -> int:
+        if name in self._options.guest_routines:
+            # plain memory functions, which the host's libc does best
+            return ctypes.cast(getattr(_libc(), name), ctypes.c_void_p).value or 0
+
+        callback = self._callbacks.get(name)
+        if callback is None:
+            callback = self._callbacks[name] = _STUB_TYPE(self._stub_callback(name))
+        return ctypes.cast(callback, ctypes.c_void_p).value or 0
+
+    def load_library(self, name: str) -> Library:
+        if name in self._loaded_libs:
+            return self._loaded_libs[name]
+
+        with self._lib_store.open_library(name) as f:
+            elf_data = f.read()
+            elf = ELFFile(io.BytesIO(elf_data))
+
+        reserve = self._layout.library_reserve
+        span = max(
+            (
+                segment["p_vaddr"] + segment["p_memsz"]
+                for segment in elf.iter_segments()
+                if segment["p_type"] == "PT_LOAD"
+            ),
+            default=0,
+        )
+        if span > reserve:
+            msg = f"Library {name} needs 0x{span:X} bytes of address space, but the layout reserves 0x{reserve:X}"
+            raise RuntimeError(msg)
+
+        library = Library(name, elf, self._lib_allocator.alloc(reserve)[0], len(self._libraries))
+        for symbol_index, import_name in library.import_names().items():
+            if import_name:
+                library.symbols[symbol_index] = self._bind_import(import_name)
+
+        # the same loader as the emulator, only the library ends up in host memory
+        images = VM._build_images(library, elf_data)  # noqa: SLF001
+        VM._relocate_images(library, images)  # noqa: SLF001
+
+        protections = _page_protections(images)
+        for start, size, _ in protections:
+            _protect(start, size, _PROT_READ | _PROT_WRITE)
+        for address, _, image in images:
+            ctypes.memmove(address, bytes(image), len(image))
+        for start, size, prot in protections:
+            _protect(start, size, prot)
+            if prot & _PROT_WRITE:
+                self._writable_segments.append((start, size))
+        logger.debug("Loaded %s natively at 0x%X", name, library.base)
+
+        self._loaded_libs[name] = library
+        self._libraries.append(library)
+        return library
+
+    def get_library(self, index: int) -> Library:
+        return self._libraries[index]
+
+    def name_entry_points(self, names: dict[int, str]) -> None:
+        """Set the names that statistics use for functions called through :meth:`invoke_cdecl`."""
+        self._entry_names = dict(names)
+
+    def _entry_name(self, address: int) -> str:
+        return self._entry_names.get(address) or f"0x{address:X}"
+
+    @property
+    def entry_address(self) -> int:
+        """Function that the current or last call through :meth:`invoke_cdecl` started at."""
+        return self._entry_address
+
+    def set_profiler(self, profiler: GuestProfiler | None) -> None:
+        if profiler is not None:
+            logger.warning("Native calls cannot be sampled, profiling needs the emulator")
+
+    def set_stub_recorder(self, recorder: StubRecorder | None) -> None:
+        """Record the time of every import stub call with a recorder, or stop recording if it is ``None``."""
+        with self._lock:
+            self._stub_recorder = recorder
+
+    @property
+    def leak_tracker(self) -> LeakTracker | None:
+        return None
+
+    def set_leak_tracking(self, enabled: bool) -> None:
+        if enabled:
+            logger.warning("Call sites of native code are unknown, leak tracking needs the emulator")
+
+    def leak_report(self) -> LeakReport | None:
+        return None
+
+    def checkpoint(self) -> NativeCheckpoint:
+        """Capture the memory that a call can change: writable library segments and heaps up to their top."""
+        regions = list(self._writable_segments)
+        regions.extend((heap.base, heap.top - heap.base) for heap in (self._malloc_allocator, self._temp_allocator))
+        return NativeCheckpoint(
+            memory=tuple((address, self.mem_read(address, size)) for address, size in regions if size > 0),
+            allocators=(self._malloc_allocator.copy(), self._temp_allocator.copy()),
+            errno_address=self._errno_address,
+        )
+
+    def rollback(self, checkpoint: NativeCheckpoint) -> None:
+        for address, data in checkpoint.memory:
+            self.mem_write(address, data)
+        self._malloc_allocator, self._temp_allocator = (allocator.copy() for allocator in checkpoint.allocators)
+        self._errno_address = checkpoint.errno_address
+        self._scratch_top = self._scratch_address
+        self._interrupted = False
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Hold the VM lock for the body, and roll memory back to what it was on entry if the body raises."""
+        with self._lock:
+            if not self._options.transactions:
+                yield
+                return
+
+            checkpoint = self.checkpoint()
+            try:
+                yield
+            except BaseException:
+                logger.warning("Native call failed, rolling back VM state")
+                self.rollback(checkpoint)
+                raise
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Generic, TypeVar
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+logger = logging.getLogger(__name__)
+
+_T = TypeVar("_T")
+
+# how long the producer waits before trying again after generating failed
+_RETRY_DELAY = 1.0
+
+
+class OTPPool(Generic[_T]):
+    """
+    Keeps a few pre-generated header sets of a session ready, so requests don't have to wait for the emulator.
+
+    Entries are thrown away once they are older than ``max_age``. The pool only refills up to the number of
+    requests seen within the last ``max_age`` seconds, so an idle session stops generating on its own.
+    """
+
+    def __init__(self, produce: Callable[[], Callable[[int], list[_T]] | None], size: int, max_age: float) -> None:
+        if size < 1 or max_age <= 0:
+            msg = f"Invalid OTP pool settings: size {size}, max age {max_age}"
+            raise ValueError(msg)
+
+        # returns None once the session is gone, which ends the producer
+        self._produce = produce
+        self._size = size
+        self._max_age = max_age
+
+        self._cond = threading.Condition()
+        self._closed = False
+        # generation time, entry; oldest first
+        self._entries: deque[tuple[float, _T]] = deque()
+        # times of recent requests, used to size the pool
+        self._demand: deque[float] = deque()
+
+        self._thread = threading.Thread(target=self._run, name="anisette-otp-pool", daemon=True)
+        self._thread.start()
+
+    def take(self) -> _T | None:
+        """Take the oldest fresh entry, or ``None`` if there is none and the caller has to generate its own."""
+        with self._cond:
+            now = time.monotonic()
+            self._demand.append(now)
+            self._expire(now)
+            entry = self._entries.popleft() if self._entries else None
+            self._cond.notify_all()
+
+        return entry[1] if entry is not None else None
+
+    def __len__(self) -> int:
+        """Return the number of fresh entries that are ready to be taken."""
+        with self._cond:
+            self._expire(time.monotonic())
+            return len(self._entries)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def wait_ready(self, count: int, timeout: float | None = None) -> bool:
+        """Wait until at least ``count`` entries are ready, and return whether they are before the timeout."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._closed or len(self._entries) >= count, timeout)
+            return not self._closed and len(self._entries) >= count
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._entries.clear()
+            self._cond.notify_all()
+
+    def _expire(self, now: float) -> None:
+        while self._entries and self._entries[0][0] + self._max_age <= now:
+            self._entries.popleft()
+        while self._demand and self._demand[0] + self._max_age <= now:
+            self._demand.popleft()
+
+    def _missing(self) -> int | None:
+        # wait until entries are missing, None once closed
+        while not self._closed:
+            now = time.monotonic()
+            self._expire(now)
+            missing = min(self._size, len(self._demand)) - len(self._entries)
+            if missing > 0:
+                return missing
+
+            # wake up when an entry or request expires, or someone takes an entry
+            oldest = [self._entries[0][0]] if self._entries else []
+            if self._demand:
+                oldest.append(self._demand[0])
+            self._cond.wait(min(oldest) + self._max_age - now if oldest else None)
+        return None
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                missing = self._missing()
+            if missing is None or not self._generate(missing):
+                return
+
+    def _generate(self, count: int) -> bool:
+        produce = self._produce()
+        if produce is None:
+            return False
+
+        start = time.monotonic()
+        try:
+            batch = produce(count)
+        except Exception:
+            logger.warning("Could not pre-generate Anisette data", exc_info=True)
+            with self._cond:
+                self._cond.wait(_RETRY_DELAY)
+            return True
+
+        with self._cond:
+            if not self._closed:
+                self._entries.extend((start, entry) for entry in batch)
+                self._cond.notify_all()
+        return True
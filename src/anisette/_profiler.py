@@ -0,0 +1,225 @@
+from __future__ import annotations
+
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from typing_extensions import Self
+    from unicorn.unicorn import Uc
+
+
+class GuestProfiler:
+    """
+    Sampling profiler for emulated code.
+
+    While attached to a session, guest execution is interrupted every ``interval`` seconds to record a backtrace.
+    Samples are grouped by the entry point that was called, and can be written out as collapsed stacks, which
+    flamegraph.pl and speedscope can read directly.
+    """
+
+    def __init__(self, interval: float = 0.001, max_depth: int = 64) -> None:
+        """
+        Init.
+
+        :param interval: Time between two samples, in seconds.
+        :type interval: float
+        :param max_depth: Maximum number of frames per backtrace.
+        :type max_depth: int
+        """
+        if interval <= 0:
+            msg = f"Invalid sampling interval: {interval}"
+            raise ValueError(msg)
+
+        self.interval = interval
+        self.max_depth = max_depth
+
+        self._lock = threading.Lock()
+        # entry point -> backtrace, outermost frame first -> number of samples
+        self._stacks: dict[str, Counter[tuple[str, ...]]] = {}
+
+    def record(self, entry: str, frames: tuple[str, ...]) -> None:
+        with self._lock:
+            self._stacks.setdefault(entry, Counter())[frames] += 1
+
+    @property
+    def stacks(self) -> dict[str, dict[tuple[str, ...], int]]:
+        """Number of samples of every backtrace, outermost frame first, by entry point."""
+        with self._lock:
+            return {entry: dict(stacks) for entry, stacks in self._stacks.items()}
+
+    def collapsed(self) -> str:
+        """Format samples as collapsed stacks: one ``entry;frame;...;frame count`` line per backtrace."""
+        lines = [
+            ";".join((entry, *frames)) + f" {count}"
+            for entry, stacks in sorted(self.stacks.items())
+            for frames, count in sorted(stacks.items())
+        ]
+        return "".join(f"{line}\n" for line in lines)
+
+    def write_collapsed(self, file: str | Path) -> None:
+        Path(file).write_text(self.collapsed(), encoding="utf-8")
+
+
+@dataclass(frozen=True)
+class StubStats:
+    """Host time spent in one import stub."""
+
+    calls: int
+    """Number of calls."""
+    total_time: float
+    """Host time spent in the stub over all calls, in seconds."""
+    max_time: float
+    """Host time of the slowest call, in seconds."""
+
+    @property
+    def mean_time(self) -> float:
+        return self.total_time / self.calls if self.calls else 0.0
+
+
+class StubRecorder:
+    """Aggregates calls to import stubs by entry point and stub."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # (entry point, stub) -> [calls, total nanoseconds, max nanoseconds]
+        self._stats: dict[tuple[str, str], list[int]] = {}
+
+    def record(self, entry: str, stub: str, elapsed_ns: int) -> None:
+        with self._lock:
+            stats = self._stats.get((entry, stub))
+            if stats is None:
+                self._stats[entry, stub] = [1, elapsed_ns, elapsed_ns]
+            else:
+                stats[0] += 1
+                stats[1] += elapsed_ns
+                stats[2] = max(stats[2], elapsed_ns)
+
+    @property
+    def stats(self) -> dict[str, dict[str, StubStats]]:
+        """Statistics of every stub, by entry point."""
+        result: dict[str, dict[str, StubStats]] = {}
+        with self._lock:
+            for (entry, stub), (calls, total_ns, max_ns) in sorted(self._stats.items()):
+                result.setdefault(entry, {})[stub] = StubStats(calls, total_ns / 1e9, max_ns / 1e9)
+        return result
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+
+@dataclass(frozen=True)
+class LeakSite:
+    """Guest memory allocated from one call site that has not been freed yet."""
+
+    site: str
+    """Symbolized address of the call to ``malloc``."""
+    entry: str
+    """Entry point that was running when the memory was allocated."""
+    live_bytes: int
+    """Requested bytes that are still allocated."""
+    live_allocations: int
+    """Number of allocations that are still live."""
+
+
+@dataclass(frozen=True)
+class LeakReport:
+    """Outstanding guest allocations made since leak tracking started."""
+
+    calls: dict[str, int]
+    """Number of calls made to each entry point while tracking."""
+    sites: tuple[LeakSite, ...]
+    """Call sites with live allocations, most bytes first."""
+
+    @property
+    def live_bytes(self) -> int:
+        return sum(site.live_bytes for site in self.sites)
+
+
+class LeakTracker:
+    """Remembers the call site of every live ``malloc`` allocation of one VM."""
+
+    def __init__(self) -> None:
+        # address -> call site, requested size, entry point
+        self._live: dict[int, tuple[int, int, int]] = {}
+        self._calls: Counter[int] = Counter()
+
+    def called(self, entry: int) -> None:
+        self._calls[entry] += 1
+
+    def allocated(self, address: int, size: int, site: int, entry: int) -> None:
+        self._live[address] = (site, size, entry)
+
+    def freed(self, address: int) -> None:
+        # allocations from before tracking started are not known
+        self._live.pop(address, None)
+
+    def retain(self, is_live: Callable[[int], bool]) -> None:
+        """Forget allocations that were undone, for example by rolling back a failed call."""
+        self._live = {address: info for address, info in self._live.items() if is_live(address)}
+
+    def report(self, symbolize: Callable[[int], str], entry_name: Callable[[int], str]) -> LeakReport:
+        sites: dict[tuple[int, int], list[int]] = {}
+        for site, size, entry in self._live.values():
+            totals = sites.setdefault((site, entry), [0, 0])
+            totals[0] += size
+            totals[1] += 1
+
+        return LeakReport(
+            calls={entry_name(entry): count for entry, count in self._calls.items()},
+            sites=tuple(
+                sorted(
+                    (
+                        LeakSite(symbolize(site), entry_name(entry), live_bytes, live_allocations)
+                        for (site, entry), (live_bytes, live_allocations) in sites.items()
+                    ),
+                    key=lambda leak: (-leak.live_bytes, leak.site),
+                ),
+            ),
+        )
+
+
+class Sampler:
+    """Background thread that stops a running emulation at a fixed interval, so the VM can take a sample."""
+
+    def __init__(self, uc: Uc, interval: float) -> None:
+        self._uc = uc
+        self._interval = interval
+
+        self._lock = threading.Lock()
+        self._running = False
+        self._fired = False
+
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="anisette-profiler", daemon=True)
+
+    def __enter__(self) -> Self:
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self._done.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._done.wait(self._interval):
+            with self._lock:
+                if self._running:
+                    self._fired = True
+                    self._uc.emu_stop()
+
+    def begin(self) -> None:
+        with self._lock:
+            self._running = True
+
+    def end(self) -> bool:
+        """Mark emulation as stopped, and return whether it was stopped to take a sample."""
+        with self._lock:
+            self._running = False
+            fired, self._fired = self._fired, False
+            return fired
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+# Pre-assembled ARM64 implementations of libc functions that only touch guest memory.
+# These are placed in the import region and run inside the emulator, so calling them
+# doesn't need a round trip through Python.
+GUEST_ROUTINES: dict[str, bytes] = {
+    # void *memcpy(void *dst, const void *src, size_t n)
+    "memcpy": bytes.fromhex(
+        "e30300aa"  # mov x3, x0
+        "5f4000f1"  # 1: cmp x2, #16
+        "a3000054"  # b.lo 2f
+        "2414c1a8"  # ldp x4, x5, [x1], #16
+        "641481a8"  # stp x4, x5, [x3], #16
+        "424000d1"  # sub x2, x2, #16
+        "fbffff17"  # b 1b
+        "a20000b4"  # 2: cbz x2, 3f
+        "24144038"  # ldrb w4, [x1], #1
+        "64140038"  # strb w4, [x3], #1
+        "420400d1"  # sub x2, x2, #1
+        "fcffff17"  # b 2b
+        "c0035fd6",  # 3: ret
+    ),
+    # void *memset(void *dst, int c, size_t n)
+    "memset": bytes.fromhex(
+        "211c4092"  # and x1, x1, #0xff
+        "e4c300b2"  # mov x4, #0x0101010101010101
+        "247c049b"  # mul x4, x1, x4
+        "e30300aa"  # mov x3, x0
+        "5f4000f1"  # 1: cmp x2, #16
+        "83000054"  # b.lo 2f
+        "641081a8"  # stp x4, x4, [x3], #16
+        "424000d1"  # sub x2, x2, #16
+        "fcffff17"  # b 1b
+        "820000b4"  # 2: cbz x2, 3f
+        "64140038"  # strb w4, [x3], #1
+        "420400d1"  # sub x2, x2, #1
+        "fdffff17"  # b 2b
+        "c0035fd6",  # 3: ret
+    ),
+    # size_t strlen(const char *s)
+    "strlen": bytes.fromhex(
+        "e10300aa"  # mov x1, x0
+        "22144038"  # 1: ldrb w2, [x1], #1
+        "e2ffff35"  # cbnz w2, 1b
+        "200000cb"  # sub x0, x1, x0
+        "000400d1"  # sub x0, x0, #1
+        "c0035fd6",  # ret
+    ),
+    # char *strncpy(char *dst, const char *src, size_t n)
+    "strncpy": bytes.fromhex(
+        "e30300aa"  # mov x3, x0
+        "220100b4"  # 1: cbz x2, 3f
+        "24144038"  # ldrb w4, [x1], #1
+        "64140038"  # strb w4, [x3], #1
+        "420400d1"  # sub x2, x2, #1
+        "84ffff35"  # cbnz w4, 1b
+        "820000b4"  # 2: cbz x2, 3f
+        "7f140038"  # strb wzr, [x3], #1
+        "420400d1"  # sub x2, x2, #1
+        "fdffff17"  # b 2b
+        "c0035fd6",  # 3: ret
+    ),
+}
+
+
+def branch(source: int, target: int) -> bytes:
+    """Encode an unconditional `B` from one guest address to another."""
+    offset = target - source
+    if offset % 4 != 0 or not -(1 << 27) <= offset < (1 << 27):
+        msg = f"Branch target out of range: 0x{source:X} -> 0x{target:X}"
+        raise ValueError(msg)
+    return (0x14000000 | (offset >> 2) & 0x3FFFFFF).to_bytes(4, "little")
@@ -1,3 +1,4 @@
+import struct
 from ctypes import Structure, c_int, c_long, c_size_t, c_uint32, c_uint64, c_ulong
 
 # Based on https://github.com/Dadoum/Provision/blob/main/lib/std_edit/linux_stat.d (aarch64)
@@ -75,3 +76,8 @@ tmp = c_stat()
 tmp_len = len(bytes(tmp))
 # print(tmpLen)
 assert tmp_len == 128
+
+# the same layouts for packing with the struct module
+STAT = struct.Struct("<QQIIIIQQqiiqqQqQqQII")
+TIMEVAL = struct.Struct("<qq")  # tv_sec, tv_usec
+assert STAT.size == tmp_len
@@ -67,27 +67,43 @@ def open_file(fp: BinaryIO | str | Path, mode: Literal["rb", "wb+"] = "rb") -> I
         file.close()
 
 
-def get_config_dir(dir_name: str) -> Path | None:
+def _get_user_dir(
+    dir_name: str,
+    xdg_variable: str,
+    linux_default: str,
+    darwin_default: str,
+    kind: str,
+) -> Path | None:
     plat = platform.system()
     if plat == "Windows":
         path_str = os.getenv("LOCALAPPDATA")
     elif plat in ("Linux", "Darwin"):
-        path_str = os.getenv("XDG_CONFIG_HOME")
+        path_str = os.getenv(xdg_variable)
         if path_str is None:
             home = os.getenv("HOME")
             if home is None:
                 logger.info("Could not determine home directory")
                 return None
-            subpath = os.path.join(home, ".config" if plat == "Linux" else "Library/Preferences")  # noqa: PTH118
-            path_str = os.getenv("XDG_CONFIG_HOME", subpath)
+            path_str = os.path.join(home, linux_default if plat == "Linux" else darwin_default)  # noqa: PTH118
     else:
         logger.info("Platform unsupported: %s", plat)
         return None
 
     if path_str is None:
-        logger.info("Could not determine config directory")
+        logger.info("Could not determine %s directory", kind)
         return None
 
     path = Path(path_str) / dir_name
+    if plat == "Windows" and kind == "cache":
+        # config and cache share LOCALAPPDATA on Windows, so the cache gets a subdirectory
+        path /= "cache"
     path.mkdir(parents=True, exist_ok=True)
     return path
+
+
+def get_config_dir(dir_name: str) -> Path | None:
+    return _get_user_dir(dir_name, "XDG_CONFIG_HOME", ".config", "Library/Preferences", "config")
+
+
+def get_cache_dir(dir_name: str) -> Path | None:
+    return _get_user_dir(dir_name, "XDG_CACHE_HOME", ".cache", "Library/Caches", "cache")
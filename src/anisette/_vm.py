@@ -1,19 +1,30 @@
 from __future__ import annotations
 
+import bisect
+import contextlib
+import ctypes
+import functools
 import io as _io
 import logging
+import struct
+import sys
+import threading
+import time
+import weakref
 from collections import OrderedDict
+from dataclasses import dataclass
+from enum import Enum
 from typing import TYPE_CHECKING, Any, Callable
 
+from elftools.elf.constants import P_FLAGS
 from elftools.elf.elffile import ELFFile
-from elftools.elf.relocation import RelocationSection
-from elftools.elf.sections import SymbolTableSection
 from unicorn import (
     UC_ARCH_ARM,
     UC_ARCH_ARM64,
     UC_ARCH_X86,
     UC_HOOK_BLOCK,
     UC_HOOK_CODE,
+    UC_HOOK_INTR,
     UC_HOOK_MEM_FETCH_UNMAPPED,
     UC_HOOK_MEM_READ_UNMAPPED,
     UC_HOOK_MEM_WRITE_UNMAPPED,
@@ -23,25 +34,48 @@ from unicorn import (
 )
 from unicorn.arm64_const import (
     UC_ARM64_REG_LR,
+    UC_ARM64_REG_PC,
     UC_ARM64_REG_SP,
     UC_ARM64_REG_X0,
+    UC_ARM64_REG_X29,
 )
-from unicorn.unicorn import Uc
+from unicorn.unicorn import Uc, UcContext
+from unicorn.unicorn_const import UC_PROT_ALL, UC_PROT_EXEC, UC_PROT_READ, UC_PROT_WRITE
 
-from ._allocator import Allocator
+from ._allocator import Allocator, AllocatorStats
 from ._arch import Architecture
-from ._hooks import HookContext, hook_block, hook_mem_invalid, hook_stub
+from ._hooks import (
+    HookContext,
+    get_stub_handler,
+    hook_block,
+    hook_code,
+    hook_intr,
+    hook_mem_invalid,
+    hook_stub,
+)
+from ._image_cache import LibraryImage
 from ._library import (
     R_AARCH64_ABS64,
     R_AARCH64_GLOB_DAT,
     R_AARCH64_JUMP_SLOT,
     R_AARCH64_RELATIVE,
+    R_X86_64_64,
+    R_X86_64_GLOB_DAT,
+    R_X86_64_JUMP_SLOT,
+    R_X86_64_RELATIVE,
+    SHN_UNDEF,
     Library,
     LibraryStore,
 )
+from ._profiler import GuestProfiler, LeakReport, LeakTracker, Sampler, StubRecorder
+from ._routines import GUEST_ROUTINES, branch
 
 if TYPE_CHECKING:
+    import mmap
+    from collections.abc import Iterator, Sequence
+
     from ._fs import VirtualFileSystem
+    from ._image_cache import LibraryImageCache
 
 logger = logging.getLogger(__name__)
 
@@ -55,98 +89,541 @@ MALLOC_SIZE = 0x1000000
 TEMP_ADDRESS = 0x800000000
 TEMP_SIZE = 0x100000
 
+SCRATCH_ADDRESS = 0x810000000
+SCRATCH_SIZE = 0x100000
+SCRATCH_ALIGNMENT = 0x10
+
 IMPORT_ADDRESS = 0xA0000000
-IMPORT_SIZE = 0x1000
+IMPORT_STRIDE = 0x01000000
+
+LIB_ADDRESS = 0x00100000
+LIB_RESERVE = 0x10000000
+# address space that libraries are placed in, one reserve each
+LIB_SPACE = 0x90000000
+
+PAGE_SIZE = 0x1000
+# heaps are mapped in steps of this size as their highest allocation grows
+HEAP_MAP_STEP = 0x40000
+
+SNAPSHOT_CHUNK_SIZE = 0x10000
+
+# reads at most this far apart are served by a single read of guest memory
+READ_COALESCE_GAP = 0x100
+# C strings are read in chunks growing from this size, rather than always reading the maximum length
+CSTR_CHUNK_SIZE = 0x40
+
+_U64 = struct.Struct("<Q")
+_FRAME_RECORD = struct.Struct("<QQ")  # previous frame pointer, return address
+
+_RET = b"\xc0\x03\x5f\xd6"
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_struct(fmt: str) -> struct.Struct:
+    return struct.Struct(fmt)
+
+
+def _as_struct(fmt: str | struct.Struct) -> struct.Struct:
+    return fmt if isinstance(fmt, struct.Struct) else _compile_struct(fmt)
+
+
+def _import_region_address(library_index: int) -> int:
+    # one stride per library between the heap and the fake return address
+    address = IMPORT_ADDRESS + library_index * IMPORT_STRIDE
+    if address + IMPORT_STRIDE > RETURN_ADDRESS:
+        msg = f"Cannot load more than {(RETURN_ADDRESS - IMPORT_ADDRESS) // IMPORT_STRIDE} libraries into one VM"
+        raise RuntimeError(msg)
+    return address
+
+
+def _svc(imm: int) -> bytes:
+    return (0xD4000001 | (imm & 0xFFFF) << 5).to_bytes(4, "little")
+
+
+class TraceLevel(Enum):
+    """
+    How much guest execution should be traced.
+
+    Every level above :attr:`TraceLevel.OFF` calls back into Python for each executed
+    basic block or instruction, which slows emulation down considerably. :attr:`TraceLevel.COUNT`
+    only counts executed instructions for call statistics, the other levels also write to the debug log
+    and run imported libc functions through their Python implementation instead of as guest code.
+    """
+
+    OFF = "off"
+    COUNT = "count"
+    BLOCK = "block"
+    INSTRUCTION = "instruction"
+
+
+class Backend(Enum):
+    """
+    How library code is run.
+
+    :attr:`Backend.NATIVE` runs the libraries directly on the host CPU. That is only possible on Linux hosts of the
+    libraries' architecture, and without options that need the emulator: tracing and call budgets. VMs fall back to
+    :attr:`Backend.UNICORN` otherwise. Native code is not isolated from the host process, so a crash in the
+    libraries takes the process down, and profiling and leak tracking are not available.
+    """
+
+    UNICORN = "unicorn"
+    NATIVE = "native"
+
+
+class CallBudgetExceededError(RuntimeError):
+    """A call into the emulated libraries was stopped because it exceeded its :class:`CallBudget`."""
+
+
+@dataclass(frozen=True)
+class CallBudget:
+    """Limits on a single call into the emulated libraries, ``None`` means unlimited."""
+
+    timeout: float | None = None
+    """Wall-clock time in seconds, including time spent in import stubs."""
+    max_instructions: int | None = None
+    """Number of guest instructions. Enforcing this makes emulation slightly slower."""
+
+    def __post_init__(self) -> None:
+        # unicorn reads 0 as no limit at all, and would be handed negative values as they are
+        if self.timeout is not None and self.timeout <= 0:
+            msg = f"Invalid call budget timeout: {self.timeout}, expected a positive number of seconds or None"
+            raise ValueError(msg)
+        if self.max_instructions is not None and self.max_instructions <= 0:
+            msg = f"Invalid call budget instruction limit: {self.max_instructions}, expected a positive number or None"
+            raise ValueError(msg)
+
+
+_UNLIMITED = CallBudget()
+# unicorn only counts instructions in code that was translated while a count was set, so VMs with an
+# instruction budget keep counting in unbudgeted calls too, up to a limit that is never reached
+_UNCOUNTED_INSTRUCTIONS = 1 << 62
+
+
+@dataclass(frozen=True)
+class CallStats:
+    """Statistics of the calls made to one entry point of the emulated libraries."""
+
+    calls: int
+    """Number of calls, including failed ones."""
+    instructions: int
+    """
+    Guest instructions executed by all calls, including the libraries they call into.
+
+    Only counted if the VM traces at :attr:`TraceLevel.COUNT` or above, 0 otherwise.
+    """
+
+    @property
+    def instructions_per_call(self) -> float:
+        return self.instructions / self.calls if self.calls else 0.0
+
+
+@dataclass(frozen=True)
+class MemoryLayout:
+    """Sizes of the guest memory regions of a VM. Region addresses are fixed, see the module constants."""
+
+    malloc_size: int = MALLOC_SIZE
+    temp_size: int = TEMP_SIZE
+    scratch_size: int = SCRATCH_SIZE
+    stack_size: int = STACK_SIZE
+    # address space set aside for each library, this is never mapped as a whole
+    library_reserve: int = LIB_RESERVE
+
+    def __post_init__(self) -> None:
+        # largest sizes that don't run into the next region
+        limits = {
+            "malloc_size": IMPORT_ADDRESS - MALLOC_ADDRESS,
+            "temp_size": SCRATCH_ADDRESS - TEMP_ADDRESS,
+            "scratch_size": 0x10000000,
+            "stack_size": 0x100000000 - STACK_ADDRESS,
+            "library_reserve": 0x10000000,
+        }
+        for name, limit in limits.items():
+            value = getattr(self, name)
+            if not 0 < value <= limit or value % PAGE_SIZE:
+                msg = f"Invalid {name}: 0x{value:X}, must be a multiple of 0x{PAGE_SIZE:X} up to 0x{limit:X}"
+                raise ValueError(msg)
+
+
+class MemoryProfile(Enum):
+    """
+    Predefined guest memory layouts, trading memory per session against headroom.
+
+    Smaller heaps fill up sooner, which makes sessions replace their VM more often.
+    Heaps are mapped on demand, so their size mostly limits how much memory a leaking VM can take up.
+    """
+
+    COMPACT = "compact"
+    DEFAULT = "default"
+    LARGE = "large"
+
+    @property
+    def layout(self) -> MemoryLayout:
+        return _PROFILE_LAYOUTS[self]
+
+
+_PROFILE_LAYOUTS = {
+    MemoryProfile.COMPACT: MemoryLayout(
+        malloc_size=0x400000,
+        temp_size=0x40000,
+        scratch_size=0x40000,
+        stack_size=0x80000,
+        library_reserve=0x4000000,
+    ),
+    MemoryProfile.DEFAULT: MemoryLayout(),
+    MemoryProfile.LARGE: MemoryLayout(
+        malloc_size=0x4000000,
+        temp_size=0x400000,
+        scratch_size=0x100000,
+        stack_size=0x400000,
+    ),
+}
+
+
+@dataclass(frozen=True)
+class VMOptions:
+    """Tunables that influence how a VM is set up."""
+
+    image_cache: LibraryImageCache | None = None
+    trace_level: TraceLevel = TraceLevel.OFF
+    # Import stubs are `SVC #n; RET` trampolines handled by one interrupt hook,
+    # instead of plain `RET`s with a code hook over every import region.
+    trap_stubs: bool = True
+    # Imports that run as pre-assembled guest code instead of a Python hook, remove names
+    # to debug them through their Python implementation. Requires trap stubs.
+    guest_routines: frozenset[str] = frozenset(GUEST_ROUTINES)
+    # Map read-only library segments from host memory shared by all VMs in this process,
+    # instead of giving every VM a writable copy.
+    share_images: bool = True
+    # Checkpoint guest state around ADI calls and roll back to it if a call fails.
+    # Off by default, since every call then copies all writable guest memory.
+    transactions: bool = False
+    # Limits on calls into the libraries made with budgeted=True, so a call that never returns can't block
+    # its thread forever.
+    call_budget: CallBudget = CallBudget()
+    layout: MemoryLayout = MemoryLayout()
+    # Run the libraries on the host CPU where possible, see Backend.
+    backend: Backend = Backend.UNICORN
+
+    def __post_init__(self) -> None:
+        unknown = self.guest_routines - GUEST_ROUTINES.keys()
+        if unknown:
+            msg = f"No guest implementation for: {', '.join(sorted(unknown))}"
+            raise ValueError(msg)
+
+    @property
+    def memory_key(self) -> tuple[object, ...]:
+        """Options that change the contents of guest memory; VMs can only be cloned between equal keys."""
+        return (self.trap_stubs, tuple(sorted(self.active_guest_routines)), self.share_images, self.layout)
+
+    @property
+    def active_guest_routines(self) -> frozenset[str]:
+        # with code hooks, jumping into guest code would still call into Python for the import slot
+        return self.guest_routines if self.trap_stubs else frozenset()
+
+    @property
+    def import_slot_size(self) -> int:
+        return 8 if self.trap_stubs else 4
+
+
+@dataclass(frozen=True)
+class VMSnapshot:
+    """
+    Frozen copy of a VM's guest state.
+
+    Memory is stored as non-zero chunks per mapped region, so untouched heap and stack
+    space does not take up any room in the snapshot.
+    """
+
+    arch: Architecture
+    regions: tuple[tuple[int, int, int, tuple[tuple[int, bytes], ...]], ...]
+    shared_regions: tuple[tuple[int, int, int, mmap.mmap, int], ...]
+    context: UcContext
+    libraries: tuple[Library, ...]
+    images: tuple[LibraryImage, ...]
+    import_regions: tuple[tuple[int, int], ...]
+    stubs: dict[int, tuple[str, Callable[[HookContext], None]]]
+    allocators: tuple[Allocator, Allocator, Allocator]
+    errno_address: int | None
+
+
+@dataclass(frozen=True)
+class VMCheckpoint:
+    """Guest state needed to undo a failed call, see :meth:`VM.checkpoint`."""
+
+    context: UcContext
+    memory: tuple[tuple[int, bytes], ...]
+    allocators: tuple[Allocator, Allocator]
+    errno_address: int | None
+
+
+# (library digest, layout) -> relocated image, shared by all VMs of this process for as long as one of them uses it
+_shared_images: weakref.WeakValueDictionary[tuple[str, tuple[int, ...]], LibraryImage] = weakref.WeakValueDictionary()
+_shared_images_lock = threading.Lock()
 
 
 class VM:
-    def __init__(self, uc: Uc, fs: VirtualFileSystem, lib_store: LibraryStore) -> None:
+    def __init__(
+        self,
+        uc: Uc,
+        fs: VirtualFileSystem,
+        lib_store: LibraryStore,
+        arch: Architecture,
+        options: VMOptions | None = None,
+    ) -> None:
         self._uc = uc
         self._fs = fs
+        self._arch = arch
+        self._options = options or VMOptions()
+        self._layout = self._options.layout
 
         self._lib_store = lib_store
         self._loaded_libs: dict[str, Library] = OrderedDict()
+        self._libraries: list[Library] = []
+        self._import_regions: list[tuple[int, int]] = []
+
+        # import stub address -> handler
+        self._stubs: dict[int, tuple[str, Callable[[HookContext], None]]] = {}
+
+        self._temp_allocator = Allocator(TEMP_ADDRESS, self._layout.temp_size)
+        self._malloc_allocator = Allocator(MALLOC_ADDRESS, self._layout.malloc_size)
+        self._lib_allocator = Allocator(LIB_ADDRESS, LIB_SPACE)
 
-        self._temp_allocator = Allocator(TEMP_ADDRESS, TEMP_SIZE)
-        self._malloc_allocator = Allocator(MALLOC_ADDRESS, MALLOC_SIZE)
-        self._lib_allocator = Allocator(0x00100000, 0x90000000)
+        # heap base -> end of the part that is mapped so far
+        self._heap_ends = {MALLOC_ADDRESS: MALLOC_ADDRESS, TEMP_ADDRESS: TEMP_ADDRESS}
+
+        # bump pointer into the scratch region, which is released as a whole after every call
+        self._scratch_top = SCRATCH_ADDRESS
 
         self._errno_address: int | None = None
 
+        self._hook_ctx = HookContext(vm=self, fs=self._fs)
+
+        # a VM runs one call at a time, different VMs can run in parallel
+        self._lock = threading.RLock()
+
+        # entry point -> name to file statistics under, instead of the symbol name
+        self._entry_names: dict[int, str] = {}
+        self._entry_address = 0
+        self._profiler: GuestProfiler | None = None
+        self._stub_recorder: StubRecorder | None = None
+        self._leak_tracker: LeakTracker | None = None
+        # symbol table for the profiler: sorted start addresses, and (end, name) of the code starting there
+        self._symbol_starts: list[int] = []
+        self._symbol_ranges: list[tuple[int, str]] = []
+        self._symbol_libraries = 0
+
+        # images of the loaded libraries, which keeps them in _shared_images while this VM lives
+        self._images: list[LibraryImage] = []
+        # guest regions backed by shared host buffers, which must outlive the unicorn instance:
+        # address, size, permissions, buffer, offset into buffer
+        self._shared_regions: list[tuple[int, int, int, mmap.mmap, int]] = []
+
+        # set when a call was stopped partway through, until a rollback undoes it
+        self._interrupted = False
+
+        # guest instructions executed so far, only counted at TraceLevel.COUNT and above
+        self._instructions = 0
+        # entry point -> (calls, instructions)
+        self._call_stats: dict[int, tuple[int, int]] = {}
+
+    @property
+    def lock(self) -> threading.RLock:
+        """Held by whoever is using the VM. Calls that span several steps must hold it throughout."""
+        return self._lock
+
+    @property
+    def interrupted(self) -> bool:
+        """Whether a call was stopped before it returned, which leaves guest state inconsistent."""
+        return self._interrupted
+
     @property
     def alloc_stats(self) -> tuple[float, float, float]:
-        return (
-            self._temp_allocator.alloc_perc,
-            self._malloc_allocator.alloc_perc,
-            self._lib_allocator.alloc_perc,
-        )
+        with self._lock:
+            return (
+                self._temp_allocator.alloc_perc,
+                self._malloc_allocator.alloc_perc,
+                self._lib_allocator.alloc_perc,
+            )
+
+    @property
+    def allocator_stats(self) -> dict[str, AllocatorStats]:
+        with self._lock:
+            return {
+                "temp": self._temp_allocator.stats,
+                "malloc": self._malloc_allocator.stats,
+                "lib": self._lib_allocator.stats,
+            }
+
+    @property
+    def call_stats(self) -> dict[int, CallStats]:
+        with self._lock:
+            return {
+                address: CallStats(calls=calls, instructions=instructions)
+                for address, (calls, instructions) in self._call_stats.items()
+            }
 
     @property
     def errno_address(self) -> int | None:
         return self._errno_address
 
+    def attach_fs(self, fs: VirtualFileSystem) -> None:
+        self._fs = fs
+        self._hook_ctx.fs = fs
+
     def wrap_hook(self, hook: Callable) -> Callable:
+        ctx = self._hook_ctx
+
         def _new_hook(_uc: Uc, *args: Any) -> None:  # noqa: ANN401
-            ctx = HookContext(vm=self, fs=self._fs)
             return hook(ctx, *(args[:-1]))
 
         return _new_hook
 
-    @classmethod
-    def create(cls, fs: VirtualFileSystem, lib_store: LibraryStore, arch: Architecture) -> VM:
+    @staticmethod
+    def _create_uc(arch: Architecture) -> Uc:
         # Startup a unicorn-engine instance as VM backend
         if arch == Architecture.X86:
-            uc = Uc(UC_ARCH_X86, UC_MODE_32)
-        elif arch == Architecture.X86_64:
-            uc = Uc(UC_ARCH_X86, UC_MODE_64)
-        elif arch == Architecture.ARM:
-            uc = Uc(UC_ARCH_ARM, UC_MODE_ARM)
-        elif arch == Architecture.ARM64:
-            uc = Uc(UC_ARCH_ARM64, UC_MODE_ARM)
+            return Uc(UC_ARCH_X86, UC_MODE_32)
+        if arch == Architecture.X86_64:
+            return Uc(UC_ARCH_X86, UC_MODE_64)
+        if arch == Architecture.ARM:
+            return Uc(UC_ARCH_ARM, UC_MODE_ARM)
+        if arch == Architecture.ARM64:
+            return Uc(UC_ARCH_ARM64, UC_MODE_ARM)
+
+        msg = "Invalid architecture: %s"
+        raise ValueError(msg, arch)
+
+    def _install_hooks(self) -> None:
+        # Debug hooks, these are called for every block or instruction so only install them when asked to
+        trace_level = self._options.trace_level
+        if trace_level != TraceLevel.OFF:
+            self._uc.hook_add(UC_HOOK_BLOCK, self._count_block)
+        if trace_level == TraceLevel.BLOCK:
+            self._uc.hook_add(UC_HOOK_BLOCK, self.wrap_hook(hook_block))
+        elif trace_level == TraceLevel.INSTRUCTION:
+            self._uc.hook_add(UC_HOOK_CODE, self.wrap_hook(hook_code))
+
+        self._uc.hook_add(
+            UC_HOOK_MEM_READ_UNMAPPED | UC_HOOK_MEM_WRITE_UNMAPPED | UC_HOOK_MEM_FETCH_UNMAPPED,
+            self.wrap_hook(hook_mem_invalid),
+        )
+
+        if self._options.trap_stubs:
+            self._uc.hook_add(UC_HOOK_INTR, self.wrap_hook(hook_intr))
         else:
-            msg = "Invalid architecture: %s"
-            raise ValueError(msg, arch)
+            for address, size in self._import_regions:
+                self._hook_import_region(address, size)
+
+    def _count_block(self, _uc: Uc, _address: int, size: int, _user_data: object) -> None:
+        # fixed-width instructions, so the block size gives the instruction count
+        self._instructions += size // 4
+
+    def _hook_import_region(self, address: int, size: int) -> None:
+        self._uc.hook_add(UC_HOOK_CODE, self.wrap_hook(hook_stub), None, address, address + size - 1)
+
+    @classmethod
+    def create(
+        cls,
+        fs: VirtualFileSystem,
+        lib_store: LibraryStore,
+        arch: Architecture,
+        options: VMOptions | None = None,
+    ) -> VM:
+        uc = cls._create_uc(arch)
+        layout = (options or VMOptions()).layout
 
         # Register a fake return address
         uc.mem_map(RETURN_ADDRESS, 0x1000)
 
-        # Register some memory for malloc
-        uc.mem_map(MALLOC_ADDRESS, MALLOC_SIZE)
+        # Memory for malloc and temp data is mapped on demand, see _grow_heap
 
-        # Register memory for temp data
-        uc.mem_map(TEMP_ADDRESS, TEMP_SIZE)
+        # Register memory for call arguments
+        uc.mem_map(SCRATCH_ADDRESS, layout.scratch_size)
 
         # Register a fake stack
-        uc.mem_map(STACK_ADDRESS, STACK_SIZE)
+        uc.mem_map(STACK_ADDRESS, layout.stack_size)
 
-        vm = cls(uc, fs, lib_store)
+        vm = cls(uc, fs, lib_store, arch, options)
+        vm._install_hooks()
 
-        # Debug hooks
-        uc.hook_add(UC_HOOK_BLOCK, vm.wrap_hook(hook_block))
-        # uc.hook_add(UC_HOOK_CODE, hook_code, vm)
-        uc.hook_add(
-            UC_HOOK_MEM_READ_UNMAPPED | UC_HOOK_MEM_WRITE_UNMAPPED | UC_HOOK_MEM_FETCH_UNMAPPED,
-            vm.wrap_hook(hook_mem_invalid),
+        return vm
+
+    def snapshot(self) -> VMSnapshot:
+        """Capture guest memory, registers, loaded libraries and allocator state of this VM."""
+        zero_chunk = bytes(SNAPSHOT_CHUNK_SIZE)
+
+        shared_addresses = {address for address, *_ in self._shared_regions}
+
+        regions = []
+        for begin, end, perms in self._uc.mem_regions():
+            if begin in shared_addresses:
+                # immutable, so the clone can map the same host memory
+                continue
+            size = end - begin + 1
+            chunks = []
+            for offset in range(0, size, SNAPSHOT_CHUNK_SIZE):
+                chunk = self.mem_read(begin + offset, min(SNAPSHOT_CHUNK_SIZE, size - offset))
+                if chunk != zero_chunk[: len(chunk)]:
+                    chunks.append((offset, chunk))
+            regions.append((begin, size, perms, tuple(chunks)))
+
+        return VMSnapshot(
+            arch=self._arch,
+            regions=tuple(regions),
+            shared_regions=tuple(self._shared_regions),
+            context=self._uc.context_save(),
+            libraries=tuple(self._libraries),
+            images=tuple(self._images),
+            import_regions=tuple(self._import_regions),
+            stubs=dict(self._stubs),
+            allocators=(
+                self._temp_allocator.copy(),
+                self._malloc_allocator.copy(),
+                self._lib_allocator.copy(),
+            ),
+            errno_address=self._errno_address,
         )
 
-        # Add a region for imports
-        import_count = IMPORT_SIZE // 4
-        for i in range(10):
-            library_import_address = IMPORT_ADDRESS + i * 0x01000000
-            uc.mem_map(library_import_address, IMPORT_SIZE)
-            uc.mem_write(library_import_address, b"\xc0\x03\x5f\xd6" * import_count)  # RET instruction
-            uc.hook_add(
-                UC_HOOK_CODE,
-                vm.wrap_hook(hook_stub),
-                None,
-                library_import_address,
-                library_import_address + IMPORT_SIZE - 1,
-            )
+    @classmethod
+    def from_snapshot(
+        cls,
+        snapshot: VMSnapshot,
+        fs: VirtualFileSystem,
+        lib_store: LibraryStore,
+        options: VMOptions | None = None,
+    ) -> VM:
+        """Create a new VM by cloning a snapshot taken using :meth:`VM.snapshot`."""
+        uc = cls._create_uc(snapshot.arch)
+        for address, size, perms, chunks in snapshot.regions:
+            uc.mem_map(address, size, perms)
+            for offset, chunk in chunks:
+                uc.mem_write(address + offset, chunk)
+        uc.context_restore(snapshot.context)
+
+        vm = cls(uc, fs, lib_store, snapshot.arch, options)
+        for address, size, *_ in snapshot.regions:
+            heap = vm._heap_of(address)
+            if heap is not None:
+                vm._heap_ends[heap.base] = max(vm._heap_ends[heap.base], address + size)
+        for address, size, perms, buffer, offset in snapshot.shared_regions:
+            vm._map_shared(address, size, perms, buffer, offset)
+        vm._loaded_libs.update((library.name, library) for library in snapshot.libraries)
+        vm._libraries.extend(snapshot.libraries)
+        vm._images.extend(snapshot.images)
+        vm._import_regions.extend(snapshot.import_regions)
+        vm._stubs.update(snapshot.stubs)
+        vm._temp_allocator, vm._malloc_allocator, vm._lib_allocator = (
+            allocator.copy() for allocator in snapshot.allocators
+        )
+        vm._errno_address = snapshot.errno_address
+        vm._install_hooks()
 
         return vm
 
     def malloc(self, length: int) -> int:
-        return self._malloc_allocator.alloc(length)[0]
+        address = self._malloc_allocator.alloc(length)[0]
+        self._grow_heap(self._malloc_allocator)
+        return address
 
     def free(self, address: int) -> None:
         return self._malloc_allocator.free(address)
@@ -157,6 +634,46 @@ class VM:
     def mem_read(self, address: int, length: int) -> bytes:
         return bytes(self._uc.mem_read(address, length))
 
+    def mem_view(self, address: int, length: int) -> memoryview:
+        """Like :meth:`mem_read`, but without copying the data into an immutable buffer."""
+        return memoryview(self._uc.mem_read(address, length))
+
+    def read_struct(self, address: int, fmt: str | struct.Struct) -> tuple[Any, ...]:
+        fmt = _as_struct(fmt)
+        return fmt.unpack(self._uc.mem_read(address, fmt.size))
+
+    def read_many(self, requests: Sequence[tuple[int, str | struct.Struct]]) -> list[tuple[Any, ...]]:
+        """
+        Read a struct at each of the given addresses.
+
+        Requests close to each other are served by the same read of guest memory.
+        Results are returned in the order of the requests.
+        """
+        structs = [_as_struct(fmt) for _, fmt in requests]
+        results: list[tuple[Any, ...]] = [()] * len(requests)
+
+        # start, end, indices of the requests in it
+        runs: list[tuple[int, int, list[int]]] = []
+        for i in sorted(range(len(requests)), key=lambda i: requests[i][0]):
+            address = requests[i][0]
+            end = address + structs[i].size
+            if runs and address - runs[-1][1] <= READ_COALESCE_GAP:
+                run_start, run_end, run = runs[-1]
+                run.append(i)
+                runs[-1] = (run_start, max(run_end, end), run)
+            else:
+                runs.append((address, end, [i]))
+
+        for run_start, run_end, run in runs:
+            data = self._uc.mem_read(run_start, run_end - run_start)
+            for i in run:
+                results[i] = structs[i].unpack_from(data, requests[i][0] - run_start)
+
+        return results
+
+    def write_struct(self, address: int, fmt: str | struct.Struct, *values: Any) -> None:  # noqa: ANN401
+        self._uc.mem_write(address, _as_struct(fmt).pack(*values))
+
     def reg_write(self, reg_id: int, value: int) -> None:
         return self._uc.reg_write(reg_id, value)
 
@@ -189,12 +706,26 @@ class VM:
             signed=False,
         )
 
-    def read_cstr(self, address: int) -> bytes:
-        max_length = 0x1000
-        s = self.mem_read(address, max_length)
-        s, terminator, _ = s.partition(b"\x00")
-        assert terminator == b"\x00"
-        return s
+    def read_cstr(self, address: int, max_length: int = 0x1000) -> bytes:
+        """Read a NUL-terminated string of at most `max_length` bytes, without the terminator."""
+        data = bytearray()
+        chunk_size = CSTR_CHUNK_SIZE
+        while len(data) < max_length:
+            # never read across a page boundary, the string may end right before an unmapped page
+            position = address + len(data)
+            length = min(chunk_size, max_length - len(data), PAGE_SIZE - position % PAGE_SIZE)
+            chunk = self._uc.mem_read(position, length)
+
+            end = chunk.find(0)
+            if end != -1:
+                data += chunk[:end]
+                return bytes(data)
+
+            data += chunk
+            chunk_size *= 2
+
+        msg = f"String at 0x{address:X} is not terminated within {max_length} bytes"
+        raise RuntimeError(msg)
 
     def set_errno(self, value: int) -> None:
         if self._errno_address is None:
@@ -204,9 +735,10 @@ class VM:
     def temp_alloc_data(self, data: bytes) -> int:
         data_size = len(data)
         address, alloc_size = self._temp_allocator.alloc(data_size + 1)
+        self._grow_heap(self._temp_allocator)
 
         logger.debug("Allocating at 0x%X; bytes 0x%X/0x%X", address, data_size, alloc_size)
-        self.mem_write(address, data + b"\xcc" * alloc_size)
+        self.mem_write(address, data + b"\xcc" * (alloc_size - data_size))
 
         return address
 
@@ -216,136 +748,519 @@ class VM:
     def temp_free(self, address: int) -> None:
         return self._temp_allocator.free(address)
 
-    def invoke_cdecl(self, address: int, args: list[int]) -> int:
+    def scratch_alloc(self, size: int) -> int:
+        """
+        Reserve guest memory that lives until the next call returns.
+
+        Scratch memory is not initialized and never needs to be freed.
+        """
+        address = self._scratch_top
+        top = (address + size + SCRATCH_ALIGNMENT - 1) & ~(SCRATCH_ALIGNMENT - 1)
+        if top > SCRATCH_ADDRESS + self._layout.scratch_size:
+            msg = f"Cannot alloc more scratch memory: 0x{size:X} bytes requested"
+            raise RuntimeError(msg)
+        self._scratch_top = top
+        return address
+
+    def scratch_alloc_data(self, data: bytes) -> int:
+        address = self.scratch_alloc(len(data))
+        self.mem_write(address, data)
+        return address
+
+    def invoke_cdecl(self, address: int, args: list[int], *, budgeted: bool = False) -> int:
+        """
+        Call a guest function and return the value it returns.
+
+        With ``budgeted``, the call is limited by the call budget of this VM, see :class:`CallBudget`.
+        """
         lr = RETURN_ADDRESS
-        for i, value in enumerate(args):
-            assert i <= 28
-            self.reg_write(UC_ARM64_REG_X0 + i, value)
-            logger.debug("X%d: 0x%08X", i, value)
-        logger.debug("Calling 0x%X", address)
-        self.reg_write(UC_ARM64_REG_SP, STACK_ADDRESS + STACK_SIZE)
-        self.reg_write(UC_ARM64_REG_LR, lr)
-        # uc.reg_write(UC_ARM64_REG_FP, stackAddress + stackSize)
-        self._uc.emu_start(address, lr)
-        return self.reg_read(UC_ARM64_REG_X0)
-
-    def relocate_section(self, library: Library, section_name: str, base: int) -> None:
-        reladyn = library.elf.get_section_by_name(section_name)
-        assert isinstance(reladyn, RelocationSection)
-
-        for reloc in reladyn.iter_relocations():
-            # print('    Relocation (%s)' % 'RELA' if reloc.is_RELA() else 'REL', end="")
-            # Relocation entry attributes are available through item lookup
-            # print('      offset = 0x%X' % reloc['r_offset'])
-            # print("%s" % reloc.__dict__, end="")
-            # print("")
-
-            info_type = reloc["r_info_type"]
-            address = base + reloc["r_offset"]
-
-            if info_type in (R_AARCH64_ABS64, R_AARCH64_GLOB_DAT):
-                symbol_index = reloc["r_info_sym"]
-                symbol_address = library.resolve_symbol_by_index(symbol_index)
-                self.mem_write(
-                    address,
-                    int.to_bytes(symbol_address + reloc["r_addend"], 8, "little"),
-                )  # b'\x12\x34\x22\x78\xAB\xCD\xEF\xFF')
-            elif info_type == R_AARCH64_JUMP_SLOT:
-                symbol_index = reloc["r_info_sym"]
-                symbol_address = library.resolve_symbol_by_index(symbol_index)
-                self.mem_write(
-                    address,
-                    int.to_bytes(symbol_address, 8, "little"),
-                )  # b'\x12\x34\x11\x78\xAB\xCD\xEF\xFF')
-            elif info_type == R_AARCH64_RELATIVE:
-                self.mem_write(
-                    address,
-                    int.to_bytes(base + reloc["r_addend"], 8, "little"),
-                )  # b'\x12\x34\x22\x78\xAB\xCD\xEF\xFF')
+        try:
+            for i, value in enumerate(args):
+                assert i <= 28
+                self.reg_write(UC_ARM64_REG_X0 + i, value)
+                logger.debug("X%d: 0x%08X", i, value)
+            logger.debug("Calling 0x%X", address)
+            self.reg_write(UC_ARM64_REG_SP, STACK_ADDRESS + self._layout.stack_size)
+            self.reg_write(UC_ARM64_REG_LR, lr)
+            # uc.reg_write(UC_ARM64_REG_FP, stackAddress + stackSize)
+            self._emu_start(address, lr, self._options.call_budget if budgeted else _UNLIMITED)
+            return self.reg_read(UC_ARM64_REG_X0)
+        finally:
+            self._scratch_top = SCRATCH_ADDRESS
+
+    def _heap_of(self, address: int) -> Allocator | None:
+        for heap in (self._malloc_allocator, self._temp_allocator):
+            if heap.base <= address < heap.base + heap.size:
+                return heap
+        return None
+
+    def _grow_heap(self, heap: Allocator) -> None:
+        # map heaps up to their highest allocation only, so untouched space is neither mapped nor snapshotted
+        end = self._heap_ends[heap.base]
+        top = heap.top
+        if top <= end:
+            return
+        new_end = min((top + HEAP_MAP_STEP - 1) & ~(HEAP_MAP_STEP - 1), heap.base + heap.size)
+        self._uc.mem_map(end, new_end - end)
+        self._heap_ends[heap.base] = new_end
+
+    def _emu_start(self, address: int, until: int, budget: CallBudget) -> None:
+        # 0 means no limit to unicorn, so the shortest timeout is 1 µs
+        timeout = max(round(budget.timeout * 1_000_000), 1) if budget.timeout is not None else 0
+        count = budget.max_instructions or 0
+        if not count and self._options.call_budget.max_instructions is not None:
+            count = _UNCOUNTED_INSTRUCTIONS
+
+        instructions = self._instructions
+        start = time.perf_counter()
+        self._entry_address = address
+        if self._leak_tracker is not None:
+            self._leak_tracker.called(address)
+        try:
+            if self._profiler is None:
+                self._uc.emu_start(address, until, timeout=timeout, count=count)
+            else:
+                self._emu_start_sampled(address, until, start, budget.timeout, count)
+        except BaseException:
+            # a failing hook or memory access stops the guest just like a budget does
+            self._interrupted = True
+            raise
+        finally:
+            calls, total = self._call_stats.get(address, (0, 0))
+            self._call_stats[address] = (calls + 1, total + self._instructions - instructions)
+
+        # unicorn returns normally when a budget runs out, but stops short of the return address
+        pc = self.reg_read(UC_ARM64_REG_PC)
+        if pc != until:
+            # the guest was stopped somewhere in the middle, only a rollback can make it consistent again
+            self._interrupted = True
+            msg = (
+                f"Call to 0x{address:X} exceeded its budget after {time.perf_counter() - start:.3f}s, "
+                f"stopped at 0x{pc:X}"
+            )
+            raise CallBudgetExceededError(msg)
+
+    def _emu_start_sampled(self, address: int, until: int, start: float, limit: float | None, count: int) -> None:
+        # Emulation is stopped for every sample and then resumed, so nothing runs per instruction.
+        # Resuming restarts unicorn's instruction count, so the instruction budget only applies per stretch.
+        profiler = self._profiler
+        assert profiler is not None
+        entry = self._entry_name(address)
+
+        pc = address
+        with Sampler(self._uc, profiler.interval) as sampler:
+            while True:
+                timeout = 0
+                if limit is not None:
+                    remaining = limit - (time.perf_counter() - start)
+                    if remaining <= 0:
+                        return
+                    timeout = max(round(remaining * 1_000_000), 1)
+
+                sampler.begin()
+                try:
+                    self._uc.emu_start(pc, until, timeout=timeout, count=count)
+                finally:
+                    sampled = sampler.end()
+
+                pc = self.reg_read(UC_ARM64_REG_PC)
+                if pc == until or not sampled:
+                    return
+                profiler.record(entry, self.backtrace(pc, profiler.max_depth))
+
+    def name_entry_points(self, names: dict[int, str]) -> None:
+        """Set the names that profiles and statistics use for functions called through :meth:`invoke_cdecl`."""
+        self._entry_names = dict(names)
+
+    def _entry_name(self, address: int) -> str:
+        return self._entry_names.get(address) or self.symbolize(address)
+
+    def set_profiler(self, profiler: GuestProfiler | None) -> None:
+        """Sample calls into this VM with a profiler, or stop sampling if it is ``None``."""
+        with self._lock:
+            self._profiler = profiler
+
+    def set_stub_recorder(self, recorder: StubRecorder | None) -> None:
+        """Record the host time of every import stub call with a recorder, or stop recording if it is ``None``."""
+        with self._lock:
+            self._stub_recorder = recorder
+
+    def backtrace(self, pc: int, max_depth: int) -> tuple[str, ...]:
+        """Symbolized call stack of the guest, outermost frame first, by following the frame pointer chain."""
+        # LR is the only trace of the caller while a leaf function runs, it is skipped if a frame record repeats it
+        addresses = [pc, self.reg_read(UC_ARM64_REG_LR) - 4]
+
+        stack_end = STACK_ADDRESS + self._layout.stack_size
+        fp = self.reg_read(UC_ARM64_REG_X29)
+        while len(addresses) < max_depth and STACK_ADDRESS <= fp <= stack_end - _FRAME_RECORD.size:
+            next_fp, return_address = self.read_struct(fp, _FRAME_RECORD)
+            if return_address in {RETURN_ADDRESS, 0}:
+                break
+            if return_address - 4 != addresses[-1]:
+                addresses.append(return_address - 4)
+            if next_fp <= fp:
+                break
+            fp = next_fp
+
+        if addresses[1] == RETURN_ADDRESS - 4:
+            del addresses[1]
+        return tuple(self.symbolize(address) for address in reversed(addresses[:max_depth]))
+
+    def symbolize(self, address: int) -> str:
+        """Name guest code by the closest preceding symbol or import of a loaded library."""
+        if self._symbol_libraries != len(self._libraries):
+            self._build_symbol_table()
+
+        i = bisect.bisect_right(self._symbol_starts, address) - 1
+        if i >= 0:
+            end, name = self._symbol_ranges[i]
+            if address < end:
+                offset = address - self._symbol_starts[i]
+                return f"{name}+0x{offset:X}" if offset else name
+        return f"0x{address:X}"
+
+    def _build_symbol_table(self) -> None:
+        entries: list[tuple[int, int, str]] = []  # start, end, name
+        slot_size = self._options.import_slot_size
+        for library, (region_address, _) in zip(self._libraries, self._import_regions):
+            # symbols run until the next one, code before the first symbol is named after the library
+            names = {library.base: library.name}
+            names.update((address, f"{library.name}!{name}") for address, name in library.defined_symbols())
+            starts = sorted(names)
+            ends = [*starts[1:], library.base + self._layout.library_reserve]
+            entries.extend((start, end, names[start]) for start, end in zip(starts, ends))
+
+            # import slots, followed by the guest routines in the same order _map_import_region placed them
+            import_names = library.import_names()
+            for symbol_index, name in import_names.items():
+                slot_address = region_address + symbol_index * slot_size
+                entries.append((slot_address, slot_address + slot_size, f"[import] {name}"))
+            routine_address = region_address + len(library.raw_symbols()) * slot_size
+            for name in sorted(self._options.active_guest_routines & set(import_names.values())):
+                routine_end = routine_address + len(GUEST_ROUTINES[name])
+                entries.append((routine_address, routine_end, f"[guest] {name}"))
+                routine_address = routine_end
+
+        entries.sort()
+        self._symbol_starts = [start for start, _, _ in entries]
+        self._symbol_ranges = [(end, name) for _, end, name in entries]
+        self._symbol_libraries = len(self._libraries)
+
+    def checkpoint(self) -> VMCheckpoint:
+        """
+        Capture the guest state that a call can change.
+
+        Only live memory is saved: stack and scratch memory are dead between calls, and heaps are only
+        saved up to their highest allocation. Libraries loaded in the meantime stay loaded on rollback.
+        """
+        dead = {STACK_ADDRESS, SCRATCH_ADDRESS, RETURN_ADDRESS}
+        dead.update(address for address, _ in self._import_regions)
+
+        memory = []
+        for begin, end, perms in self._uc.mem_regions():
+            if not perms & UC_PROT_WRITE or begin in dead:
+                continue
+            heap = self._heap_of(begin)
+            size = min(end + 1, heap.top if heap is not None else end + 1) - begin
+            if size > 0:
+                memory.append((begin, self.mem_read(begin, size)))
+
+        return VMCheckpoint(
+            context=self._uc.context_save(),
+            memory=tuple(memory),
+            allocators=(self._malloc_allocator.copy(), self._temp_allocator.copy()),
+            errno_address=self._errno_address,
+        )
+
+    def rollback(self, checkpoint: VMCheckpoint) -> None:
+        self._uc.context_restore(checkpoint.context)
+        for address, data in checkpoint.memory:
+            self.mem_write(address, data)
+        self._malloc_allocator, self._temp_allocator = (allocator.copy() for allocator in checkpoint.allocators)
+        if self._leak_tracker is not None:
+            self._leak_tracker.retain(self._malloc_allocator.is_allocated)
+        self._errno_address = checkpoint.errno_address
+        self._scratch_top = SCRATCH_ADDRESS
+        self._interrupted = False
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator[None]:
+        """
+        Hold the VM lock for the body, and roll guest state back to what it was on entry if the body raises.
+
+        Rolling back keeps the VM usable after a failed call.
+        """
+        with self._lock:
+            if not self._options.transactions:
+                yield
+                return
+
+            checkpoint = self.checkpoint()
+            try:
+                yield
+            except BaseException:
+                logger.warning("Guest call failed, rolling back VM state")
+                self.rollback(checkpoint)
+                raise
+
+    def _map_shared(self, address: int, size: int, perms: int, buffer: mmap.mmap, offset: int) -> None:
+        ptr = ctypes.addressof(ctypes.c_char.from_buffer(buffer, offset))
+        self._uc.mem_map_ptr(address, size, perms, ptr)
+        self._shared_regions.append((address, size, perms, buffer, offset))
+
+    def _map_image(self, image: LibraryImage) -> None:
+        for address, size, offset, perms in image.segments:
+            logger.debug("Mapping image at 0x%X-0x%X", address, address + size - 1)
+            if self._options.share_images and not perms & UC_PROT_WRITE:
+                self._map_shared(address, size, perms, image.buffer, offset)
+            else:
+                # writable data is private to every VM
+                self._uc.mem_map(address, size, UC_PROT_ALL)
+                self.mem_write(address, image.buffer[offset : offset + size])
+
+    @staticmethod
+    def _build_images(library: Library, elf_data: bytes) -> list[tuple[int, int, bytearray]]:
+        # Each PT_LOAD segment is built exactly once in a zero-filled host buffer
+        images = []
+        elf_view = memoryview(elf_data)
+        for segment in library.elf.iter_segments():
+            if segment["p_type"] != "PT_LOAD":
+                logger.debug("- Skipping %s", segment.__dict__)
+                continue
+
+            address = library.base + segment["p_vaddr"]
+            alignment = segment["p_align"]
+
+            # Align the start and end
+            address_start = address & ~(alignment - 1)
+            address_end = (address + segment["p_memsz"] + alignment - 1) & ~(alignment - 1)
+
+            logger.debug(
+                "Mapping at 0x%X-0x%X (0x%X-0x%X); bytes 0x%X",
+                address_start,
+                address_end,
+                address,
+                address_end - 1,
+                address_end - address,
+            )
+
+            data_offset = segment["p_offset"]
+            data_size = segment["p_filesz"]
+            image_offset = address - address_start
+
+            perms = UC_PROT_ALL if segment["p_flags"] & P_FLAGS.PF_W else UC_PROT_READ | UC_PROT_EXEC
+
+            image = bytearray(address_end - address_start)
+            image[image_offset : image_offset + data_size] = elf_view[data_offset : data_offset + data_size]
+            images.append((address_start, perms, image))
+
+        return images
+
+    @staticmethod
+    def _relocate_images(library: Library, images: list[tuple[int, int, bytearray]]) -> None:
+        symbol_addresses = [library.base + value for _, _, value in library.raw_symbols()]
+        for symbol_index, address in library.symbols.items():
+            symbol_addresses[symbol_index] = address
+
+        relocations = library.raw_relocations(".rela.dyn") + library.raw_relocations(".rela.plt")
+        logger.debug("Applying %d relocations to %s", len(relocations), library.name)
+
+        # Patch through 64-bit views of the images where possible, which avoids packing every value
+        images.sort(key=lambda item: item[0])
+        starts = [start for start, _, _ in images]
+        ends = [start + len(image) for start, _, image in images]
+        views = [memoryview(image).cast("Q") if sys.byteorder == "little" else None for _, _, image in images]
+
+        for r_offset, info_type, symbol_index, addend in relocations:
+            address = library.base + r_offset
+
+            if info_type in (R_AARCH64_ABS64, R_AARCH64_GLOB_DAT, R_X86_64_64, R_X86_64_GLOB_DAT):
+                value = symbol_addresses[symbol_index] + addend
+            elif info_type in (R_AARCH64_JUMP_SLOT, R_X86_64_JUMP_SLOT):
+                value = symbol_addresses[symbol_index]
+            elif info_type in (R_AARCH64_RELATIVE, R_X86_64_RELATIVE):
+                value = library.base + addend
             else:
                 msg = "Invalid reloc info type: %d"
                 raise RuntimeError(msg, info_type)
 
+            i = bisect.bisect_right(starts, address) - 1
+            if i < 0 or address + 8 > ends[i]:
+                msg = "Relocation outside of loaded segments: 0x%X"
+                raise RuntimeError(msg, address)
+
+            offset = address - starts[i]
+            view = views[i]
+            if view is not None and offset % 8 == 0:
+                view[offset // 8] = value & 0xFFFFFFFFFFFFFFFF
+            else:
+                _U64.pack_into(images[i][2], offset, value & 0xFFFFFFFFFFFFFFFF)
+
+        for view in views:
+            if view is not None:
+                view.release()
+
     def load_library(self, name: str) -> Library:
         if name in self._loaded_libs:
             return self._loaded_libs[name]
 
         library_index = len(self._loaded_libs)
+        import_address = _import_region_address(library_index)
         with self._lib_store.open_library(name) as f:
             elf_data = f.read()
             # Construct ELF from an in-memory buffer to avoid lifecycle issues of the context-managed stream
             elf = ELFFile(_io.BytesIO(elf_data))
 
-        chosen_base = self._lib_allocator.alloc(0x10000000)[0]
+        reserve = self._layout.library_reserve
+        span = max(
+            (
+                segment["p_vaddr"] + segment["p_memsz"]
+                for segment in elf.iter_segments()
+                if segment["p_type"] == "PT_LOAD"
+            ),
+            default=0,
+        )
+        if span > reserve:
+            msg = f"Library {name} needs 0x{span:X} bytes of address space, but the layout reserves 0x{reserve:X}"
+            raise RuntimeError(msg)
+        chosen_base = self._lib_allocator.alloc(reserve)[0]
 
         library = Library(name, elf, chosen_base, library_index)
+        slot_size = self._options.import_slot_size
+        raw_symbols = library.raw_symbols()
+        import_names = library.import_names()
+        self._map_import_region(import_address, len(raw_symbols), import_names)
+
+        layout = (library.base, import_address, slot_size)
+        digest = self._lib_store.library_digest(name)
+        with _shared_images_lock:
+            image = _shared_images.get((digest, layout))
+            if image is None:
+                image = _shared_images[digest, layout] = self._load_image(library, elf_data, digest, layout)
+
+        self._images.append(image)
+        library.symbols.update(image.symbols)
+        self._map_image(image)
+        self._register_library(library, import_names)
 
-        # Stub all imports
-        section = library.elf.get_section_by_name(".dynsym")
-        assert isinstance(section, SymbolTableSection)
-        num_symbols = section.num_symbols()
-        for i in range(num_symbols):
-            sym = section.get_symbol(i)
-            # print(sym.name)
-
-            # print(sym.__dict__)
-            # print(sym['st_shndx'])
-            if sym["st_shndx"] == "SHN_UNDEF":
-                library.symbols[i] = IMPORT_ADDRESS + library.index * 0x01000000 + i * 4
-                # print("Registering 0x%X: %s" % (library.symbols[i], sym.name))
-
-                # print("%s: 0x%X" % (sym.name, resolveSymbolByIndex(library, i)))
-
-        for segment in library.elf.iter_segments():
-            address = library.base + segment["p_vaddr"]
-            size = segment["p_memsz"]
+        return library
 
-            address_start = address
-            address_end = address + size
+    def _load_image(
+        self,
+        library: Library,
+        elf_data: bytes,
+        digest: str,
+        layout: tuple[int, int, int],
+    ) -> LibraryImage:
+        image_cache = self._options.image_cache
+        image = image_cache.load(digest, layout) if image_cache is not None else None
+        if image is not None:
+            return image
 
-            alignment = segment["p_align"]
+        # Stub all imports
+        _, import_address, slot_size = layout
+        for i, (_, st_shndx, _) in enumerate(library.raw_symbols()):
+            if st_shndx == SHN_UNDEF:
+                library.symbols[i] = import_address + i * slot_size
+
+        images = self._build_images(library, elf_data)
+        self._relocate_images(library, images)
+
+        segments = [(address, perms, bytes(image)) for address, perms, image in images]
+        if image_cache is not None:
+            image_cache.store(digest, layout, segments, library.symbols)
+
+        return LibraryImage.from_segments(segments, library.symbols)
+
+    def _map_import_region(self, address: int, count: int, import_names: dict[int, str]) -> None:
+        # One stub slot for every dynamic symbol, so a slot can be found from the symbol index
+        slot_size = self._options.import_slot_size
+        slots = bytearray(
+            # SVC immediates only hold 16 bits, but the stub is looked up by address anyway
+            b"".join(_svc(i) + _RET for i in range(count)) if self._options.trap_stubs else _RET * count,
+        )
 
-            # Align the start
-            address_start &= ~(alignment - 1)
+        # Guest routines go right after the slots, and their slots branch there instead of trapping
+        routines = bytearray()
+        routine_addresses = {}
+        for name in sorted(self._options.active_guest_routines & set(import_names.values())):
+            routine_addresses[name] = address + len(slots) + len(routines)
+            routines += GUEST_ROUTINES[name]
+        for symbol_index, name in import_names.items():
+            if name in routine_addresses:
+                slot_address = address + symbol_index * slot_size
+                slots[symbol_index * slot_size : symbol_index * slot_size + 4] = branch(
+                    slot_address,
+                    routine_addresses[name],
+                )
 
-            # Align the end
-            address_end += alignment - 1
-            address_end &= ~(alignment - 1)
+        data = bytes(slots + routines)
+        size = (len(data) + PAGE_SIZE - 1) & ~(PAGE_SIZE - 1)
+        if size > IMPORT_STRIDE:
+            msg = f"Import stubs need 0x{size:X} bytes, but only 0x{IMPORT_STRIDE:X} are reserved per library"
+            raise RuntimeError(msg)
 
-            # Fix size for new alignment
-            size = address_end - address
+        logger.debug("Mapping import stubs at 0x%X-0x%X", address, address + size - 1)
+        self._uc.mem_map(address, size)
+        self.mem_write(address, data)
+        self._import_regions.append((address, size))
 
-            data_offset = segment["p_offset"]
-            data_size = segment["p_filesz"]
-            padding_before_size = address - address_start
-            padding_after_size = size - data_size
+        if not self._options.trap_stubs:
+            self._hook_import_region(address, size)
 
-            logger.debug(
-                "Mapping at 0x%X-0x%X (0x%X-0x%X); bytes 0x%X",
-                address_start,
-                address_end,
-                address,
-                address + size - 1,
-                size,
-            )
+    def _register_library(self, library: Library, import_names: dict[int, str]) -> None:
+        # Bind every import to its handler now, so hitting a stub doesn't need to look at the ELF
+        guest_routines = self._options.active_guest_routines
+        for symbol_index, name in import_names.items():
+            if name not in guest_routines:
+                self._stubs[library.symbols[symbol_index]] = (name, get_stub_handler(name))
 
-            if segment["p_type"] == "PT_LOAD":
-                data = (
-                    b"\x00" * padding_before_size
-                    + elf_data[data_offset : data_offset + data_size]
-                    + b"\x00" * padding_after_size
-                )
-                self._uc.mem_map(address_start, len(data))
-                self.mem_write(address_start, data)
-            else:
-                logger.debug("- Skipping %s", segment.__dict__)
+        self._loaded_libs[library.name] = library
+        self._libraries.append(library)
 
-        self.relocate_section(library, ".rela.dyn", library.base)
-        self.relocate_section(library, ".rela.plt", library.base)
+    def get_library(self, index: int) -> Library:
+        return self._libraries[index]
 
-        self._loaded_libs[name] = library
+    def get_stub(self, address: int) -> Callable[[HookContext], None]:
+        stub = self._stubs.get(address)
+        if stub is None:
+            msg = f"No import stub at 0x{address:X}"
+            raise RuntimeError(msg)
+        return stub[1]
 
-        return library
+    @property
+    def leak_tracker(self) -> LeakTracker | None:
+        return self._leak_tracker
 
-    def get_library(self, index: int) -> Library:
-        return list(self._loaded_libs.values())[index]
+    @property
+    def entry_address(self) -> int:
+        """Function that the current or last call through :meth:`invoke_cdecl` started at."""
+        return self._entry_address
+
+    def set_leak_tracking(self, enabled: bool) -> None:
+        """Start tracking ``malloc`` call sites from now on, or stop and forget about them."""
+        with self._lock:
+            if not enabled:
+                self._leak_tracker = None
+            elif self._leak_tracker is None:
+                self._leak_tracker = LeakTracker()
+
+    def leak_report(self) -> LeakReport | None:
+        with self._lock:
+            if self._leak_tracker is None:
+                return None
+            return self._leak_tracker.report(self.symbolize, self._entry_name)
+
+    def call_stub(self, address: int) -> None:
+        recorder = self._stub_recorder
+        if recorder is None:
+            self.get_stub(address)(self._hook_ctx)
+            return
+
+        handler = self.get_stub(address)
+        start = time.perf_counter_ns()
+        try:
+            handler(self._hook_ctx)
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            recorder.record(self._entry_name(self._entry_address), self._stubs[address][0], elapsed)
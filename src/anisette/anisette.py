@@ -5,26 +5,40 @@ from __future__ import annotations
 import base64
 import locale
 import logging
-from contextlib import ExitStack
+import threading
+import weakref
+from contextlib import ExitStack, contextmanager
 from ctypes import c_ulonglong
 from datetime import datetime
 from typing import TYPE_CHECKING, BinaryIO, TypedDict
 
 from typing_extensions import Self
 
-from ._ani_provider import AnisetteProvider
+from ._ani_provider import AnisetteProvider, RecyclePolicy
 from ._fs import FSCollection
+from ._image_cache import LibraryImageCache
 from ._library import LibraryStore
+from ._otp_pool import OTPPool
+from ._profiler import GuestProfiler, StubRecorder
+from ._routines import GUEST_ROUTINES
 from ._util import open_file
+from ._vm import Backend, CallBudget, MemoryProfile, TraceLevel, VMOptions
 
 if TYPE_CHECKING:
+    from collections.abc import Iterator
     from pathlib import Path
 
+    from ._allocator import AllocatorStats
     from ._device import AnisetteDeviceConfig
+    from ._profiler import LeakReport, StubStats
+    from ._vm import CallStats
 
 
 DEFAULT_LIBS_URL = "https://anisette.dl.mikealmel.ooo/libs?arch=arm64-v8a"
 
+# DSID used when none is given
+DEFAULT_DS_ID = c_ulonglong(-2).value
+
 logger = logging.getLogger(__name__)
 
 
@@ -45,6 +59,35 @@ AnisetteHeaders = TypedDict(
 )
 
 
+def _get_vm_options(  # noqa: PLR0913
+    cache_dir: str | Path | None,
+    trace_level: TraceLevel,
+    call_budget: CallBudget | None,
+    memory_profile: MemoryProfile,
+    transactions: bool,
+    *,
+    backend: Backend,
+) -> VMOptions:
+    debug_trace = trace_level in (TraceLevel.BLOCK, TraceLevel.INSTRUCTION)
+    return VMOptions(
+        image_cache=LibraryImageCache(cache_dir) if cache_dir is not None else None,
+        trace_level=trace_level,
+        # when debugging, run every libc helper through its Python implementation so each call shows up in the log
+        guest_routines=frozenset() if debug_trace else frozenset(GUEST_ROUTINES),
+        call_budget=call_budget or CallBudget(),
+        layout=memory_profile.layout,
+        transactions=transactions,
+        backend=backend,
+    )
+
+
+def _check_ds_id(ds_id: int) -> int:
+    if not 0 <= ds_id <= c_ulonglong(-1).value:
+        msg = f"DSID out of range: {ds_id}"
+        raise ValueError(msg)
+    return ds_id
+
+
 def _get_libs(file: BinaryIO | str | Path | None = None) -> LibraryStore:
     file = file or DEFAULT_LIBS_URL
 
@@ -61,6 +104,9 @@ class Anisette:
 
     This class should not be instantiated directly through its __init__ method.
     Instead, you should use :meth:`Anisette.init` or :meth:`Anisette.load` depending on your use case.
+
+    A session can be provisioned for several DSIDs, which then share the same emulated device.
+    Methods that take a ``ds_id`` use the default DSID if it is not given.
     """
 
     def __init__(self, ani_provider: AnisetteProvider) -> None:
@@ -70,19 +116,142 @@ class Anisette:
         :meta private:
         """
         self._ani_provider = ani_provider
+        # so concurrent first requests don't both provision the device
+        self._provision_lock = threading.Lock()
 
-        self._ds_id = c_ulonglong(-2).value
+        self._otp_pool: OTPPool[AnisetteHeaders] | None = None
+        # closes the pool when the session goes away, the producer thread only holds a weak reference to it
+        self._otp_pool_finalizer: weakref.finalize | None = None
 
     @property
     def is_provisioned(self) -> bool:
-        """Whether this Anisette session has been provisioned yet or not."""
-        return self._ani_provider.adi.is_machine_provisioned(self._ds_id)
+        """Whether this Anisette session has been provisioned yet or not, for the default DSID."""
+        return self.is_provisioned_for(DEFAULT_DS_ID)
+
+    def is_provisioned_for(self, ds_id: int) -> bool:
+        """
+        Whether this Anisette session has been provisioned yet or not, for a specific DSID.
+
+        :param ds_id: The DSID to check.
+        :type ds_id: int
+        :return: True if the DSID has been provisioned.
+        :rtype: bool
+        """
+        return self._ani_provider.adi.is_machine_provisioned(_check_ds_id(ds_id))
+
+    @property
+    def provisioned_ds_ids(self) -> list[int]:
+        """
+        The DSIDs this session has been provisioned for, in the order they were provisioned.
+
+        These are saved along with the provisioning data.
+        """
+        return self._ani_provider.device.provisioned_ds_ids
+
+    @property
+    def allocator_stats(self) -> dict[str, AllocatorStats]:
+        """
+        Memory usage statistics of the emulated device, for monitoring.
+
+        Maps each guest memory region ("temp", "malloc" and "lib") to its allocator statistics.
+        Empty if the VM has not been started yet.
+        """
+        return self._ani_provider.allocator_stats
+
+    @property
+    def call_stats(self) -> dict[str, CallStats]:
+        """
+        Statistics of the calls made into the emulated ADI library, by entry point.
+
+        Instruction counts are only collected with a ``trace_level`` of :attr:`TraceLevel.COUNT` or above.
+        They are stable between runs, which makes them a cheap signal for performance regressions.
+        Statistics are reset whenever the VM is replaced.
+        """
+        return self._ani_provider.call_stats
+
+    @property
+    def stub_stats(self) -> dict[str, dict[str, StubStats]]:
+        """
+        Calls into the host made by the emulated library, by ADI entry point and import stub.
+
+        Every stub call crosses the boundary between emulator and Python, so these show which imports are
+        worth optimizing. Empty unless enabled with :meth:`Anisette.enable_stub_stats`.
+        """
+        recorder = self._ani_provider.stub_recorder
+        return recorder.stats if recorder is not None else {}
+
+    def enable_stub_stats(self, enabled: bool = True) -> None:
+        """
+        Start or stop recording :attr:`Anisette.stub_stats`.
+
+        Recording adds a little overhead to every stub call. Stopping discards the statistics.
+
+        :param enabled: Whether to record stub calls.
+        :type enabled: bool
+        """
+        if not enabled:
+            self._ani_provider.stub_recorder = None
+        elif self._ani_provider.stub_recorder is None:
+            self._ani_provider.stub_recorder = StubRecorder()
+
+    def reset_stub_stats(self) -> None:
+        """Clear :attr:`Anisette.stub_stats`, and keep recording if enabled."""
+        recorder = self._ani_provider.stub_recorder
+        if recorder is not None:
+            recorder.reset()
+
+    def enable_leak_tracking(self, enabled: bool = True) -> None:
+        """
+        Start or stop remembering where the emulated library allocates memory that it doesn't free.
+
+        Only allocations made from now on are tracked. Stopping discards what was tracked so far.
+
+        :param enabled: Whether to track allocations.
+        :type enabled: bool
+        """
+        self._ani_provider.leak_tracking = enabled
+
+    @property
+    def leak_report(self) -> LeakReport | None:
+        """
+        Guest memory that is still allocated, by call site, or ``None`` if leak tracking is not enabled.
+
+        The report covers the current VM only. It starts over when the VM is replaced because it ran low on memory.
+        """
+        return self._ani_provider.leak_report
+
+    @contextmanager
+    def profile(self, profiler: GuestProfiler | None = None) -> Iterator[GuestProfiler]:
+        """
+        Sample where the emulated library spends its time while the ``with`` block runs.
+
+        Samples are grouped by ADI entry point. Write them out with :meth:`GuestProfiler.write_collapsed`
+        to get a flamegraph.
+
+        :param profiler: Profiler to add samples to, a new one with default settings if not provided.
+        :type profiler: GuestProfiler, None
+        :return: A context manager that yields the profiler.
+        """
+        profiler = profiler or GuestProfiler()
+        self._ani_provider.profiler = profiler
+        try:
+            yield profiler
+        finally:
+            self._ani_provider.profiler = None
 
     @classmethod
-    def init(
+    def init(  # noqa: PLR0913
         cls,
         file: BinaryIO | str | Path | None = None,
         default_device_config: AnisetteDeviceConfig | None = None,
+        cache_dir: str | Path | None = None,
+        trace_level: TraceLevel = TraceLevel.OFF,
+        recycle_threshold: float = RecyclePolicy.soft_threshold,
+        *,
+        call_budget: CallBudget | None = None,
+        memory_profile: MemoryProfile = MemoryProfile.DEFAULT,
+        transactions: bool = False,
+        backend: Backend = Backend.UNICORN,
     ) -> Self:
         """
         Initialize a new Anisette session from an Apple Music APK or Anisette.py library file.
@@ -92,6 +261,34 @@ class Anisette:
 
         :param file: A file, path or URL to a library file or Apple Music APK.
         :type file: BinaryIO, str, Path, None
+        :param cache_dir: Optional directory to cache relocated library images in. Speeds up VM startup
+                          in later processes. The directory may be shared between sessions.
+        :type cache_dir: str, Path, None
+        :param trace_level: Debug tracing of emulated code. Anything other than :attr:`TraceLevel.OFF`
+                            is very slow and only useful for debugging. :attr:`TraceLevel.BLOCK` and above
+                            also handle all imported libc functions in Python, instead of in emulated code.
+        :type trace_level: TraceLevel
+        :param recycle_threshold: Fraction of VM memory in use at which a fresh VM is prepared in the background,
+                                  to replace the current one before it runs out of memory. Must be above 0
+                                  and below 0.5, the usage at which the VM is replaced right away.
+        :type recycle_threshold: float
+        :param call_budget: Time and instruction limits on the calls into the emulated library that every request
+                            makes, to check provisioning and generate OTPs. Starting the library and provisioning
+                            are not limited. A call that exceeds the budget raises :class:`CallBudgetExceededError`.
+                            The session stays usable: the emulated device is rolled back if ``transactions``
+                            is enabled, and replaced otherwise.
+        :type call_budget: CallBudget, None
+        :param memory_profile: Sizes of the emulated device's memory regions. :attr:`MemoryProfile.COMPACT`
+                               fits more sessions on a host, at the cost of replacing the VM more often.
+        :type memory_profile: MemoryProfile
+        :param transactions: Save the emulated device's memory before every call into the ADI library, and restore
+                             it if the call fails, so a failed call leaves no trace. Each call then has to copy
+                             all memory in use, which makes it noticeably slower.
+        :type transactions: bool
+        :param backend: How the library is run. :attr:`Backend.NATIVE` runs it directly on arm64 Linux hosts,
+                        which is much faster but does not isolate it from this process. Other hosts, tracing
+                        and call budgets fall back to the emulator.
+        :type backend: Backend
         :return: An instance of :class:`Anisette`.
         :rtype: :class:`Anisette`
         """
@@ -99,11 +296,24 @@ class Anisette:
             FSCollection(),
             lambda: _get_libs(file),
             default_device_config,
+            _get_vm_options(cache_dir, trace_level, call_budget, memory_profile, transactions, backend=backend),
+            RecyclePolicy(soft_threshold=recycle_threshold),
         )
         return cls(ani_provider)
 
     @classmethod
-    def load(cls, *files: BinaryIO | str | Path, default_device_config: AnisetteDeviceConfig | None = None) -> Self:
+    def load(  # noqa: PLR0913
+        cls,
+        *files: BinaryIO | str | Path,
+        default_device_config: AnisetteDeviceConfig | None = None,
+        cache_dir: str | Path | None = None,
+        trace_level: TraceLevel = TraceLevel.OFF,
+        recycle_threshold: float = RecyclePolicy.soft_threshold,
+        call_budget: CallBudget | None = None,
+        memory_profile: MemoryProfile = MemoryProfile.DEFAULT,
+        transactions: bool = False,
+        backend: Backend = Backend.UNICORN,
+    ) -> Self:
         """
         Load a previously-initialized Anisette session.
 
@@ -112,6 +322,20 @@ class Anisette:
 
         :param files: File objects or paths that together form the provider's virtual file system.
         :type files: BinaryIO, str, Path
+        :param cache_dir: Optional directory to cache relocated library images in. See :meth:`Anisette.init`.
+        :type cache_dir: str, Path, None
+        :param trace_level: Debug tracing of emulated code. See :meth:`Anisette.init`.
+        :type trace_level: TraceLevel
+        :param recycle_threshold: Memory usage at which the VM is replaced in the background. See :meth:`Anisette.init`.
+        :type recycle_threshold: float
+        :param call_budget: Limits on the calls into the emulated library made per request. See :meth:`Anisette.init`.
+        :type call_budget: CallBudget, None
+        :param memory_profile: Sizes of the emulated device's memory regions. See :meth:`Anisette.init`.
+        :type memory_profile: MemoryProfile
+        :param transactions: Undo failed calls into the ADI library. See :meth:`Anisette.init`.
+        :type transactions: bool
+        :param backend: How the library is run. See :meth:`Anisette.init`.
+        :type backend: Backend
         :return: An instance of :class:`Anisette`.
         :rtype: :class:`Anisette`
         """
@@ -121,6 +345,15 @@ class Anisette:
                 *file_objs,
                 fs_fallback=lambda: _get_libs(),
                 default_device_config=default_device_config,
+                vm_options=_get_vm_options(
+                    cache_dir,
+                    trace_level,
+                    call_budget,
+                    memory_profile,
+                    transactions,
+                    backend=backend,
+                ),
+                recycle_policy=RecyclePolicy(soft_threshold=recycle_threshold),
             )
 
         return cls(ani_provider)
@@ -141,7 +374,8 @@ class Anisette:
         :param file: The file or path to save provisioning data to.
         :type file: BinaryIO, str, Path
         """
-        self.provision()
+        if not self.provisioned_ds_ids:
+            self.provision()
 
         with open_file(file, "wb+") as f:
             self._ani_provider.save(f, exclude=["libs"])
@@ -186,36 +420,101 @@ class Anisette:
         with open_file(file, "wb+") as f:
             self._ani_provider.save(f)
 
-    def provision(self) -> None:
+    def provision(self, ds_id: int = DEFAULT_DS_ID) -> None:
         """
         Provision the virtual device, if it has not been provisioned yet.
 
         In most cases it is not necessary to manually use this method, since :meth:`Anisette.get_data`
         will call it implicitly.
+
+        :param ds_id: The DSID to provision for.
+        :type ds_id: int
         """
-        if not self.is_provisioned:
-            logger.info("Provisioning...")
-            self._ani_provider.provisioning_session.provision(self._ds_id)
+        with self._provision_lock:
+            if not self.is_provisioned_for(ds_id):
+                logger.info("Provisioning DSID %d...", ds_id)
+                self._ani_provider.provisioning_session.provision(ds_id)
+            self._ani_provider.device.add_provisioned_ds_id(ds_id)
 
-    def get_data(self) -> AnisetteHeaders:
+    def enable_otp_pool(self, enabled: bool = True, size: int = 4, max_age: float = 30.0) -> None:
+        """
+        Start or stop generating Anisette headers ahead of time in a background thread.
+
+        With the pool enabled, :meth:`Anisette.get_data` returns pre-generated headers right away while the pool has
+        fresh ones, and only generates headers itself when the pool has run dry. The pool holds at most as many
+        entries as there were requests during the last ``max_age`` seconds, so it adapts to demand and stops
+        generating when the session is idle.
+
+        :param enabled: Whether to use the pool.
+        :type enabled: bool
+        :param size: Maximum number of header sets to keep ready.
+        :type size: int
+        :param max_age: Time in seconds after which a pre-generated header set is thrown away unused.
+        :type max_age: float
+        """
+        if self._otp_pool_finalizer is not None:
+            # closes the current pool
+            self._otp_pool_finalizer()
+            self._otp_pool = self._otp_pool_finalizer = None
+        if enabled:
+            pool: OTPPool[AnisetteHeaders] = OTPPool(weakref.WeakMethod(self.get_data_batch), size, max_age)
+            self._otp_pool = pool
+            self._otp_pool_finalizer = weakref.finalize(self, pool.close)
+
+    def get_data(self, ds_id: int = DEFAULT_DS_ID) -> AnisetteHeaders:
         """
         Obtain Anisette headers for this session.
 
+        :param ds_id: The DSID to generate headers for. The OTP pool only serves the default DSID.
+        :type ds_id: int
         :return: Anisette headers that may be used for authentication purposes.
         """
-        self.provision()
-        otp = self._ani_provider.adi.request_otp(self._ds_id)
+        pool = self._otp_pool
+        if pool is not None and ds_id == DEFAULT_DS_ID:
+            headers = pool.take()
+            if headers is not None:
+                return headers
+        return self.get_data_batch(1, ds_id)[0]
+
+    def get_data_batch(self, count: int, ds_id: int = DEFAULT_DS_ID) -> list[AnisetteHeaders]:
+        """
+        Obtain several sets of Anisette headers for this session at once.
+
+        This is cheaper than calling :meth:`Anisette.get_data` repeatedly: the provisioning check runs once,
+        and all OTPs are generated back to back without other threads getting in between.
+
+        :param count: Number of header sets to generate.
+        :type count: int
+        :param ds_id: The DSID to generate headers for.
+        :type ds_id: int
+        :return: A list of Anisette headers that may each be used for authentication purposes.
+        """
+        if count < 1:
+            msg = f"Invalid batch size: {count}"
+            raise ValueError(msg)
+
+        self.provision(ds_id)
+        otps = self._ani_provider.adi.request_otp_batch(ds_id, count)
         device = self._ani_provider.device
 
-        return {
-            "X-Apple-I-Client-Time": datetime.now().astimezone().replace(microsecond=0).isoformat() + "Z",
-            "X-Apple-I-MD": base64.b64encode(bytes(otp.otp)).decode(),
-            "X-Apple-I-MD-LU": base64.b64encode(str(device.local_user_uuid).encode()).decode(),
-            "X-Apple-I-MD-M": base64.b64encode(bytes(otp.machine_id)).decode(),
-            "X-Apple-I-MD-RINFO": "17106176",
-            "X-Apple-I-SRL-NO": "0",
-            "X-Apple-I-TimeZone": str(datetime.now().astimezone().tzinfo),
-            "X-Apple-Locale": locale.getlocale()[0] or "en_US",
-            "X-MMe-Client-Info": device.server_friendly_description,
-            "X-Mme-Device-Id": device.unique_device_identifier,
-        }
+        now = datetime.now().astimezone()
+        client_time = now.replace(microsecond=0).isoformat() + "Z"
+        local_user = base64.b64encode(str(device.local_user_uuid).encode()).decode()
+        time_zone = str(now.tzinfo)
+        user_locale = locale.getlocale()[0] or "en_US"
+
+        return [
+            {
+                "X-Apple-I-Client-Time": client_time,
+                "X-Apple-I-MD": base64.b64encode(bytes(otp.otp)).decode(),
+                "X-Apple-I-MD-LU": local_user,
+                "X-Apple-I-MD-M": base64.b64encode(bytes(otp.machine_id)).decode(),
+                "X-Apple-I-MD-RINFO": "17106176",
+                "X-Apple-I-SRL-NO": "0",
+                "X-Apple-I-TimeZone": time_zone,
+                "X-Apple-Locale": user_locale,
+                "X-MMe-Client-Info": device.server_friendly_description,
+                "X-Mme-Device-Id": device.unique_device_identifier,
+            }
+            for otp in otps
+        ]
@@ -18,7 +18,7 @@ except ImportError:
     msg = "Failed to find CLI dependencies. Install the 'anisette[cli]' package if you require CLI support."
     raise ImportError(msg) from None
 
-from ._util import get_config_dir
+from ._util import get_cache_dir, get_config_dir
 from .anisette import Anisette
 
 if TYPE_CHECKING:
@@ -58,6 +58,10 @@ class _SessionManager:
             return None
         return self.config_dir / "libs.bin"
 
+    @property
+    def cache_dir(self) -> Path | None:
+        return get_cache_dir("anisette-py")
+
     def _get_prov_path(self, name: str) -> Path:
         assert self.config_dir is not None
 
@@ -90,10 +94,10 @@ class _SessionManager:
             raise _AniError(msg)
 
         if not self.libs_path.exists():
-            session = Anisette.init()
+            session = Anisette.init(cache_dir=self.cache_dir)
             session.save_libs(self.libs_path)
         else:
-            session = Anisette.init(self.libs_path)
+            session = Anisette.init(self.libs_path, cache_dir=self.cache_dir)
         self.save(session, name)
 
         return session
@@ -116,7 +120,7 @@ class _SessionManager:
             msg = f"Session with name '{name}' does not exist"
             raise _AniError(msg)
 
-        return Anisette.load(self.libs_path, prov_path)
+        return Anisette.load(self.libs_path, prov_path, cache_dir=self.cache_dir)
 
     def list(self) -> list[str]:
         assert self.config_dir is not None
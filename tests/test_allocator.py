@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import random
+
+import pytest
+
+from anisette._allocator import Allocator
+
+_BASE = 0x10000000
+_SIZE = 0x10000
+
+
+def test_alloc_free():
+    allocator = Allocator(_BASE, _SIZE)
+
+    address, length = allocator.alloc(1)
+    assert address == _BASE
+    assert length == 0x100
+    assert allocator.is_allocated(address)
+
+    second, _ = allocator.alloc(0x101)
+    assert second == _BASE + 0x100
+    assert allocator.alloc_size == 0x300
+
+    allocator.free(address)
+    assert not allocator.is_allocated(address)
+    assert allocator.alloc_size == 0x200
+
+    stats = allocator.stats
+    assert stats.live_allocations == 1
+    assert stats.alloc_calls == 2
+    assert stats.free_calls == 1
+    assert stats.high_water_mark == 0x300
+
+
+def test_free_unknown_address_is_ignored():
+    allocator = Allocator(_BASE, _SIZE)
+    allocator.alloc(0x100)
+
+    allocator.free(_BASE + 0x100)
+    assert allocator.stats.free_calls == 0
+    assert allocator.alloc_size == 0x100
+
+
+def test_coalescing():
+    allocator = Allocator(_BASE, _SIZE)
+    addresses = [allocator.alloc(0x100)[0] for _ in range(4)]
+
+    # free the outer blocks first, then the ones in between, which must merge with both neighbours
+    for i in (0, 2, 1, 3):
+        allocator.free(addresses[i])
+
+    stats = allocator.stats
+    assert stats.free_blocks == 1
+    assert stats.largest_free_block == _SIZE
+    assert allocator.top == _BASE
+
+    # the whole region is usable as one block again
+    assert allocator.alloc(_SIZE) == (_BASE, _SIZE)
+
+
+def test_exhaustion():
+    allocator = Allocator(_BASE, _SIZE)
+    addresses = [allocator.alloc(0x1000)[0] for _ in range(_SIZE // 0x1000)]
+    assert allocator.stats.usage == 1.0
+
+    with pytest.raises(RuntimeError, match="allocator is full"):
+        allocator.alloc(1)
+
+    # a free block in the middle is reused, but a larger request still fails
+    allocator.free(addresses[5])
+    assert allocator.alloc(0x1000)[0] == addresses[5]
+    allocator.free(addresses[5])
+    with pytest.raises(RuntimeError, match="allocator is full"):
+        allocator.alloc(0x1001)
+
+
+def test_copy():
+    allocator = Allocator(_BASE, _SIZE)
+    address, _ = allocator.alloc(0x100)
+    allocator.alloc(0x100)
+
+    clone = allocator.copy()
+    assert clone.stats == allocator.stats
+
+    # the copy and the original don't share any state
+    clone.free(address)
+    clone.alloc(0x1000)
+    assert allocator.is_allocated(address)
+    assert allocator.alloc_size == 0x200
+    assert clone.alloc_size == 0x1100
+    assert allocator.alloc(0x100)[0] == _BASE + 0x200
+
+
+def test_random_operations():
+    allocator = Allocator(_BASE, _SIZE)
+    rng = random.Random(0)  # noqa: S311
+    live: dict[int, int] = {}
+
+    for _ in range(2000):
+        if live and (rng.random() < 0.5 or allocator.stats.largest_free_block < 0x800):
+            address = rng.choice(list(live))
+            allocator.free(address)
+            del live[address]
+        else:
+            address, length = allocator.alloc(rng.randrange(1, 0x800))
+            # blocks never overlap each other or leave the region
+            assert address >= _BASE
+            assert address + length <= _BASE + _SIZE
+            assert all(address + length <= other or other + size <= address for other, size in live.items())
+            live[address] = length
+
+        assert allocator.alloc_size == sum(live.values())
+
+    for address in live:
+        allocator.free(address)
+    assert allocator.stats.free_blocks == 1
@@ -1,6 +1,18 @@
 from __future__ import annotations
 
-from anisette import Anisette
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+
+import pytest
+
+from anisette import Anisette, CallBudget, CallBudgetExceededError, GuestProfiler, MemoryProfile, TraceLevel
+from anisette._adi import ADI
+from anisette._arch import Architecture
+from anisette._fs import VirtualFileSystem
+from anisette._routines import GUEST_ROUTINES
+from anisette._vm import VM, VMOptions
+from anisette.anisette import DEFAULT_DS_ID
 
 
 def test_init_save():
@@ -15,3 +27,325 @@ def test_load():
     ani = Anisette.load("bundle.bin")
 
     assert isinstance(ani.get_data(), dict)
+
+
+def test_adi_template(caplog):
+    Anisette.load("bundle.bin").get_data()
+
+    # a new session with the same libraries starts from the template built by the first one
+    with caplog.at_level(logging.DEBUG, logger="anisette._adi"):
+        Anisette.load("bundle.bin").get_data()
+    assert "Cloning VM from ADI template" in caplog.messages
+    assert "Building ADI template" not in caplog.messages
+
+
+def test_adi_template_output(caplog):
+    provider = Anisette.load("bundle.bin")._ani_provider
+    provider.adi.request_otp(DEFAULT_DS_ID)
+    adi_fs = provider._fs_collection.get("adi")
+
+    # a cloned VM must produce the same machine ID as one initialized from scratch on the same state
+    machine_ids = []
+    with caplog.at_level(logging.DEBUG, logger="anisette._adi"):
+        for use_template in (False, True):
+            adi = ADI(adi_fs.copy(), provider.library_store, provider.device.adi_identifier, use_template=use_template)
+            machine_ids.append(adi.request_otp(DEFAULT_DS_ID).machine_id)
+    assert "Cloning VM from ADI template" in caplog.messages
+    assert machine_ids[0] == machine_ids[1]
+
+
+def test_shared_images():
+    sessions = [Anisette.load("bundle.bin") for _ in range(2)]
+    buffers = []
+    for ani in sessions:
+        vm = ani._ani_provider.adi._vm
+        assert isinstance(vm, VM)
+        buffers.append({id(buffer) for _, _, _, buffer, _ in vm._shared_regions})
+
+    # read-only library segments of both sessions are backed by the same host memory
+    assert buffers[0]
+    assert buffers[0] == buffers[1]
+
+
+def test_image_cache(tmp_path):
+    ani = Anisette.init("applemusic.apk", cache_dir=tmp_path)
+    assert isinstance(ani.get_data(), dict)
+    assert any(tmp_path.glob("*.img"))
+
+    ani = Anisette.load("bundle.bin", cache_dir=tmp_path)
+    assert isinstance(ani.get_data(), dict)
+
+
+@pytest.mark.parametrize("routine", sorted(GUEST_ROUTINES))
+def test_guest_routines(routine):
+    lib_store = Anisette.load("bundle.bin")._ani_provider.library_store
+
+    results = []
+    for options in (VMOptions(), VMOptions(guest_routines=frozenset())):
+        vm = VM.create(VirtualFileSystem(), lib_store, Architecture.ARM64, options)
+        libraries = [vm.load_library(name) for name in ("libstoreservicescore.so", "libCoreADI.so")]
+        address = next(
+            library.symbols[index]
+            for library in libraries
+            for index, name in library.import_names().items()
+            if name == routine
+        )
+
+        src, dst = vm.malloc(0x100), vm.malloc(0x100)
+        vm.mem_write(src, b"hello world\x00" + b"\x11" * 40)
+        vm.mem_write(dst, b"\xee" * 0x100)
+        args = {
+            "memcpy": [dst + 3, src, 35],
+            "memset": [dst, 0x1AB, 37],
+            "strlen": [src],
+            "strncpy": [dst, src, 20],
+        }[routine]
+        ret = vm.invoke_cdecl(address, args)
+        results.append((ret - dst if ret >= dst else ret, vm.mem_read(dst, 0x40)))
+
+    # the guest routine behaves exactly like its Python fallback
+    assert results[0] == results[1]
+
+
+def test_allocator_stats():
+    ani = Anisette.load("bundle.bin")
+    assert ani.allocator_stats == {}
+
+    ani.get_data()
+    stats = ani.allocator_stats
+    assert set(stats) == {"temp", "malloc", "lib"}
+    assert stats["malloc"].alloc_calls > 0
+    assert 0 < stats["lib"].bytes_in_use <= stats["lib"].high_water_mark
+
+
+@pytest.mark.parametrize("recycle_threshold", [0.0, 0.5, 0.6])
+def test_invalid_recycle_threshold(recycle_threshold):
+    with pytest.raises(ValueError, match="recycle thresholds"):
+        Anisette.init("bundle.bin", recycle_threshold=recycle_threshold)
+
+
+def test_background_recycle():
+    ani = Anisette.load("bundle.bin", recycle_threshold=0.001)
+    ani.get_data()
+
+    # any memory use is above the threshold, so this starts preparing a replacement
+    provider = ani._ani_provider
+    provider._replacement = None
+    provider._startup_usage = 0.0
+    first = provider.adi
+    assert provider._replacement is not None
+    provider._replacement[0].result()
+
+    assert provider.adi is not first
+    assert isinstance(ani.get_data(), dict)
+
+
+def test_recycle_fresh_vm_above_threshold():
+    ani = Anisette.load("bundle.bin", recycle_threshold=0.001)
+    ani.get_data()
+
+    # a fresh VM is already above the threshold, so replacing it would not help
+    provider = ani._ani_provider
+    first = provider.adi
+    assert provider._replacement is None
+    assert provider.adi is first
+
+
+def test_recycle_backoff():
+    ani = Anisette.load("bundle.bin", recycle_threshold=0.001)
+    ani.get_data()
+    provider = ani._ani_provider
+    provider._startup_usage = 0.0
+    first = provider.adi
+    assert provider._replacement is not None
+    provider._replacement[0].result()
+
+    # the file system changed while the replacement was built, so it is discarded and not rebuilt right away
+    provider._fs_collection.get("adi").write_bytes("changed", b"")
+    assert provider.adi is first
+    assert provider._replacement is None
+    assert provider._retry_usage > max(first.alloc_stats)
+
+
+def test_call_budget():
+    ani = Anisette.load("bundle.bin", call_budget=CallBudget(max_instructions=1000))
+
+    # starting the library is not limited, only the calls every request makes
+    assert ani._ani_provider.adi is not None
+    with pytest.raises(CallBudgetExceededError):
+        ani.get_data()
+
+
+@pytest.mark.parametrize("transactions", [False, True])
+def test_call_budget_recovery(monkeypatch, transactions):
+    ani = Anisette.load("bundle.bin", transactions=transactions)
+    ani.get_data()
+    adi = ani._ani_provider.adi
+
+    # tighten the budget of the running VM, so the next OTP request is stopped partway through
+    options = replace(adi._vm._options, call_budget=CallBudget(timeout=0.000001))
+    monkeypatch.setattr(adi._vm, "_options", options)
+    with pytest.raises(CallBudgetExceededError):
+        adi.request_otp(DEFAULT_DS_ID)
+    assert adi.interrupted != transactions
+    monkeypatch.undo()
+
+    # the VM was either rolled back or is replaced, and the session keeps working
+    assert isinstance(ani.get_data(), dict)
+    assert (ani._ani_provider.adi is adi) == transactions
+
+
+def test_transactions(monkeypatch):
+    ani = Anisette.load("bundle.bin", transactions=True)
+    ani.get_data()
+    vm = ani._ani_provider.adi._vm
+    assert isinstance(vm, VM)
+    memory, stats = vm.checkpoint().memory, ani.allocator_stats
+
+    # let the next ADI call run for a while, then fail it from inside a host call
+    call_stub = vm.call_stub
+    calls = 0
+
+    def failing_call_stub(address):
+        nonlocal calls
+        calls += 1
+        call_stub(address)
+        if calls == 5:
+            msg = "injected failure"
+            raise RuntimeError(msg)
+
+    monkeypatch.setattr(vm, "call_stub", failing_call_stub)
+    with pytest.raises(RuntimeError, match="injected failure"):
+        ani.get_data()
+    monkeypatch.undo()
+
+    assert calls == 5
+    assert vm.checkpoint().memory == memory
+    assert ani.allocator_stats == stats
+    assert isinstance(ani.get_data(), dict)
+
+
+def test_call_stats():
+    ani = Anisette.load("bundle.bin", trace_level=TraceLevel.COUNT)
+    ani.get_data()
+
+    stats = ani.call_stats
+    assert stats["ADIOTPRequest"].calls == 1
+    assert stats["ADIOTPRequest"].instructions > 0
+
+
+@pytest.mark.parametrize("memory_profile", list(MemoryProfile))
+def test_memory_profile(memory_profile):
+    ani = Anisette.load("bundle.bin", memory_profile=memory_profile)
+    assert isinstance(ani.get_data(), dict)
+
+    stats = ani.allocator_stats
+    assert stats["malloc"].size == memory_profile.layout.malloc_size
+    assert stats["malloc"].high_water_mark < stats["malloc"].size
+
+
+def test_threads():
+    sessions = [Anisette.load("bundle.bin") for _ in range(4)]
+    with ThreadPoolExecutor(4) as executor:
+        # independent sessions in parallel, then one session shared by all threads
+        assert all(isinstance(data, dict) for data in executor.map(lambda ani: ani.get_data(), sessions))
+        assert all(isinstance(data, dict) for data in executor.map(lambda _: sessions[0].get_data(), range(8)))
+
+
+def test_profile(tmp_path):
+    ani = Anisette.load("bundle.bin")
+    ani.get_data()
+
+    with ani.profile(GuestProfiler(interval=0.0001)) as profiler:
+        ani.get_data()
+    assert "ADIOTPRequest" in profiler.stacks
+
+    profiler.write_collapsed(tmp_path / "otp.folded")
+    assert (tmp_path / "otp.folded").read_text().startswith("ADI")
+
+
+def test_stub_stats():
+    ani = Anisette.load("bundle.bin")
+    assert ani.stub_stats == {}
+
+    ani.enable_stub_stats()
+    ani.get_data()
+    stats = ani.stub_stats
+    assert "ADIOTPRequest" in stats
+    assert all(stub.calls > 0 and stub.max_time <= stub.total_time for stub in stats["ADIOTPRequest"].values())
+
+    ani.reset_stub_stats()
+    assert ani.stub_stats == {}
+
+
+def test_leak_report():
+    ani = Anisette.load("bundle.bin")
+    ani.get_data()
+    report = ani.leak_report
+    assert report is None
+
+    ani.enable_leak_tracking()
+    for _ in range(5):
+        ani.get_data()
+    report = ani.leak_report
+    assert report is not None
+    assert report.calls["ADIOTPRequest"] == 5
+
+    # the OTP buffers handed out by ADI are never freed, so every request leaves memory behind in ADI code
+    otp_sites = [site for site in report.sites if site.entry == "ADIOTPRequest"]
+    assert otp_sites
+    assert all(site.site.startswith(("libstoreservicescore.so", "libCoreADI.so")) for site in otp_sites)
+    assert sum(site.live_allocations for site in otp_sites) >= 5
+    assert report.live_bytes > 0
+
+
+def test_get_data_batch():
+    ani = Anisette.load("bundle.bin")
+    batch = ani.get_data_batch(5)
+
+    assert len(batch) == 5
+    assert len({headers["X-Apple-I-MD"] for headers in batch}) == 5
+    assert {headers["X-Apple-I-MD-M"] for headers in batch} == {ani.get_data()["X-Apple-I-MD-M"]}
+
+
+def test_otp_pool(monkeypatch):
+    ani = Anisette.load("bundle.bin")
+    ani.enable_otp_pool(size=2, max_age=60.0)
+    pool = ani._otp_pool
+    assert pool is not None
+
+    # nothing is ready for the first request, but it makes the pool start generating
+    ani.get_data()
+    assert pool.wait_ready(1, timeout=30.0)
+
+    def generate(*_args, **_kwargs):
+        msg = "headers should have come from the pool"
+        raise AssertionError(msg)
+
+    monkeypatch.setattr(ani, "get_data_batch", generate)
+    assert ani.get_data()["X-Apple-I-MD"]
+    monkeypatch.undo()
+
+    # enabling again replaces the pool, disabling stops it
+    ani.enable_otp_pool(size=1)
+    assert pool.closed
+    pool = ani._otp_pool
+    ani.enable_otp_pool(enabled=False)
+    assert pool is not None
+    assert pool.closed
+    assert ani._otp_pool is None
+
+
+def test_multiple_ds_ids(tmp_path):
+    ani = Anisette.load("bundle.bin")
+    ds_id = 123456789
+    ani.provision(ds_id)
+    assert ani.is_provisioned_for(ds_id)
+
+    assert ani.get_data(ds_id)["X-Apple-I-MD"]
+    assert ds_id in ani.provisioned_ds_ids
+
+    ani.save_all(tmp_path / "session.bin")
+    loaded = Anisette.load(tmp_path / "session.bin")
+    assert ds_id in loaded.provisioned_ds_ids
+    assert loaded.is_provisioned_for(ds_id)
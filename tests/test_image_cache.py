@@ -0,0 +1,36 @@
+from __future__ import annotations
+
+from anisette._image_cache import LibraryImageCache
+
+_LAYOUT = (0x100000, 0xA0000000, 8)
+_SEGMENTS = [(0x100000, 5, b"\x01" * 0x1800), (0x102000, 3, b"\x02" * 0x10)]
+_SYMBOLS = {3: 0xA0000018, 7: 0xA0000038}
+
+
+def test_second_load_hits_cache(tmp_path):
+    cache = LibraryImageCache(tmp_path)
+    assert cache.load("digest", _LAYOUT) is None
+
+    cache.store("digest", _LAYOUT, _SEGMENTS, _SYMBOLS)
+    image = cache.load("digest", _LAYOUT)
+    assert image is not None
+    assert image.symbols == _SYMBOLS
+    for (address, perms, data), (seg_address, size, offset, seg_perms) in zip(_SEGMENTS, image.segments):
+        assert (seg_address, size, seg_perms) == (address, len(data), perms)
+        assert image.buffer[offset : offset + size] == data
+
+    # any layout difference is a different image
+    assert cache.load("digest", (0x200000, 0xA0000000, 8)) is None
+    assert cache.load("other", _LAYOUT) is None
+
+
+def test_corrupt_image_is_ignored(tmp_path):
+    cache = LibraryImageCache(tmp_path)
+    cache.store("digest", _LAYOUT, _SEGMENTS, _SYMBOLS)
+
+    (path,) = tmp_path.glob("*.img")
+    path.write_bytes(b"garbage")
+    assert cache.load("digest", _LAYOUT) is None
+
+    path.write_bytes(path.read_bytes()[:4])
+    assert cache.load("digest", _LAYOUT) is None
@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import struct
+
+import pytest
+
+from anisette._library import Library
+
+_SYM = struct.Struct("<IBBHQQ")
+_BASE = 0x100000
+
+
+class _Section:
+    def __init__(self, data: bytes) -> None:
+        self._data = data
+
+    def data(self) -> bytes:
+        return self._data
+
+
+class _ELF:
+    elfclass = 64
+    little_endian = True
+
+    def __init__(self, symbols: list[tuple[bytes, int, int]]) -> None:
+        strtab = bytearray(b"\x00")
+        symtab = bytearray()
+        for name, shndx, value in symbols:
+            symtab += _SYM.pack(len(strtab) if name else 0, 0, 0, shndx, value, 0)
+            strtab += name + b"\x00"
+        self._sections = {".dynsym": _Section(bytes(symtab)), ".dynstr": _Section(bytes(strtab))}
+
+    def get_section_by_name(self, name: str) -> _Section | None:
+        return self._sections.get(name)
+
+
+def _library() -> Library:
+    elf = _ELF(
+        [
+            (b"", 0, 0),
+            (b"foo", 9, 0x100),
+            (b"malloc", 0, 0),
+            (b"\xffbad", 9, 0x200),
+            (b"foo", 9, 0x300),
+        ],
+    )
+    return Library("libtest.so", elf, _BASE, 0)  # type: ignore[arg-type]
+
+
+def test_resolve_symbol_by_name():
+    library = _library()
+
+    # the first symbol with a name wins, like a scan of the symbol table
+    assert library.resolve_symbol_by_name("foo") == _BASE + 0x100
+    with pytest.raises(ValueError, match="not found"):
+        library.resolve_symbol_by_name("bar")
+
+    # bound imports resolve to their stub
+    library.symbols[2] = 0xA0000010
+    assert library.resolve_symbol_by_name("malloc") == 0xA0000010
+    assert library.resolve_symbol_by_index(2) == 0xA0000010
+
+
+def test_symbol_names():
+    library = _library()
+
+    assert library.symbol_name_by_index(1) == "foo"
+    assert library.import_names() == {0: "", 2: "malloc"}
+    assert library.defined_symbols() == [(_BASE + 0x100, "foo"), (_BASE + 0x200, "\ufffdbad"), (_BASE + 0x300, "foo")]
+
+
+def test_invalid_utf8_name():
+    library = _library()
+
+    # decoded like pyelftools does, instead of failing to load the library
+    assert library.symbol_name_by_index(3) == "\ufffdbad"
+    assert library.resolve_symbol_by_name("\ufffdbad") == _BASE + 0x200
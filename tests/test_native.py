@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import io
+import platform
+import shutil
+import subprocess
+
+import pytest
+
+from anisette._arch import Architecture
+from anisette._fs import VirtualFileSystem
+from anisette._library import LibraryStore
+from anisette._native import NativeVM, native_supported, runs_natively
+from anisette._vm import Backend, CallBudget, TraceLevel, VMOptions
+
+_HOST_ARCH = {"aarch64": Architecture.ARM64, "x86_64": Architecture.X86_64}.get(platform.machine().lower())
+
+# stand-ins for the ADI libraries, built without libc so every libc call goes through an import stub
+_SSC_SOURCE = b"""
+typedef unsigned long size_t;
+void *malloc(size_t size);
+void *memcpy(void *dst, const void *src, size_t n);
+size_t strlen(const char *s);
+int open(const char *path, int flags, ...);
+long read(int fd, void *buf, size_t n);
+long write(int fd, const void *buf, size_t n);
+int close(int fd);
+void *dlopen(const char *path, int flags);
+void *dlsym(void *handle, const char *name);
+int not_stubbed(void);
+
+int counter = 0;
+
+long copy_string(const char *s) {
+    size_t n = strlen(s);
+    char *copy = malloc(n + 1);
+    memcpy(copy, s, n + 1);
+    counter += 1;
+    return (long)copy;
+}
+
+long write_read(const char *path, const char *data, char *out) {
+    size_t n = strlen(data);
+    int fd = open(path, 0100 | 02, 0644);
+    write(fd, data, n);
+    close(fd);
+    fd = open(path, 0);
+    n = read(fd, out, n);
+    close(fd);
+    return n;
+}
+
+long call_twice(long value) {
+    void *handle = dlopen("libCoreADI.so", 0);
+    long (*twice)(long) = (long (*)(long))dlsym(handle, "twice");
+    return twice(value);
+}
+
+int call_not_stubbed(void) {
+    counter += 1;
+    return not_stubbed() + 1;
+}
+"""
+
+_ADI_SOURCE = b"""
+long twice(long value) {
+    return value * 2;
+}
+"""
+
+
+def _compile(compiler: str, tmp_path, name: str, source: bytes) -> bytes:
+    src = tmp_path / f"{name}.c"
+    src.write_bytes(source)
+    out = tmp_path / name
+    subprocess.run(
+        [compiler, "-shared", "-fPIC", "-O1", "-nostdlib", "-fno-stack-protector", "-o", str(out), str(src)],
+        check=True,
+    )
+    return out.read_bytes()
+
+
+@pytest.fixture
+def native_vm(tmp_path):
+    compiler = shutil.which("cc")
+    if _HOST_ARCH is None or not native_supported(_HOST_ARCH) or compiler is None:
+        pytest.skip("needs a Linux host with a C compiler")
+
+    lib_store = LibraryStore(None)
+    lib_store.add_library("libstoreservicescore.so", io.BytesIO(_compile(compiler, tmp_path, "ssc", _SSC_SOURCE)))
+    lib_store.add_library("libCoreADI.so", io.BytesIO(_compile(compiler, tmp_path, "adi", _ADI_SOURCE)))
+
+    vm = NativeVM(VirtualFileSystem(), lib_store, _HOST_ARCH, VMOptions(transactions=True))
+    library = vm.load_library("libstoreservicescore.so")
+    return vm, library
+
+
+def test_native_calls(native_vm):
+    vm, library = native_vm
+
+    copy = vm.invoke_cdecl(library.resolve_symbol_by_name("copy_string"), [vm.temp_alloc_data(b"hello\x00")])
+    assert vm.read_cstr(copy) == b"hello"
+    assert vm.allocator_stats["malloc"].alloc_calls == 1
+
+    out = vm.malloc(64)
+    args = [vm.temp_alloc_data(b"state\x00"), vm.temp_alloc_data(b"some data\x00"), out]
+    assert vm.invoke_cdecl(library.resolve_symbol_by_name("write_read"), args) == 9
+    assert vm.mem_read(out, 9) == b"some data"
+
+    # dlopen loads the other library into the same VM
+    assert vm.invoke_cdecl(library.resolve_symbol_by_name("call_twice"), [21]) == 42
+
+
+def test_native_stub_failure(native_vm):
+    vm, library = native_vm
+    counter = library.resolve_symbol_by_name("counter")
+    checkpoint = vm.checkpoint()
+
+    with pytest.raises(RuntimeError, match="not_stubbed"), vm.transaction():
+        vm.invoke_cdecl(library.resolve_symbol_by_name("call_not_stubbed"), [])
+
+    # the library went on after the failed stub, until the transaction rolled it back
+    assert not vm.interrupted
+    assert vm.read_struct(counter, "<i") == (0,)
+    assert vm.checkpoint().memory == checkpoint.memory
+
+    with pytest.raises(RuntimeError, match="not_stubbed"):
+        vm.invoke_cdecl(library.resolve_symbol_by_name("call_not_stubbed"), [])
+    assert vm.interrupted
+
+
+@pytest.mark.parametrize(
+    ("options", "native"),
+    [
+        (None, False),
+        (VMOptions(), False),
+        (VMOptions(backend=Backend.NATIVE), True),
+        (VMOptions(backend=Backend.NATIVE, trace_level=TraceLevel.COUNT), False),
+        (VMOptions(backend=Backend.NATIVE, call_budget=CallBudget(timeout=1.0)), False),
+    ],
+)
+def test_runs_natively(options, native):
+    # anything the host can't run natively falls back to the emulator
+    for arch in Architecture:
+        assert runs_natively(options, arch) == (native and native_supported(arch))
@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import threading
+
+import pytest
+
+from anisette._otp_pool import OTPPool
+
+
+class _Producer:
+    def __init__(self) -> None:
+        self.generated = 0
+        self.release = threading.Event()
+        self.release.set()
+
+    def batch(self, count: int) -> list[int]:
+        self.release.wait()
+        entries = list(range(self.generated, self.generated + count))
+        self.generated += count
+        return entries
+
+
+def test_invalid_settings():
+    with pytest.raises(ValueError, match="Invalid OTP pool settings"):
+        OTPPool(lambda: None, 0, 1.0)
+    with pytest.raises(ValueError, match="Invalid OTP pool settings"):
+        OTPPool(lambda: None, 1, 0.0)
+
+
+def test_take_prefilled_entry():
+    producer = _Producer()
+    pool = OTPPool(lambda: producer.batch, 4, 60.0)
+    try:
+        # nothing is generated before there is demand
+        assert pool.take() is None
+        assert pool.wait_ready(1, timeout=5.0)
+
+        producer.release.clear()
+        assert pool.take() == 0
+        assert producer.generated == 1
+    finally:
+        producer.release.set()
+        pool.close()
+
+
+def test_pool_follows_demand():
+    producer = _Producer()
+    pool = OTPPool(lambda: producer.batch, 2, 60.0)
+    try:
+        for _ in range(5):
+            pool.take()
+        # five requests, but never more than the pool size ready
+        assert pool.wait_ready(2, timeout=5.0)
+        assert len(pool) == 2
+    finally:
+        pool.close()
+
+
+def test_close():
+    producer = _Producer()
+    pool = OTPPool(lambda: producer.batch, 2, 60.0)
+    pool.take()
+    pool.close()
+
+    assert pool.closed
+    assert len(pool) == 0
+    assert not pool.wait_ready(1, timeout=0.0)
+    assert pool.take() is None
+
+
+def test_stops_without_producer():
+    pool = OTPPool(lambda: None, 2, 60.0)
+    pool.take()
+    pool._thread.join(timeout=5.0)
+    assert not pool._thread.is_alive()
@@ -0,0 +1,23 @@
+from __future__ import annotations
+
+import pytest
+
+from anisette._vm import IMPORT_STRIDE, RETURN_ADDRESS, CallBudget, _import_region_address
+
+
+def test_import_region_address():
+    assert _import_region_address(1) - _import_region_address(0) == IMPORT_STRIDE
+
+    # the last region still ends before the fake return address, the next one would overlap it
+    last = next(index for index in range(256) if _import_region_address(index) + 2 * IMPORT_STRIDE > RETURN_ADDRESS)
+    with pytest.raises(RuntimeError, match="Cannot load more than"):
+        _import_region_address(last + 1)
+
+
+@pytest.mark.parametrize(
+    "limits",
+    [{"timeout": 0}, {"timeout": -1.0}, {"max_instructions": 0}, {"max_instructions": -5}],
+)
+def test_invalid_call_budget(limits):
+    with pytest.raises(ValueError, match="Invalid call budget"):
+        CallBudget(**limits)